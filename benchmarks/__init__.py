@@ -0,0 +1,23 @@
+###############################################################################
+#
+# Benchmarks for pickledbg
+#
+# `python -m benchmarks` times the debugger's hot paths on synthetic pickles
+# of every protocol and several shapes, and writes the results as JSON so
+# that two runs (e.g. on two Python versions, whose `_Unpickler` internals
+# change under `DbgUnpickler`) can be compared with `--compare`.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import os, sys
+
+
+### CONSTANTS ###
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, "src")
+
+# the debugger's modules import each other as top-level modules
+if SRC not in sys.path:
+    sys.path.insert(0, SRC)
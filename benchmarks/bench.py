@@ -0,0 +1,368 @@
+###############################################################################
+#
+# Benchmark runner for pickledbg
+#
+# Times, for every generated pickle:
+#   startup      `pickledbg <file>` in a new interpreter, until the prompt
+#   dis          `pickletools.dis`, what the disassembly used to be built with
+#   index        building the `Disassembly` index the debugger uses instead
+#   index-cached loading that index from the on-disk cache
+#   step         `DbgUnpickler.run()` to the end, without drawing frames
+#   step-no-checkpoints  the same with checkpoints for `back` disabled
+#   step-print   `DbgUnpickler.run()` drawing a frame per instruction
+#   unpickle     `pickle._Unpickler.load()`, the pure-Python unpickler
+#   symbolic     `SymbolicUnpickler.summarize()`, what `summary` and `scan` run
+# and, once per shape, rendering the unpickled value with `colorize_*` and
+# with the budgeted `Renderer` used for each frame.
+#
+# Each case is run several times and the fastest run is kept, which is the
+# least noisy estimate of what the code itself costs.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import os, re, sys, json, time, pickle, argparse, platform, tempfile, subprocess
+from pickletools import dis
+from statistics import median
+
+
+### LOCAL IMPORTS ###
+from benchmarks import SRC
+from benchmarks.generators import SHAPES, PROTOCOLS, write_all
+from disasm import Disassembly
+from pickledbg import DbgUnpickler
+from symbolic import SymbolicUnpickler
+from source import PickleSource
+from cache import IndexCache, MIN_INSTRUCTIONS
+from colors import Renderer, colorize_array, colorize_dict
+from screen import Screen
+
+
+### CONSTANTS ###
+FORMAT_VERSION = 1
+PROMPT = b"pickledbg>"
+STARTUP_TIMEOUT = 60        # seconds to wait for the prompt
+# what the installed `pickledbg` script runs, so that startup is measured
+# with the modules' bytecode cached rather than compiling pickledbg.py
+ENTRY_POINT = "import sys; from pickledbg import main; sys.exit(main())"
+FRAMES = 300                # instructions stepped with a frame drawn for each
+DEFAULT_THRESHOLD = 0.20    # slowdown reported as a regression by --compare
+CACHE_BYTES = 1 << 40       # nothing is evicted from the benchmarks' index cache
+
+
+### CLASSES ###
+class NullWriter:
+    """A file that discards what is written to it, standing in for the terminal."""
+    def write(self, text: str) -> int:
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+    def isatty(self) -> bool:
+        return False
+
+
+### FUNCTIONS ###
+def measure(case, repeat: int) -> dict:
+    """Runs `case` `repeat` times and summarizes the timings.
+
+    `case()` returns a function to time (so that setup isn't timed), which
+    returns how many units of work it did, or (units, seconds) if it times
+    itself because its teardown mustn't be counted.
+    """
+    times = []
+    units = 0
+    for _ in range(repeat):
+        timed = case()
+        start = time.perf_counter()
+        units = timed()
+        elapsed = time.perf_counter() - start
+        if isinstance(units, tuple):
+            units, elapsed = units
+        times.append(elapsed)
+    best = min(times)
+    return {
+        "seconds": best,
+        "median": median(times),
+        "units": units,
+        "per_second": units / best if best > 0 else None,
+    }
+
+
+def open_debugger(data: bytes, verbose: bool, checkpoints: bool = True) -> DbgUnpickler:
+    """Returns a DbgUnpickler over `data` that is ready to step, drawing frames nowhere."""
+    from io import BytesIO
+    unpickler = DbgUnpickler(BytesIO(data), disasm=Disassembly(data))
+    unpickler.screen = Screen(NullWriter())
+    unpickler.options['step-verbose'] = verbose
+    if not checkpoints:
+        unpickler.options['checkpoint-interval'] = 0
+        unpickler.checkpoints.configure(0, unpickler.options['checkpoint-limit'])
+    unpickler.setup_machine()
+    unpickler.last_command = None
+    unpickler.start = True
+    return unpickler
+
+
+def startup_case(path: str):
+    """Times `pickledbg <path>` from starting the interpreter to the first prompt."""
+    def case():
+        return timed
+
+    def timed():
+        env = dict(os.environ, PYTHONUNBUFFERED="1", PYTHONPATH=SRC, COLUMNS="120", LINES="40")
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "-c", ENTRY_POINT, path],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL, env=env)
+        try:
+            output = b""
+            while PROMPT not in output:
+                if time.perf_counter() - start > STARTUP_TIMEOUT:
+                    raise TimeoutError(f"no prompt after {STARTUP_TIMEOUT} s")
+                chunk = os.read(process.stdout.fileno(), 65536)
+                if not chunk:
+                    raise RuntimeError("pickledbg exited before showing the prompt")
+                output += chunk
+            elapsed = time.perf_counter() - start
+        finally:
+            # end of input quits the debugger
+            process.stdin.close()
+            process.stdout.close()
+            process.wait()
+        return 1, elapsed
+    return case
+
+
+def dis_case(data: bytes):
+    def case():
+        out = NullWriter()
+        def timed():
+            dis(data, out=out)
+            return len(data)
+        return timed
+    return case
+
+
+def index_case(data: bytes):
+    def case():
+        def timed():
+            return len(Disassembly(data))
+        return timed
+    return case
+
+
+def unpickle_case(data: bytes):
+    def case():
+        reader = PickleSource(data).reader()
+        def timed():
+            pickle._Unpickler(reader).load()
+            return reader.tell()
+        return timed
+    return case
+
+
+def symbolic_case(data: bytes):
+    def case():
+        unpickler = SymbolicUnpickler(PickleSource(data).reader())
+        def timed():
+            unpickler.summarize()
+            return sum(unpickler.counts)
+        return timed
+    return case
+
+
+def cached_index_case(data: bytes, path: str, directory: str):
+    """Loads the index of the pickle at `path` from a cache in `directory`, where it is saved first.
+
+    Returns None if the pickle is too small to be cached.
+    """
+    disasm = Disassembly(data)
+    if len(disasm) < MIN_INSTRUCTIONS:
+        return None
+    IndexCache(directory, CACHE_BYTES, path).save_index(disasm)
+    def case():
+        def timed():
+            disasm = Disassembly(data, background=True)
+            if not IndexCache(directory, CACHE_BYTES, path).load_index(disasm):
+                raise RuntimeError(f"the index of {path} is not in the cache")
+            return len(disasm)
+        return timed
+    return case
+
+
+def step_case(data: bytes, verbose: bool, checkpoints: bool = True):
+    """Steps through the pickle, or through the first FRAMES instructions if drawing frames."""
+    def case():
+        unpickler = open_debugger(data, verbose, checkpoints)
+        count = FRAMES if verbose else None
+        def timed():
+            try:
+                unpickler.run(count)
+            except pickle._Stop:
+                pass
+            return unpickler.executed
+        return timed
+    return case
+
+
+def colorize_case(value):
+    render = colorize_dict if isinstance(value, dict) else colorize_array
+    def case():
+        def timed():
+            render(value)
+            return 1
+        return timed
+    return case
+
+
+def renderer_case(value):
+    """Renders a stack and memo holding `value` with the debugger's default budgets, without the cache."""
+    def case():
+        renderer = Renderer(10, 3, 200)
+        memo = {0: value}
+        renderer.memo = memo
+        def timed():
+            for _ in range(FRAMES):
+                renderer.generation += 1
+                renderer.render_items([value])
+                renderer.render_mapping(memo)
+                renderer.end_frame()
+            return FRAMES
+        return timed
+    return case
+
+
+def run_benchmarks(directory: str, scale: float, repeat: int, pattern: str = None, log=None) -> dict:
+    """Runs every benchmark whose name matches `pattern` on pickles generated in `directory`.
+
+    Returns:
+        dict: benchmark name -> result from `measure()`.
+    """
+    selected = re.compile(pattern) if pattern else None
+    wanted = lambda name: selected is None or selected.search(name)
+    results = {}
+
+    def record(name, case):
+        if not wanted(name):
+            return
+        results[name] = measure(case, repeat)
+        if log is not None:
+            result = results[name]
+            log(f"{name:<40} {result['seconds'] * 1000:>10.2f} ms")
+
+    limit = sys.getrecursionlimit()
+    # rendering and building the deepest values recurse once per level
+    sys.setrecursionlimit(max(limit, 20000))
+    try:
+        paths = write_all(directory, scale)
+        for shape in SHAPES:
+            for protocol in PROTOCOLS:
+                path = paths[shape, protocol]
+                with open(path, "rb") as f:
+                    data = f.read()
+                prefix = f"{shape}/p{protocol}"
+                record(f"startup/{prefix}", startup_case(path))
+                record(f"dis/{prefix}", dis_case(data))
+                record(f"index/{prefix}", index_case(data))
+                if wanted(f"index-cached/{prefix}"):
+                    cached = cached_index_case(data, path, os.path.join(directory, "cache"))
+                    if cached is not None:
+                        record(f"index-cached/{prefix}", cached)
+                record(f"step/{prefix}", step_case(data, False))
+                record(f"step-no-checkpoints/{prefix}", step_case(data, False, checkpoints=False))
+                record(f"step-print/{prefix}", step_case(data, True))
+                record(f"unpickle/{prefix}", unpickle_case(data))
+                record(f"symbolic/{prefix}", symbolic_case(data))
+            value = SHAPES[shape](scale)
+            record(f"colorize/{shape}", colorize_case(value))
+            record(f"render-frame/{shape}", renderer_case(value))
+    finally:
+        sys.setrecursionlimit(limit)
+    return results
+
+
+def environment() -> dict:
+    """Describes where the benchmarks ran, so results from different machines aren't confused."""
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+    }
+
+
+def compare(old: dict, new: dict, threshold: float) -> list[str]:
+    """Compares two result files.
+
+    Returns:
+        list[str]: A line for every benchmark that got more than `threshold` slower.
+    """
+    regressions = []
+    print(f"{'benchmark':<40} {'old ms':>10} {'new ms':>10} {'change':>8}")
+    for name, result in new["results"].items():
+        before = old["results"].get(name)
+        if before is None or not before["seconds"]:
+            continue
+        change = result["seconds"] / before["seconds"] - 1
+        line = (f"{name:<40} {before['seconds'] * 1000:>10.2f} {result['seconds'] * 1000:>10.2f} "
+                f"{change:>+8.1%}")
+        print(line)
+        if change > threshold:
+            regressions.append(line)
+    return regressions
+
+
+def main(argv: list[str]) -> int:
+    """Runs the benchmarks. Returns the exit code."""
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Time pickledbg's hot paths on synthetic pickles and compare runs")
+    parser.add_argument("-o", "--output", default="benchmarks.json",
+                        help="results file (default: benchmarks.json)")
+    parser.add_argument("-k", "--filter", metavar="REGEX",
+                        help="only run benchmarks whose name matches, e.g. 'step/' or 'p5$'")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiplies the size of every generated pickle (default: 1.0)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="runs per benchmark, the fastest is kept (default: 5)")
+    parser.add_argument("--dir",
+                        help="where to write the generated pickles (default: a temporary directory)")
+    parser.add_argument("--compare", metavar="BASELINE",
+                        help="results file to compare against; exits with 1 if anything regressed")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help=f"slowdown counted as a regression (default: {DEFAULT_THRESHOLD})")
+    args = parser.parse_args(argv)
+
+    log = lambda line: print(line, file=sys.stderr)
+    if args.dir is not None:
+        results = run_benchmarks(args.dir, args.scale, max(args.repeat, 1), args.filter, log)
+    else:
+        with tempfile.TemporaryDirectory(prefix="pickledbg-bench-") as directory:
+            results = run_benchmarks(directory, args.scale, max(args.repeat, 1), args.filter, log)
+
+    report = {
+        "version": FORMAT_VERSION,
+        "environment": environment(),
+        "scale": args.scale,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"[+] Wrote {len(results)} results to {args.output}", file=sys.stderr)
+
+    if args.compare is None:
+        return 0
+    with open(args.compare) as f:
+        baseline = json.load(f)
+    if baseline.get("scale") != args.scale:
+        print(f"[-] Warning: the baseline was run with --scale {baseline.get('scale')}", file=sys.stderr)
+    regressions = compare(baseline, report, args.threshold)
+    if regressions:
+        print(f"[-] {len(regressions)} benchmark(s) more than {args.threshold:.0%} slower than {args.compare}")
+        return 1
+    print(f"[+] No benchmark more than {args.threshold:.0%} slower than {args.compare}")
+    return 0
@@ -0,0 +1,78 @@
+###############################################################################
+#
+# Checkpoint overhead check for pickledbg
+#
+# `python -m benchmarks.checkpoints` fails if the checkpoints `back` restores
+# from make running a pickle to the end (what `continue` does) more than
+# `--max-ratio` times slower than with checkpoints disabled, for any of the
+# generated shapes. Both runs are timed on the same machine, so unlike the
+# startup budget the check doesn't depend on how fast the machine is.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import sys, argparse
+
+
+### LOCAL IMPORTS ###
+from benchmarks.bench import step_case, measure
+from benchmarks.generators import SHAPES, generate
+
+
+### CONSTANTS ###
+DEFAULT_MAX_RATIO = 1.5
+PROTOCOLS = (2, 5)      # the memo and framing opcodes differ the most between these
+
+
+### FUNCTIONS ###
+def check_overhead(scale: float, repeat: int, max_ratio: float) -> list[str]:
+    """Returns a problem for every pickle that checkpoints slow down more than `max_ratio` times."""
+    problems = []
+    limit = sys.getrecursionlimit()
+    # deep nesting is copied one level per call
+    sys.setrecursionlimit(max(limit, 20000))
+    try:
+        print(f"{'pickle':<24} {'on ms':>10} {'off ms':>10} {'ratio':>7}")
+        for shape in SHAPES:
+            for protocol in PROTOCOLS:
+                data = generate(shape, protocol, scale)
+                # alternated, so neither run gets the memory the other freed every time
+                on = off = float("inf")
+                for _ in range(repeat):
+                    on = min(on, measure(step_case(data, False), 1)["seconds"])
+                    off = min(off, measure(step_case(data, False, checkpoints=False), 1)["seconds"])
+                ratio = on / off if off else 1.0
+                name = f"{shape}/p{protocol}"
+                print(f"{name:<24} {on * 1000:>10.2f} {off * 1000:>10.2f} {ratio:>6.2f}x")
+                if ratio > max_ratio:
+                    problems.append(f"{name}: continue is {ratio:.2f}x slower with checkpoints")
+    finally:
+        sys.setrecursionlimit(limit)
+    return problems
+
+
+def main(argv: list[str]) -> int:
+    """Runs the check. Returns the exit code."""
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.checkpoints",
+        description="Check that checkpoints for 'back' keep 'continue' fast")
+    parser.add_argument("--max-ratio", type=float, default=DEFAULT_MAX_RATIO,
+                        help=f"slowdown from checkpoints counted as a failure (default: {DEFAULT_MAX_RATIO})")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiplies the size of every generated pickle (default: 1.0)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per measurement, the fastest is kept (default: 3)")
+    args = parser.parse_args(argv)
+
+    problems = check_overhead(args.scale, max(args.repeat, 1), args.max_ratio)
+    for problem in problems:
+        print(f"[-] {problem}")
+    if problems:
+        return 1
+    print(f"[+] Checkpoints slow continue down by at most {args.max_ratio:g}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,97 @@
+###############################################################################
+#
+# Synthetic pickle generators for the pickledbg benchmarks
+#
+# Each shape stresses a different part of the debugger: deep nesting the
+# MARK/metastack handling and recursive rendering, wide dicts SETITEMS and
+# the memo pane, huge bytes the reads and previews of large values, memo
+# heavy pickles PUT/GET, rows of tuples a large but flat state to checkpoint,
+# and REDUCE heavy pickles global lookups and calls.
+# Every shape is built from plain Python values and pickled with the stdlib,
+# so the same object exercises each protocol's own opcodes.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import os, sys, pickle
+
+
+### CONSTANTS ###
+PROTOCOLS = tuple(range(pickle.HIGHEST_PROTOCOL + 1))
+
+
+### FUNCTIONS ###
+def deep_nesting(scale: float) -> list:
+    """Lists nested inside lists, each holding a number and a string."""
+    value = []
+    for i in range(max(int(1000 * scale), 1)):
+        value = [i, f"level {i}", value]
+    return value
+
+
+def wide_dict(scale: float) -> dict:
+    """One dict with many string keys and small values."""
+    return {f"key {i}": (i, i * 0.5) if i % 2 else f"value {i}" for i in range(max(int(50000 * scale), 1))}
+
+
+def huge_bytes(scale: float) -> list:
+    """A few multi-MB bytes objects."""
+    size = max(int((4 << 20) * scale), 1)
+    return [bytes([i]) * size for i in range(4)]
+
+
+def memo_heavy(scale: float) -> list:
+    """Strings referenced four times each, so most of the pickle is memo GETs."""
+    strings = [f"string {i}" for i in range(max(int(20000 * scale), 1))]
+    return strings + strings[::-1] + strings + strings[::-1]
+
+
+def tuple_rows(scale: float) -> list:
+    """Many small tuples in one list, like the rows of a table."""
+    return [(i, f"row {i}", i * 0.5) for i in range(max(int(80000 * scale), 1))]
+
+
+def reduce_heavy(scale: float) -> list:
+    """Objects that are rebuilt by calling a global, one REDUCE each."""
+    return [complex(i, -i) for i in range(max(int(20000 * scale), 1))]
+
+
+# shape name -> function building the object to pickle at a given scale
+SHAPES = {
+    "deep-nesting": deep_nesting,
+    "wide-dict": wide_dict,
+    "huge-bytes": huge_bytes,
+    "memo-heavy": memo_heavy,
+    "tuple-rows": tuple_rows,
+    "reduce-heavy": reduce_heavy,
+}
+
+
+def generate(shape: str, protocol: int, scale: float = 1.0) -> bytes:
+    """Returns the pickle of `shape` at `scale` with `protocol`."""
+    value = SHAPES[shape](scale)
+    limit = sys.getrecursionlimit()
+    # the pickler recurses once per level of nesting
+    sys.setrecursionlimit(max(limit, 10000))
+    try:
+        return pickle.dumps(value, protocol=protocol)
+    finally:
+        sys.setrecursionlimit(limit)
+
+
+def write_all(directory: str, scale: float = 1.0, shapes=None, protocols=PROTOCOLS) -> dict:
+    """Writes every shape in every protocol to `directory`.
+
+    Returns:
+        dict: (shape, protocol) -> path of the pickle file.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for shape in shapes or SHAPES:
+        for protocol in protocols:
+            path = os.path.join(directory, f"{shape}-p{protocol}.pickle")
+            with open(path, "wb") as f:
+                f.write(generate(shape, protocol, scale))
+            paths[shape, protocol] = path
+    return paths
@@ -0,0 +1,111 @@
+###############################################################################
+#
+# Startup regression check for pickledbg
+#
+# `python -m benchmarks.startup` fails if the debugger got slow to start:
+#   - `import pickledbg` must not import any module that is only needed
+#     after the prompt or by another mode, according to `-X importtime`
+#   - the prompt must appear within a time budget, even for a pickle too
+#     big to disassemble in that time
+# The first check is exact, so it is the one to run in CI; the second
+# depends on the machine.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import os, sys, argparse, subprocess, tempfile
+
+
+### LOCAL IMPORTS ###
+from benchmarks import SRC
+from benchmarks.bench import startup_case, measure
+from benchmarks.generators import generate
+
+
+### CONSTANTS ###
+DEFAULT_BUDGET_MS = 100
+SHOWN = 10      # slowest imports listed in the report
+
+# modules that `import pickledbg` must leave for later: readline is set up
+# right before the prompt, the rest are only used by some commands or modes
+DEFERRED = frozenset((
+    "readline", "ast", "typing", "json", "zipfile", "tempfile", "tracemalloc", "asyncio",
+    "profiler", "recorder", "xref", "cache", "server", "symbolic", "scan", "replay",
+))
+
+
+### FUNCTIONS ###
+def import_times() -> list[tuple[str, int, int]]:
+    """Imports pickledbg in a new interpreter under `-X importtime`.
+
+    Returns:
+        list[tuple[str, int, int]]: (module, self µs, cumulative µs) for
+            every module imported, in the order they finished importing.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import pickledbg"],
+                            cwd=SRC, capture_output=True, text=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        if not own.strip().isdigit():
+            continue    # the header
+        modules.append((name.strip(), int(own), int(cumulative)))
+    return modules
+
+
+def check_imports() -> list[str]:
+    """Returns a problem for every deferred module `import pickledbg` imports."""
+    modules = import_times()
+    total = next(cumulative for name, _, cumulative in reversed(modules) if name == "pickledbg")
+    print(f"import pickledbg: {total / 1000:.1f} ms, slowest modules (cumulative):")
+    top_level = [m for m in modules if m[0] != "pickledbg"]
+    for name, _, cumulative in sorted(top_level, key=lambda m: -m[2])[:SHOWN]:
+        print(f"  {name:<30} {cumulative / 1000:>6.1f} ms")
+    return [f"import pickledbg imports {name}, which should be imported when first used"
+            for name, _, _ in modules if name in DEFERRED]
+
+
+def check_prompt(budget_ms: float, repeat: int) -> list[str]:
+    """Returns a problem if the prompt takes longer than `budget_ms` to appear for a large pickle."""
+    with tempfile.TemporaryDirectory(prefix="pickledbg-startup-") as directory:
+        path = os.path.join(directory, "large.pickle")
+        with open(path, "wb") as f:
+            # about 1M instructions, several seconds of disassembly
+            f.write(generate("wide-dict", 0, scale=5))
+        result = measure(startup_case(path), repeat)
+    elapsed = result["seconds"] * 1000
+    print(f"prompt shown after {elapsed:.1f} ms (budget {budget_ms:g} ms)")
+    if elapsed > budget_ms:
+        return [f"the prompt took {elapsed:.1f} ms to appear, the budget is {budget_ms:g} ms"]
+    return []
+
+
+def main(argv: list[str]) -> int:
+    """Runs the startup checks. Returns the exit code."""
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.startup",
+        description="Check that pickledbg's imports stay lazy and its prompt appears quickly")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS,
+                        help=f"time allowed until the prompt appears (default: {DEFAULT_BUDGET_MS})")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="startups timed, the fastest is kept (default: 5)")
+    parser.add_argument("--imports-only", action="store_true",
+                        help="only check which modules are imported, not the time to the prompt")
+    args = parser.parse_args(argv)
+
+    problems = check_imports()
+    if not args.imports_only:
+        problems += check_prompt(args.budget_ms, max(args.repeat, 1))
+    for problem in problems:
+        print(f"[-] {problem}")
+    if problems:
+        return 1
+    print("[+] Startup is within budget")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -2,13 +2,15 @@
 # 
 # A simple tool to compare the output of different pickle implementations
 # 
+# Edit `payload` and run this script. It is a shortcut for `pickledbg diff`,
+# which also takes files and whole corpora: see `pickledbg diff -h`.
+# 
 ###########
 
 # imports
-from pickle import _Unpickler
-import _pickle
-from io import BytesIO
-from pickletools import dis
+import os, sys, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+from diff import diff_file
 
 
 # edit here
@@ -16,25 +18,16 @@ payload = b'].'
 encoding = 'utf-8'
 
 
-# pickle
-print('pickle:       ',end='')
-try:
-    print(_Unpickler(BytesIO(payload),encoding=encoding).load())
-except Exception as e:
-    print('FAILURE',e)
-    
-
-# _pickle.c
-print('_pickle.c:    ',end='')
-try:
-    print(_pickle.loads(payload,encoding=encoding))
-except Exception as e:
-    print('FAILURE',e)
-    
+with tempfile.TemporaryDirectory(prefix="pickledbg-compare-") as directory:
+    path = os.path.join(directory, "payload.pickle")
+    with open(path, "wb") as f:
+        f.write(payload)
+    report = diff_file(path, encoding=encoding)
 
-# pickletools
-print('pickletools:  ')
-try:
-    dis(payload)
-except Exception as e:
-    print('pickletools failed',e)
\ No newline at end of file
+print('pickle:       ', report['python'])
+print('_pickle.c:    ', report['c'])
+print('pickletools:  ', report['disasm'])
+print('result:       ', report['result'])
+if report['result'] != 'agree':
+    print('at address:   ', report['address'], report['opcode'])
+    print('reason:       ', report['reason'])
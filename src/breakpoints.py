@@ -0,0 +1,84 @@
+###############################################################################
+#
+# Breakpoints for pickledbg
+#
+# Breakpoints are resolved to instruction addresses when they are created, so
+# the execution loop only has to do a single dictionary lookup per
+# instruction to know whether anything needs to be checked.
+#
+###############################################################################
+
+
+### LOCAL IMPORTS ###
+from errors import *
+
+
+### CLASSES ###
+class Breakpoint:
+    """A breakpoint on one or more instruction addresses.
+
+    Attributes:
+        number (int): The breakpoint number shown to the user.
+        addresses (list[int]): The instruction addresses the breakpoint is set on.
+        opcode (str|None): The opcode name for `break opcode` breakpoints.
+        search (str|None): The search for `break search` breakpoints.
+        condition (str|None): The source of the condition, if any.
+        hits (int): How many times the breakpoint has stopped execution.
+        commands (list[str]): The debugger commands run when it stops execution.
+    """
+    def __init__(self, number: int, addresses: list[int], opcode: str = None, condition: str = None,
+                 search: str = None):
+        self.number = number
+        self.addresses = addresses
+        self.opcode = opcode
+        self.search = search
+        self.condition = condition
+        self.hits = 0
+        self.commands = []      # run when the breakpoint stops execution, see 'commands'
+
+        if condition is None:
+            self._code = None
+        else:
+            try:
+                self._code = compile(condition, "<breakpoint>", "eval")
+            except SyntaxError as e:
+                raise PickleDBGError(f"Invalid breakpoint condition: {e.msg}")
+
+    def should_stop(self, unpickler, addr: int) -> bool:
+        """Returns whether execution should stop at this breakpoint.
+
+        The condition is evaluated with `stack`, `metastack`, `memo`, `proto`
+        and `addr` in scope. A condition that raises an exception stops
+        execution so the problem can be inspected.
+        """
+        if self._code is not None:
+            namespace = {
+                "stack": unpickler.stack,
+                "metastack": unpickler.metastack,
+                "memo": unpickler.memo,
+                "proto": unpickler.proto,
+                "addr": addr,
+            }
+            try:
+                if not eval(self._code, namespace):
+                    return False
+            except Exception as e:
+                unpickler.stop_reason = f"Breakpoint {self.number} condition raised {type(e).__name__}: {e}"
+                self.hits += 1
+                return True
+
+        self.hits += 1
+        unpickler.stop_reason = f"Breakpoint {self.number} at {addr}"
+        return True
+
+    def describe(self) -> str:
+        """Returns a one-line description of the breakpoint."""
+        if self.opcode is not None:
+            where = f"opcode {self.opcode} ({len(self.addresses)} locations)"
+        elif self.search is not None:
+            where = f"search {self.search} ({len(self.addresses)} locations)"
+        else:
+            where = f"address {self.addresses[0]}"
+        if self.condition is not None:
+            where += f" if {self.condition}"
+        return f"{where}, hit {self.hits} time{'s' if self.hits != 1 else ''}"
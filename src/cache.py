@@ -0,0 +1,304 @@
+###############################################################################
+#
+# Persistent index cache for pickledbg
+#
+# Indexing a large pickle and cross-referencing its memo take seconds, and
+# the same pickles tend to be opened again and again. The arrays both are
+# made of are saved in a cache directory, keyed by a hash of the pickle's
+# contents, and loaded instead of being rebuilt the next time. A record of
+# each file's size, modification time and inode maps it to its hash, so a
+# file that hasn't changed is found without reading it. A file without a
+# record is indexed as usual and hashed afterwards on a background thread,
+# since hashing a pickle of large blobs takes longer than indexing it, so
+# nothing waits on the hash. The least recently used
+# entries are deleted to keep the directory under a size limit.
+#
+# Entries are a JSON header line followed by the raw arrays, so nothing
+# is unpickled to read them.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import os, sys, json, hashlib, tempfile, threading
+from array import array
+
+
+### CONSTANTS ###
+VERSION = 1
+MIN_INSTRUCTIONS = 100000   # pickles with fewer instructions are indexed faster than they are hashed
+HASH_CHUNK = 16 << 20       # bytes hashed at a time
+
+
+### CLASSES ###
+class IndexCache:
+    """The cache entries of one pickle.
+
+    Every method that reads the cache treats a missing, unreadable or
+    outdated entry as a miss, and every method that writes it ignores
+    errors, so the cache never stops a pickle from being debugged.
+
+    Args:
+        directory (str): The cache directory, created if needed.
+        max_bytes (int): The size the directory is kept under.
+        path (str): The file the pickle was read from, for the fast path
+            that recognizes an unchanged file without hashing it.
+        member (str): The zip member the pickle was read from, if any.
+    """
+    def __init__(self, directory: str, max_bytes: int, path: str = None, member: str = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.path = path
+        self.member = member
+        self.key = None         # the hash of the pickle, once known
+        self._record = None     # (record path, stat stamp) to write once the key is known
+        self._looked_up = False
+        self._lock = threading.Lock()   # the index and cross-references are saved on threads of their own
+        self._saving = None     # the thread saving cross-references, see `save_xref()`
+
+    def lookup(self) -> str | None:
+        """Returns the hash of the pickle if the file's record says it is unchanged, without reading the pickle."""
+        if self._looked_up or self.path is None:
+            return self.key
+        self._looked_up = True
+        try:
+            st = os.stat(self.path)
+            stamp = [st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev]
+            name = f"{os.path.realpath(self.path)}\0{self.member or ''}"
+            record = os.path.join(self.directory, "file-" + hashlib.sha1(name.encode("utf-8", "surrogateescape")).hexdigest())
+            self._record = (record, stamp)
+            with open(record) as f:
+                saved = json.load(f)
+            if saved.get("stamp") == stamp:
+                self.key = saved["key"]
+                self._record = None
+                os.utime(record)    # recently used, like the entries it leads to
+        except (OSError, ValueError, KeyError):
+            pass
+        return self.key
+
+    def identify(self, data) -> str:
+        """Returns the hash of the pickle, hashing it if the file's record doesn't have it."""
+        with self._lock:
+            if self.lookup() is None:
+                self.key = content_hash(data)
+            return self.key
+
+    def load_index(self, disasm) -> bool:
+        """Fills in the index of `disasm` from the cache. Returns whether it was there.
+
+        Only a file whose record is up to date is looked up, so nothing is
+        hashed. The arrays are extended in place, since the debugger keeps
+        a reference to `disasm.offsets`.
+        """
+        if self.lookup() is None:
+            return False
+        found = read_entry(self._entry("index"))
+        if found is None:
+            return False
+        meta, arrays = found
+        try:
+            offsets, opcodes, depths = arrays["offsets"], arrays["opcodes"], arrays["depths"]
+            skips = {int(offset): length for offset, length in meta["skips"].items()}
+            end, end_depth, error = meta["end"], meta["end_depth"], meta["error"]
+        except (KeyError, ValueError, AttributeError):
+            return False
+        if not len(offsets) == len(opcodes) == len(depths) or offsets.typecode != disasm.offsets.typecode:
+            return False
+        disasm.offsets.extend(offsets)
+        disasm.opcodes.extend(opcodes)
+        disasm.depths.extend(depths)
+        disasm.skips = skips
+        disasm.end, disasm.end_depth, disasm.error = end, end_depth, error
+        self._save_record()
+        return True
+
+    def save_index(self, disasm) -> None:
+        """Saves the index of `disasm`, as built from the start of the pickle.
+
+        The pickle is hashed if it has no record. If the same contents were
+        indexed under another name, only the record is written.
+        """
+        if len(disasm) < MIN_INSTRUCTIONS or disasm.regions:
+            return
+        self.identify(disasm.data)
+        entry = self._entry("index")
+        if os.path.exists(entry):
+            self._save_record()
+            return
+        meta = {
+            "skips": {str(offset): length for offset, length in disasm.skips.items()},
+            "end": disasm.end,
+            "end_depth": disasm.end_depth,
+            "error": disasm.error,
+        }
+        arrays = {"offsets": disasm.offsets, "opcodes": disasm.opcodes, "depths": disasm.depths}
+        self._save("index", meta, arrays)
+
+    def load_xref(self, disasm):
+        """Returns the cross-references of `disasm` from the cache, or None.
+
+        Like `load_index()`, this never hashes the pickle, so until its
+        record is written or the background save of the index has hashed
+        it, there is nothing to look up and it's a miss.
+        """
+        if len(disasm) < MIN_INSTRUCTIONS or disasm.regions or self.lookup() is None:
+            return None
+        found = read_entry(self._entry("xref"))
+        if found is None:
+            return None
+        meta, arrays = found
+        from xref import CrossReference
+        try:
+            if meta["instructions"] != len(disasm):
+                return None
+            return CrossReference.from_arrays(disasm, meta["memo_size"], arrays)
+        except (KeyError, ValueError):
+            return None
+
+    def save_xref(self, xref) -> None:
+        """Saves cross-references built over the whole index, on a background thread.
+
+        The pickle may still need hashing, and the arrays writing, neither
+        of which the prompt should wait for. `wait()` waits for the save.
+        """
+        disasm = xref.disasm
+        if len(disasm) < MIN_INSTRUCTIONS or disasm.regions:
+            return
+
+        def save():
+            self.identify(disasm.data)
+            meta = {"instructions": len(disasm), "memo_size": xref.memo_size}
+            self._save("xref", meta, xref.arrays())
+        self._saving = threading.Thread(target=save, name="pickledbg-cache", daemon=True)
+        self._saving.start()
+
+    def wait(self, timeout: float = None) -> None:
+        """Waits for cross-references being saved by `save_xref()`."""
+        if self._saving is not None:
+            self._saving.join(timeout)
+
+    def _entry(self, kind: str) -> str:
+        return os.path.join(self.directory, f"{self.key}.{kind}")
+
+    def _save(self, kind: str, meta: dict, arrays: dict) -> None:
+        size = sum(len(a) * a.itemsize if isinstance(a, array) else len(a) for a in arrays.values())
+        if size > self.max_bytes:
+            return
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            write_entry(self._entry(kind), meta, arrays)
+            self._save_record()
+            self.evict()
+        except OSError:
+            pass
+
+    def _save_record(self) -> None:
+        """Records the file's stat and hash, so the next open doesn't hash it."""
+        if self._record is None:
+            return
+        record, stamp = self._record
+        self._record = None
+        try:
+            _write_atomic(record, (json.dumps({"stamp": stamp, "key": self.key}) + "\n").encode())
+        except OSError:
+            pass
+
+    def evict(self) -> None:
+        """Deletes the least recently used files until the directory is under `max_bytes`."""
+        files = []
+        total = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                files.append((st.st_mtime_ns, st.st_size, entry.path))
+                total += st.st_size
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
+
+
+### FUNCTIONS ###
+def default_directory() -> str:
+    """Returns $PICKLEDBG_CACHE_DIR, or pickledbg/ in the user's cache directory."""
+    directory = os.environ.get("PICKLEDBG_CACHE_DIR")
+    if directory:
+        return directory
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "pickledbg")
+
+
+def content_hash(data) -> str:
+    """Returns a hash of the pickle's bytes, read a chunk at a time."""
+    h = hashlib.blake2b(digest_size=20)
+    for pos in range(0, len(data), HASH_CHUNK):
+        h.update(data[pos:pos + HASH_CHUNK])
+    return h.hexdigest()
+
+
+def write_entry(path: str, meta: dict, arrays: dict) -> None:
+    """Writes a JSON header describing `arrays` and `meta`, then the arrays' bytes."""
+    header = {
+        "version": VERSION,
+        "byteorder": sys.byteorder,
+        "meta": meta,
+        "arrays": [(name, a.typecode if isinstance(a, array) else "bytes", len(a)) for name, a in arrays.items()],
+    }
+    chunks = [(json.dumps(header) + "\n").encode()]
+    chunks += [memoryview(a).cast("B") for a in arrays.values()]
+    _write_atomic(path, chunks)
+
+
+def read_entry(path: str):
+    """Reads an entry written by `write_entry()`, marking it as recently used.
+
+    Returns:
+        tuple | None: (meta, name -> array or bytearray), or None if the
+            entry is missing or can't be used.
+    """
+    try:
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            if header.get("version") != VERSION or header.get("byteorder") != sys.byteorder:
+                return None
+            arrays = {}
+            for name, typecode, count in header["arrays"]:
+                if typecode == "bytes":
+                    values = bytearray(count)
+                    if f.readinto(values) != count:
+                        raise EOFError
+                else:
+                    values = array(typecode)
+                    values.fromfile(f, count)
+                arrays[name] = values
+        os.utime(path)
+    except (OSError, EOFError, ValueError, KeyError, TypeError):
+        return None
+    return header["meta"], arrays
+
+
+def _write_atomic(path: str, chunks) -> None:
+    """Writes `chunks` to a temporary file and renames it to `path`, so readers never see half an entry."""
+    if isinstance(chunks, bytes):
+        chunks = [chunks]
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(temp, path)
+    except BaseException:
+        try:
+            os.unlink(temp)
+        except OSError:
+            pass
+        raise
@@ -1,3 +1,9 @@
+### GLOBAL IMPORTS ###
+import sys
+from itertools import islice
+from pickle import PickleBuffer
+
+
 # Mapping of ANSI color codes to their respective escape sequences.
 colors = {
     "normal"         : "\033[0m",
@@ -79,28 +85,7 @@ def color_by_type(element, strip_comma=False) -> str:
     Returns:
         str: The colored string representation of the element.
     """
-    if strip_comma:
-        end = ''
-    else:
-        end = ', '
-
-    if type(element) == str or type(element) == bytes:
-        return pinkify(ascii(element))+end
-
-    elif type(element) == dict:
-        return colorize_dict(element)+end
-
-    elif type(element) == int or type(element) == float:
-        return cyanify(ascii(element))+end
-
-    elif type(element) == list or type(element) == tuple:
-        return colorize_array(element)+end
-
-    elif element == None:
-        return blueify(ascii(element))+end
-
-    else:
-        return yellowify(ascii(element))+end
+    return _unbounded.render_value(element) + ('' if strip_comma else ', ')
 
 
 def colorize_array(arr: list|tuple) -> str:
@@ -111,25 +96,7 @@ def colorize_array(arr: list|tuple) -> str:
     Returns:
         str: The colored string representation of the array or tuple.
     """
-    if type(arr) == list:
-        BEGIN = '['
-        END = ']'
-    elif type(arr) == tuple:
-        BEGIN = '('
-        END = ')'
-
-    retval = BEGIN
-
-    for element in arr:
-        retval += color_by_type(element)
-
-    # remove the last comma and space
-    if retval != BEGIN:
-        retval = retval[:-2]+END
-    else:
-        retval += END
-
-    return retval
+    return _unbounded.render_value(arr)
 
 
 def colorize_dict(arr: dict) -> str:
@@ -140,18 +107,314 @@ def colorize_dict(arr: dict) -> str:
     Returns:
         str: The colored string representation of the dictionary.
     """
-    retval = '{'
-
-    for key, value in arr.items():
-        retval += color_by_type(key, strip_comma=True)+': '
-        retval += color_by_type(value)
-
-    if retval != '{':
-        retval = retval[:-2]+'}'
-    else:
-        retval += '}'
-
-    return retval
+    return _unbounded.render_value(arr)
+
+
+class Renderer:
+    """Renders Pickle Machine values as colored previews within a budget.
+
+    Containers are traversed only until the preview is full: at most
+    `max_items` items per container, `max_depth` levels of nesting and
+    roughly `max_width` visible characters per value. A budget of 0 means
+    unlimited.
+
+    Within one preview each container is laid out at most once. Later
+    references to it print `<memo k>` if it is stored in the memo, otherwise
+    `<cycle>` for a container that contains itself and `<ref>` for any other
+    shared reference. This keeps self-referential structures from recursing
+    forever and shared subtrees from being expanded once per path. Memo
+    slots that a later PUT overwrites aren't tracked, see `_memo_key()`.
+
+    Values rendered with `render()` are cached by object identity. Each
+    cached preview keeps a reference to its value and to every container it
+    laid out, so their ids can't be reused while it is cached, along with
+    the version of each of those containers. The caller reports a mutation
+    of one container with `touch()`, which only invalidates the previews
+    that contain it, and bumps `generation` when any object may have been
+    changed, e.g. by code run from the pickle. The cache only keeps entries
+    that were used in the last frame, see `end_frame()`.
+    """
+    def __init__(self, max_items: int = 0, max_depth: int = 0, max_width: int = 0):
+        self.max_items = max_items
+        self.max_depth = max_depth
+        self.max_width = max_width
+        self.generation = 0
+        self.memo = None    # the memo, used to label back-references
+        self._cache = {}    # id(value) -> (value, generation, preview, memo size or None, ((container, version), ...), touches)
+        self._used = {}     # entries used since the last end_frame()
+        self._versions = {} # id(container) -> times touched, for the containers in cached previews
+        self._touches = 0   # touches of those containers, so unchanged previews skip checking theirs
+        self._walked = None # containers laid out in the preview `render()` is building
+        self._left = 0      # visible characters left in the current preview
+        self._seen = set()  # ids of containers laid out in the current preview
+        self._path = set()  # ids of containers currently being laid out
+        self._has_refs = False
+        self._memo_ids = {} # id(memo value) -> memo key
+        self._memo_ids_len = 0
+        self._memo_ids_of = None    # the memo the reverse index was built from
+
+    def configure(self, max_items: int = None, max_depth: int = None, max_width: int = None) -> None:
+        """Changes the budgets and drops every cached preview."""
+        if max_items is not None: self.max_items = max_items
+        if max_depth is not None: self.max_depth = max_depth
+        if max_width is not None: self.max_width = max_width
+        self._cache = {}
+        self._used = {}
+        self._versions = {}
+        self._touches = 0
+
+    def end_frame(self) -> None:
+        """Forgets cached previews of values that were not shown in this frame."""
+        self._cache = self._used
+        self._used = {}
+        versions = self._versions
+        if len(versions) > 4 * len(self._cache) + 1024:
+            # only the containers of cached previews need versions
+            self._versions = {id(c): versions[id(c)] for entry in self._cache.values() for c, _ in entry[4]}
+
+    def touch(self, container) -> None:
+        """Invalidates the cached previews that laid out `container`, after it was mutated."""
+        key = id(container)
+        if key in self._versions:
+            self._versions[key] += 1
+            self._touches += 1
+
+    def render(self, element) -> str:
+        """Returns the preview of a top-level value, reusing the cached one if possible."""
+        key = id(element)
+        entry = self._cache.get(key)
+        if entry is None or not self._valid(entry, element):
+            self._walked = []
+            preview = self.render_value(element)
+            # back-reference labels depend on what is in the memo
+            memo_len = len(self.memo or ()) if self._has_refs else None
+            versions = self._versions
+            walked = tuple((c, versions.setdefault(id(c), 0)) for c in self._walked)
+            self._walked = None
+            entry = (element, self.generation, preview, memo_len, walked, self._touches)
+        elif entry[5] != self._touches:
+            entry = entry[:5] + (self._touches,)
+        self._used[key] = entry
+        return entry[2]
+
+    def _valid(self, entry: tuple, element) -> bool:
+        """Returns whether a cached preview still shows `element` as it is."""
+        if entry[0] is not element or entry[1] != self.generation:
+            return False
+        if entry[3] is not None and entry[3] != len(self.memo or ()):
+            return False
+        if entry[5] != self._touches:
+            versions = self._versions
+            for container, version in entry[4]:
+                if versions.get(id(container)) != version:
+                    return False
+        return True
+
+    def render_value(self, element) -> str:
+        """Returns the preview of a value without consulting the cache."""
+        parts = []
+        self._left = self.max_width or sys.maxsize
+        self._seen.clear()
+        self._path.clear()
+        self._has_refs = False
+        self._walk(element, 0, parts)
+        return ''.join(parts)
+
+    def render_items(self, items: list, begin: str = '[', end: str = ']', hidden: int = 0) -> str:
+        """Returns the preview of a pane such as the stack.
+
+        Only the last `max_items` items are shown, since the top of the stack
+        is what matters when debugging. Each item is cached separately.
+        `hidden` counts items before `items` that the caller left out, so
+        they are included in the '…N more' marker without being passed in.
+        """
+        skipped = len(items) - self.max_items if self.max_items else 0
+        if skipped > 0:
+            items = items[skipped:]
+        skipped = max(skipped, 0) + hidden
+        if skipped > 0:
+            shown = [grayify(f'…{skipped} more')]
+        else:
+            shown = []
+        shown.extend(self.render(element) for element in items)
+        return begin + ', '.join(shown) + end
+
+    def render_mapping(self, mapping: dict) -> str:
+        """Returns the preview of a pane such as the memo.
+
+        Only the last `max_items` entries are shown, since the most recently
+        memoized values are usually the interesting ones. Each value is
+        cached separately.
+        """
+        skipped = len(mapping) - self.max_items if self.max_items else 0
+        if skipped > 0:
+            keys = list(islice(reversed(mapping), self.max_items))[::-1]
+            shown = [grayify(f'…{skipped} more')]
+        else:
+            keys = mapping
+            shown = []
+        for key in keys:
+            shown.append(self.render_value(key) + ': ' + self.render(mapping[key]))
+        return '{' + ', '.join(shown) + '}'
+
+    def _atom(self, text: str, color, parts: list) -> None:
+        """Appends an atom's text, cut off at the remaining width budget."""
+        if len(text) > self._left:
+            text = text[:max(self._left, 0)] + '…'
+        self._left -= len(text)
+        parts.append(color(text))
+
+    def _walk(self, element, depth: int, parts: list) -> None:
+        """Appends the colored preview of `element` to `parts`."""
+        t = type(element)
+
+        if t is str or t is bytes or t is bytearray:
+            # don't let ascii() escape a huge string only to throw most of it away
+            if len(element) > self._left:
+                element = element[:max(self._left, 0) + 1]
+            self._atom(ascii(element), pinkify, parts)
+
+        elif t is int or t is float:
+            if t is int and element.bit_length() > 10000:
+                self._atom(f'<int with {element.bit_length()} bits>', cyanify, parts)
+            else:
+                self._atom(ascii(element), cyanify, parts)
+
+        elif element is None:
+            self._atom('None', blueify, parts)
+
+        elif t is PickleBuffer or t is memoryview:
+            # out-of-band buffers can be huge, only describe them
+            self._atom(describe_buffer(element), pinkify, parts)
+
+        elif t is list or t is tuple or t is dict or t is set or t is frozenset:
+            self._walk_container(element, t, depth, parts)
+
+        elif isinstance(element, (list, tuple, dict, set, frozenset)):
+            # subclasses such as OrderedDict are shown as TypeName(<contents>)
+            for base in (list, tuple, dict, set, frozenset):
+                if isinstance(element, base):
+                    break
+            self._atom(t.__name__ + '(', yellowify, parts)
+            self._walk_container(element, base, depth, parts)
+            parts.append(yellowify(')'))
+
+        else:
+            try:
+                text = ascii(element)
+            except Exception as e:
+                text = f'<{t.__name__} object, repr failed: {type(e).__name__}>'
+            self._atom(text, yellowify, parts)
+
+    def _walk_container(self, element, t: type, depth: int, parts: list) -> None:
+        """Appends the preview of a list, tuple, dict, set or frozenset to `parts`."""
+        if self._walked is not None:
+            # even an empty or elided container's preview changes with it
+            self._walked.append(element)
+        if t is list:
+            begin, end = '[', ']'
+        elif t is tuple:
+            begin, end = '(', ')'
+        elif t is dict or t is set and element:
+            begin, end = '{', '}'
+        elif element:
+            begin, end = 'frozenset({', '})'
+        else:
+            self._atom(t.__name__ + '()', yellowify, parts)
+            return
+
+        key = id(element)
+        if key in self._seen:
+            self._has_refs = True
+            self._atom(self._ref_label(element, key in self._path), grayify, parts)
+            return
+
+        if self.max_depth and depth >= self.max_depth and len(element):
+            self._atom(begin + '…' + end, grayify, parts)
+            return
+
+        self._seen.add(key)
+        self._path.add(key)
+        parts.append(begin)
+        self._left -= len(begin) + len(end)
+        shown = 0
+        for item in (element.items() if t is dict else element):
+            if shown:
+                parts.append(', ')
+                self._left -= 2
+            if self._left <= 0 or (self.max_items and shown == self.max_items):
+                parts.append(grayify(f'…{len(element) - shown} more'))
+                break
+            if t is dict:
+                self._walk(item[0], depth + 1, parts)
+                parts.append(': ')
+                self._left -= 2
+                self._walk(item[1], depth + 1, parts)
+            else:
+                self._walk(item, depth + 1, parts)
+            shown += 1
+
+        if t is tuple and len(element) == 1:
+            parts.append(',')
+        parts.append(end)
+        self._path.discard(key)
+
+    def _ref_label(self, element, cycle: bool) -> str:
+        """Returns the label printed in place of a container that was already laid out."""
+        memo_key = self._memo_key(element)
+        if memo_key is not None:
+            return f'<memo {memo_key}>'
+        return '<cycle>' if cycle else '<ref>'
+
+    def _memo_key(self, element):
+        """Returns the memo key holding `element`, or None if it isn't memoized.
+
+        The reverse index is only built once a back-reference is found and
+        is then extended with the entries added to the memo since. Slots
+        overwritten by a later PUT with a key already in the memo don't
+        change its size, so they aren't picked up: the object now in such a
+        slot, and one that was only stored in it before, are labeled `<ref>`
+        (or `<cycle>`). A key is only returned after checking that the slot
+        still holds `element`, so a label never names the wrong slot.
+        """
+        memo = self.memo
+        if not memo:
+            return None
+
+        grown = len(memo) - self._memo_ids_len
+        if grown < 0 or memo is not self._memo_ids_of:
+            # stepping back replaces the memo with copies
+            self._memo_ids = {}
+            self._memo_ids_of = memo
+            grown = len(memo)
+        if grown:
+            for memo_key in islice(reversed(memo), grown):
+                self._memo_ids.setdefault(id(memo[memo_key]), memo_key)
+            self._memo_ids_len = len(memo)
+
+        memo_key = self._memo_ids.get(id(element))
+        if memo_key is not None and memo.get(memo_key) is element:
+            return memo_key
+        return None
+
+
+# used by the module-level helpers above, which render everything
+_unbounded = Renderer()
+
+
+def describe_buffer(buf) -> str:
+    """Returns a summary of a PickleBuffer or memoryview: its size, and its format and shape if not plain bytes."""
+    name = type(buf).__name__
+    try:
+        with memoryview(buf) as m:
+            text = f'<{name} {m.nbytes} bytes'
+            if m.format != 'B' or m.ndim != 1:
+                text += f", format '{m.format}', shape {m.shape}"
+            if m.readonly:
+                text += ', read-only'
+    except ValueError:
+        return f'<{name}, released>'
+    return text + '>'
 
 
 def header(hdr_name: str, terminal_width: int) -> str:
@@ -0,0 +1,448 @@
+###############################################################################
+#
+# Container adapters for pickledbg
+#
+# Most pickles worth debugging arrive wrapped: as the data.pkl member of a
+# PyTorch zip archive, compressed by joblib with numpy arrays written into
+# the middle of the stream, or on stdin from a pipeline. `open_source()`
+# finds the pickle inside whatever it is given without making a temporary
+# copy: uncompressed zip members are used in place from the mapping of the
+# archive, and only compressed input is decompressed, in memory. Everything
+# the pickle refers to outside itself (tensor storages, joblib arrays,
+# persistent ids) is replaced by a stub that is never loaded.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import os, re, sys, mmap, stat, struct
+from importlib.util import find_spec
+
+
+### LOCAL IMPORTS ###
+from errors import PickleDBGError
+from source import PickleSource, MappedRange, SourceReader
+
+
+### CONSTANTS ###
+ZIP_MAGIC = b"PK\x03\x04"
+LOCAL_HEADER = struct.Struct("<4s22xHH")   # signature, ..., file name length, extra field length
+
+BUILD = ord('b')
+
+# the global joblib pickles in place of every numpy array, followed by the
+# array's data in the stream
+ARRAY_WRAPPER = "numpy_pickle.NumpyArrayWrapper"
+FIND_CHUNK = 1 << 20    # bytes searched at a time for the wrapper's name
+
+# dtype kind -> numpy type name prefix, for describing arrays
+DTYPE_KINDS = {'f': 'float', 'i': 'int', 'u': 'uint', 'c': 'complex'}
+
+# torch storage class -> tensor dtype
+TORCH_STORAGES = {
+    'FloatStorage': 'float32', 'DoubleStorage': 'float64', 'HalfStorage': 'float16',
+    'BFloat16Storage': 'bfloat16', 'LongStorage': 'int64', 'IntStorage': 'int32',
+    'ShortStorage': 'int16', 'CharStorage': 'int8', 'ByteStorage': 'uint8',
+    'BoolStorage': 'bool', 'ComplexFloatStorage': 'complex64',
+    'ComplexDoubleStorage': 'complex128', 'QInt8Storage': 'qint8', 'QUInt8Storage': 'quint8',
+    'QInt32Storage': 'qint32', 'UntypedStorage': 'uint8',
+}
+
+
+### CLASSES ###
+class LazyArray:
+    """A numpy array joblib wrote into the pickle stream, never loaded.
+
+    Attributes:
+        dtype (str): The numpy type name, e.g. 'float64', or 'object'.
+        shape (tuple): The array's shape.
+        offset (int): Where the array's data starts in the pickle.
+        length (int): How many bytes of the stream the data takes up.
+    """
+    __slots__ = ('dtype', 'shape', 'offset', 'length')
+
+    def __init__(self, dtype: str, shape: tuple, offset: int, length: int):
+        self.dtype = dtype
+        self.shape = shape
+        self.offset = offset
+        self.length = length
+
+    def __repr__(self) -> str:
+        return f"<array {self.dtype} {self.shape}, {self.length} bytes at {self.offset}, not loaded>"
+
+
+class ArrayWrapper:
+    """Stands in for joblib's NumpyArrayWrapper, which is replaced by a `LazyArray` once built."""
+
+
+class DType:
+    """Stands in for `numpy.dtype` when numpy is not installed."""
+    def __init__(self, code: str, align: bool = False, copy: bool = False):
+        self.code = code
+
+    def __setstate__(self, state):
+        pass
+
+    def __repr__(self) -> str:
+        return f"dtype({self.code!r})"
+
+
+class StorageType:
+    """Stands in for a torch storage class such as `torch.FloatStorage`."""
+    __slots__ = ('name', 'dtype')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.dtype = TORCH_STORAGES.get(name, name)
+
+    def __repr__(self) -> str:
+        return f"torch.{self.name}"
+
+
+class LazyStorage:
+    """A torch tensor storage, referenced by persistent id and never loaded.
+
+    Attributes:
+        dtype (str): The element type, e.g. 'float32'.
+        key (str): The storage's name in the archive's data/ directory.
+        location (str): The device it was saved from, e.g. 'cpu'.
+        numel (int): The number of elements.
+    """
+    __slots__ = ('dtype', 'key', 'location', 'numel')
+
+    def __init__(self, dtype: str, key: str, location: str, numel: int):
+        self.dtype = dtype
+        self.key = key
+        self.location = location
+        self.numel = numel
+
+    def __repr__(self) -> str:
+        return f"<storage {self.key}: {self.numel} x {self.dtype} on {self.location}, not loaded>"
+
+
+class LazyTensor:
+    """A tensor (or parameter) over a `LazyStorage`, as `torch._utils._rebuild_tensor_v2` would build it."""
+    __slots__ = ('storage', 'storage_offset', 'size', 'stride', 'requires_grad', 'parameter')
+
+    def __init__(self, storage, storage_offset: int, size: tuple, stride: tuple, requires_grad: bool = False):
+        self.storage = storage
+        self.storage_offset = storage_offset
+        self.size = tuple(size)
+        self.stride = tuple(stride)
+        self.requires_grad = requires_grad
+        self.parameter = False
+
+    def __repr__(self) -> str:
+        kind = "parameter" if self.parameter else "tensor"
+        dtype = getattr(self.storage, "dtype", "?")
+        key = getattr(self.storage, "key", "?")
+        return f"<{kind} {dtype} {self.size} in storage {key}, not loaded>"
+
+
+class PersistentRef:
+    """Stands in for the object a persistent id refers to, which only the original unpickler could load."""
+    __slots__ = ('pid',)
+
+    def __init__(self, pid):
+        self.pid = pid
+
+    def __repr__(self) -> str:
+        return f"<persistent {self.pid!r}>"
+
+
+### FUNCTIONS ###
+def _rebuild_tensor(storage, storage_offset, size, stride, *args, **kwargs) -> LazyTensor:
+    # _rebuild_tensor_v2(storage, storage_offset, size, stride, requires_grad, backward_hooks, metadata=None)
+    requires_grad = bool(args[0]) if args else False
+    return LazyTensor(storage, storage_offset, size, stride, requires_grad)
+
+
+def _rebuild_parameter(data, requires_grad=False, *args, **kwargs):
+    if isinstance(data, LazyTensor):
+        data.parameter = True
+        data.requires_grad = bool(requires_grad)
+    return data
+
+
+def _rebuild_from_type(func, new_type, args, state):
+    # tensor subclasses are rebuilt as plain tensors
+    return func(*args)
+
+
+def torch_stubs() -> dict:
+    """Returns the globals replaced by stubs in PyTorch checkpoints, so no tensor is ever loaded."""
+    stubs = {f"torch.{name}": StorageType(name) for name in TORCH_STORAGES}
+    stubs["torch.storage.UntypedStorage"] = stubs["torch.UntypedStorage"]
+    stubs["torch.storage.TypedStorage"] = StorageType("TypedStorage")
+    for name in ("_rebuild_tensor", "_rebuild_tensor_v2", "_rebuild_tensor_v3"):
+        stubs[f"torch._utils.{name}"] = _rebuild_tensor
+    stubs["torch._utils._rebuild_parameter"] = _rebuild_parameter
+    stubs["torch._utils._rebuild_parameter_with_state"] = _rebuild_parameter
+    stubs["torch._tensor._rebuild_from_type_v2"] = _rebuild_from_type
+    return stubs
+
+
+def joblib_stubs() -> dict:
+    """Returns the globals replaced by stubs in joblib dumps, so neither joblib nor numpy is needed."""
+    stubs = {f"{module}.{ARRAY_WRAPPER}": ArrayWrapper for module in ("joblib", "sklearn.externals.joblib")}
+    if find_spec("numpy") is None:
+        stubs["numpy.dtype"] = DType
+    return stubs
+
+
+def persistent_stub(pid):
+    """Returns the stub for a persistent id: a `LazyStorage` for torch storages, otherwise a `PersistentRef`."""
+    if type(pid) is tuple and len(pid) == 5 and pid[0] == "storage":
+        _, storage_type, key, location, numel = pid
+        dtype = getattr(storage_type, "dtype", None) or getattr(storage_type, "__name__", str(storage_type))
+        return LazyStorage(str(dtype), key, location, numel)
+    return PersistentRef(pid)
+
+
+def open_source(path: str, member: str = None, arrays: bool = True) -> PickleSource:
+    """Opens the pickle at `path`, or inside it.
+
+    `path` may be a pickle, a zip archive such as a PyTorch checkpoint (the
+    pickle is `member`, by default the `data.pkl` member), a joblib dump,
+    a pickle compressed with gzip, bz2, xz/lzma, zlib or lz4, or '-' for
+    stdin. Finding joblib's arrays means reading the whole pickle, so with
+    `arrays` False it is left to a later `find_arrays()`.
+
+    Raises:
+        OSError: If the file can't be read.
+        PickleDBGError: If the container is not understood or has no pickle.
+    """
+    if path == "-":
+        source = PickleSource(read_stdin(), "<stdin>")
+    else:
+        source = PickleSource.open(path)
+    data = source.data
+
+    if data[:4] == ZIP_MAGIC:
+        source = open_zip(source, member)
+    elif member is not None:
+        raise PickleDBGError(f"'{path}' is not a zip archive, so it has no member '{member}'")
+    else:
+        kind, decompress = detect_compression(data)
+        if decompress is not None:
+            compressed = source
+            source = PickleSource(decompress(data), source.name, kind)
+            compressed.close()
+
+    if arrays:
+        find_arrays(source)
+    return source
+
+
+def find_arrays(source: PickleSource) -> None:
+    """Stubs out the numpy arrays in `source` if it is a joblib dump.
+
+    The source's payloads and stubs are updated in place, so an unpickler
+    already created over it sees them.
+    """
+    if not contains(source.data, ARRAY_WRAPPER.rpartition(".")[2].encode()):
+        return
+    payloads = find_payloads(source)
+    if payloads:
+        source.payloads.update(payloads)
+        source.kind = "joblib" if source.kind == "pickle" else f"joblib ({source.kind})"
+        source.stubs.update(joblib_stubs())
+
+
+def read_stdin():
+    """Returns the pickle piped or redirected to stdin, mapped if stdin is a file."""
+    fd = sys.stdin.fileno()
+    if stat.S_ISREG(os.fstat(fd).st_mode) and os.fstat(fd).st_size:
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    return sys.stdin.buffer.read()
+
+
+def reattach_terminal() -> bool:
+    """Points stdin at the controlling terminal after a pickle was read from it.
+
+    Returns False if there is no terminal, in which case the prompt only
+    sees the end of its input.
+    """
+    try:
+        fd = os.open("/dev/tty", os.O_RDONLY)
+    except OSError:
+        return False
+    os.dup2(fd, 0)
+    os.close(fd)
+    sys.stdin = open(0, "r", closefd=False)
+    return True
+
+
+def open_zip(source: PickleSource, member: str = None) -> PickleSource:
+    """Returns the pickle member of a zip archive, in place if it is stored uncompressed."""
+    import zipfile
+
+    data = source.data
+    reader = SourceReader(data, source.name)
+    try:
+        archive = zipfile.ZipFile(reader)
+    except zipfile.BadZipFile as e:
+        reader.close()
+        raise PickleDBGError(f"'{source.name}' is not a valid zip archive: {e}")
+    with archive, reader:
+        names = archive.namelist()
+        if member is None:
+            # PyTorch saves the pickle as <archive name>/data.pkl
+            pickles = [name for name in names if name.endswith(".pkl")]
+            main = [name for name in pickles if name == "data.pkl" or name.endswith("/data.pkl")]
+            if len(main) == 1:
+                member = main[0]
+            elif len(pickles) == 1:
+                member = pickles[0]
+            elif pickles:
+                raise PickleDBGError(f"'{source.name}' has several pickles ({', '.join(pickles)}), choose one with --member")
+            else:
+                raise PickleDBGError(f"'{source.name}' has no .pkl member, choose one with --member")
+        try:
+            info = archive.getinfo(member)
+        except KeyError:
+            raise PickleDBGError(f"'{source.name}' has no member '{member}'")
+
+        torch = any(name.endswith(("/version", "/byteorder")) or "/data/" in name for name in names)
+        kind = "torch zip" if torch else "zip"
+        stubs = torch_stubs() if torch else None
+
+        if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+            # the member's bytes follow its local header
+            signature, name_len, extra_len = LOCAL_HEADER.unpack(data[info.header_offset:info.header_offset + LOCAL_HEADER.size])
+            if signature != ZIP_MAGIC:
+                raise PickleDBGError(f"'{source.name}' has a corrupt local header for '{member}'")
+            start = info.header_offset + LOCAL_HEADER.size + name_len + extra_len
+            pickle = MappedRange(data, start, info.file_size)
+        else:
+            pickle = archive.read(member)
+    if not isinstance(pickle, MappedRange):
+        source.close()
+    return PickleSource(pickle, f"{source.name}:{member}", kind, stubs=stubs)
+
+
+def detect_compression(data) -> tuple:
+    """Returns (name, decompress function) for compressed data, or ('pickle', None)."""
+    head = data[:6]
+    if head[:2] == b"\x1f\x8b":
+        import gzip
+        return "gzip", gzip.decompress
+    if head[:3] == b"BZh":
+        import bz2
+        return "bz2", bz2.decompress
+    if head == b"\xfd7zXZ\x00" or head[:3] == b"\x5d\x00\x00":
+        import lzma
+        return "xz" if head[:1] == b"\xfd" else "lzma", lzma.decompress
+    if head[:4] == b"\x04\x22\x4d\x18":
+        try:
+            import lz4.frame
+        except ImportError:
+            raise PickleDBGError("The pickle is lz4-compressed, which needs the 'lz4' package")
+        return "lz4", lz4.frame.decompress
+    if head[:1] == b"\x78" and int.from_bytes(head[:2], "big") % 31 == 0:
+        # a zlib header; 'x' is not a pickle opcode
+        import zlib
+        return "zlib", zlib.decompress
+    return "pickle", None
+
+
+def contains(data, needle: bytes) -> bool:
+    """Returns whether `data` contains `needle`.
+
+    The search holds the GIL, so a large pickle is searched a chunk at a
+    time to let other threads, like the prompt, run in between.
+    """
+    size = len(data)
+    for start in range(0, size, FIND_CHUNK):
+        if data.find(needle, start, min(start + FIND_CHUNK + len(needle) - 1, size)) >= 0:
+            return True
+    return False
+
+
+def find_payloads(source: PickleSource) -> dict:
+    """Finds the numpy arrays joblib wrote into the pickle stream.
+
+    joblib pickles a NumpyArrayWrapper in place of each array and writes
+    the array's data right after the wrapper's BUILD. The pickle is run
+    symbolically, so nothing is imported or called, and each wrapper's
+    state gives the size of the data to skip.
+
+    Returns:
+        dict: Offset of each array's data -> `LazyArray`. A pickle that
+            fails part way has the arrays found before the failure.
+    """
+    from symbolic import SymbolicUnpickler, Symbol, Call
+
+    payloads = {}
+    reader = source.reader()
+    scanner = SymbolicUnpickler(reader, payloads=payloads)
+    symbolic_build = SymbolicUnpickler.dispatch[BUILD]
+
+    def load_build(unpickler):
+        symbolic_build(unpickler)
+        wrapper = unpickler.stack[-1]
+        if not isinstance(wrapper, Call) or not wrapper.state:
+            return
+        func = wrapper.func
+        if isinstance(func, Symbol) and func.name == "copyreg._reconstructor" and wrapper.args:
+            # protocols 0 and 1 rebuild objects with copyreg
+            func = wrapper.args[0]
+        if isinstance(func, Symbol) and func.name.endswith(ARRAY_WRAPPER):
+            pos = unpickler.tell()
+            payloads[pos] = array_payload(wrapper.state[-1], pos, source)
+            unpickler.skip_payload()
+
+    scanner.dispatch = dict(SymbolicUnpickler.dispatch)
+    scanner.dispatch[BUILD] = load_build
+    try:
+        scanner.summarize()
+    except Exception:
+        # a malformed pickle is reported when it is debugged
+        pass
+    finally:
+        reader.close()
+    return payloads
+
+
+def array_payload(state, pos: int, source: PickleSource) -> LazyArray:
+    """Returns the stub for the array data at `pos`, described by a NumpyArrayWrapper's state."""
+    import pickletools
+    from symbolic import Call
+
+    if not isinstance(state, dict):
+        raise PickleDBGError(f"at position {pos}, unexpected NumpyArrayWrapper state")
+    shape = state.get("shape")
+    dtype = state.get("dtype")
+    if not isinstance(shape, tuple) or not isinstance(dtype, Call) or not dtype.args \
+            or not isinstance(dtype.args[0], str):
+        raise PickleDBGError(f"at position {pos}, unexpected NumpyArrayWrapper state")
+
+    code = dtype.args[0]
+    if code.startswith("O"):
+        # object arrays are pickled into the stream, protocol 2, without padding
+        with source.reader() as reader:
+            reader.seek(pos)
+            for op, _, _ in pickletools.genops(reader):
+                if op.name == "STOP":
+                    break
+            return LazyArray("object", shape, pos, reader.tell() - pos)
+
+    # numpy pickles the size of flexible types (strings, structs) in the
+    # dtype's state and encodes the rest in the type code, e.g. 'f8'
+    dtype_state = dtype.state[-1] if dtype.state else ()
+    elsize = dtype_state[5] if isinstance(dtype_state, tuple) and len(dtype_state) > 5 else -1
+    if not isinstance(elsize, int) or elsize <= 0:
+        digits = re.search(r"\d+$", code)
+        elsize = int(digits.group()) if digits else 1
+    count = 1
+    for n in shape:
+        count *= n
+
+    kind = code.lstrip("<>=|")[:1]
+    name = "bool" if kind == "b" else f"{DTYPE_KINDS[kind]}{elsize * 8}" if kind in DTYPE_KINDS else code
+
+    length = count * elsize
+    if state.get("numpy_array_alignment_bytes") is not None:
+        # one byte giving the padding length, then the padding
+        length += 1 + source.data[pos]
+    return LazyArray(name, shape, pos, length)
@@ -0,0 +1,414 @@
+###############################################################################
+#
+# Differential runner for pickledbg
+#
+# `pickledbg diff <file-or-corpus>` unpickles each file with the pure-Python
+# `pickle._Unpickler` and the C `_pickle.Unpickler`, each in its own
+# subprocess with a timeout and a memory cap, and indexes it with the
+# disassembler. Where they disagree, it reports the first instruction at
+# which they diverge: the instruction one of them failed on, or, when both
+# finish with different results, the instruction after which the top of
+# the stack or the memo first differs. The C unpickler can't be stepped, so
+# the latter is found by running both on prefixes of the pickle that end
+# with an added STOP, narrowing the range a few prefixes at a time.
+#
+# Both unpicklers run the pickle's code. Only diff pickles you would be
+# willing to load.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import io, os, re, sys, csv, json, struct, signal, hashlib, argparse, subprocess
+from time import perf_counter
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import resource
+except ImportError:     # not available on Windows
+    resource = None
+
+
+### LOCAL IMPORTS ###
+from containers import open_source
+from disasm import Disassembly
+from tracer import OPCODE_NAMES
+
+
+### CONSTANTS ###
+ENGINES = ("python", "c")
+FRAME = 0x95
+STOP = b'.'
+PROBES_PER_ROUND = 15   # prefixes each unpickler runs per narrowing round
+PREVIEW = 200           # characters of each result kept in the report
+ADDRESS_RE = re.compile(r" at 0x[0-9a-fA-F]+")
+LENGTH = struct.Struct("<Q")     # precedes each pickle sent to an unpickler subprocess
+FAILED = {"ok": False, "value": None, "memo": None, "value_digest": None, "memo_digest": None, "error": None}
+
+CSV_FIELDS = ("path", "size", "instructions", "result", "address", "opcode", "reason",
+              "python", "c", "disasm", "seconds")
+
+
+### FUNCTIONS ###
+def describe(value, text=repr) -> str:
+    """Returns the repr (or another `text`) of `value`, with object addresses masked so separate processes agree."""
+    try:
+        text = text(value)
+    except BaseException as e:
+        text = f"<{text.__name__} failed: {type(e).__name__}>"
+    return ADDRESS_RE.sub(" at 0x…", text)
+
+
+def digest(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8", "backslashreplace")).hexdigest()
+
+
+def outcome(engine: str, file, encoding: str) -> dict:
+    """Unpickles `file` with `engine` and describes how it ended.
+
+    Returns:
+        dict: `ok`, whether it returned; `value` and `memo`, previews of
+            the result and the memo; `value_digest` and `memo_digest`,
+            hashes of them in full; `error`, the exception; and `pos`, how
+            far into the pickle it read.
+    """
+    if engine == "python":
+        from pickle import _Unpickler as Unpickler
+    else:
+        from _pickle import Unpickler
+    unpickler = Unpickler(file, encoding=encoding)
+    result = dict(FAILED, pos=None)
+    try:
+        value = unpickler.load()
+        result["ok"] = True
+    except BaseException as e:
+        value = None
+        message = describe(e, str)
+        result["error"] = f"{type(e).__name__}: {message}" if message else type(e).__name__
+    result["pos"] = file.tell()
+    try:
+        memo = unpickler.memo if engine == "python" else unpickler.memo.copy()
+        memo = describe(sorted(memo.items(), key=lambda item: item[0]))
+    except BaseException as e:
+        memo = f"<memo unavailable: {type(e).__name__}>"
+    value = describe(value) if result["ok"] else ""
+    result["value_digest"], result["memo_digest"] = digest(value), digest(memo)
+    result["value"] = value[:PREVIEW]
+    result["memo"] = memo[:PREVIEW]
+    return result
+
+
+def run_engine(engine: str, path: str, encoding: str) -> None:
+    """The body of an unpickler subprocess: writes a JSON outcome per pickle to stdout.
+
+    With `path` '-', the pickles to run are read from stdin, each preceded
+    by its length; otherwise the file at `path` is run.
+    """
+    out = sys.stdout
+    if path != "-":
+        source = open_source(path, arrays=False)
+        out.write(json.dumps(outcome(engine, source.reader(), encoding)) + "\n")
+        return
+    stdin = sys.stdin.buffer
+    while True:
+        header = stdin.read(LENGTH.size)
+        if len(header) < LENGTH.size:
+            return
+        (size,) = LENGTH.unpack(header)
+        out.write(json.dumps(outcome(engine, io.BytesIO(stdin.read(size)), encoding)) + "\n")
+        out.flush()
+
+
+def _limit_memory(memory_mb: int):
+    """Returns a function capping the address space of an unpickler subprocess."""
+    def limit():
+        if resource is not None and memory_mb:
+            cap = memory_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (cap, cap))
+    return limit
+
+
+def start_engines(path: str, probes: list, encoding: str, memory_mb: int) -> dict:
+    """Starts both unpicklers in subprocesses, on the file or on `probes` if given."""
+    env = dict(os.environ, PYTHONHASHSEED="0")     # so that sets print in the same order
+    processes = {}
+    for engine in ENGINES:
+        processes[engine] = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--engine", engine, "--encoding", encoding,
+             "-" if probes is not None else path],
+            stdin=subprocess.PIPE if probes is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env,
+            preexec_fn=_limit_memory(memory_mb) if resource is not None else None)
+    return processes
+
+
+def finish_engine(process, stdin: bytes, count: int, timeout: float) -> list[dict]:
+    """Collects `count` outcomes from an unpickler subprocess, filling in for what it didn't report."""
+    try:
+        stdout, _ = process.communicate(stdin, timeout=timeout or None)
+        failure = None
+        if process.returncode < 0:
+            failure = f"crashed with signal {-process.returncode}"
+        elif process.returncode:
+            failure = f"exited with status {process.returncode}"
+    except subprocess.TimeoutExpired:
+        process.kill()
+        stdout, _ = process.communicate()
+        failure = "timed out"
+    outcomes = [json.loads(line) for line in stdout.decode().splitlines() if line.startswith("{")]
+    # a crash or timeout is the outcome of the pickle it was running
+    while len(outcomes) < count:
+        outcomes.append(dict(FAILED, error=failure or "no result", pos=None, failed=failure is not None))
+    return outcomes
+
+
+def run_both(path: str, probes: list, encoding: str, timeout: float, memory_mb: int) -> dict:
+    """Runs both unpicklers side by side. Returns engine -> list of outcomes, one per probe."""
+    stdin = b"".join(LENGTH.pack(len(probe)) + probe for probe in probes) if probes is not None else None
+    count = len(probes) if probes is not None else 1
+    processes = start_engines(path, probes, encoding, memory_mb)
+    return {engine: finish_engine(process, stdin, count, timeout) for engine, process in processes.items()}
+
+
+def same(a: dict, b: dict) -> bool:
+    """Whether two outcomes agree: both failed, or both returned the same result and memo."""
+    if not a["ok"] or not b["ok"]:
+        return a["ok"] == b["ok"]
+    return a["value_digest"] == b["value_digest"] and a["memo_digest"] == b["memo_digest"]
+
+
+def prefix(data, disasm: Disassembly, count: int) -> bytes:
+    """Returns the first `count` instructions followed by STOP, without FRAMEs.
+
+    A prefix that ends inside a frame is a truncated frame, which both
+    unpicklers reject, so frames are dropped. They only group the bytes.
+    """
+    end = disasm.offsets[count] if count < len(disasm) else disasm.end
+    frames = [i for i in disasm.opcode_lines(FRAME) if i < count]
+    if not frames:
+        return bytes(data[:end]) + STOP
+    parts = []
+    pos = 0
+    for i in frames:
+        parts.append(data[pos:disasm.offsets[i]])
+        pos = disasm.offsets[i + 1] if i + 1 < len(disasm) else disasm.end
+    parts.append(data[pos:end])
+    return b"".join(map(bytes, parts)) + STOP
+
+
+def narrow(path: str, data, disasm: Disassembly, encoding: str, timeout: float, memory_mb: int):
+    """Finds the first instruction after which the unpicklers' stack tops or memos differ.
+
+    Prefixes of `lo` instructions agree and of `hi` instructions don't;
+    every round runs both unpicklers on prefixes in between, until they
+    are one instruction apart.
+
+    Returns:
+        tuple: (index of the instruction, outcomes of the first differing prefix), or
+            (None, None) if every prefix agrees.
+    """
+    lo, hi = 0, len(disasm) - 1       # the last instruction is the STOP each prefix ends with
+    found = None
+    while hi - lo > 1 or found is None:
+        if hi <= lo:
+            return None, None
+        step = max((hi - lo) // (PROBES_PER_ROUND + 1), 1)
+        counts = list(range(lo + step, hi, step))[:PROBES_PER_ROUND] + [hi]
+        outcomes = run_both(path, [prefix(data, disasm, count) for count in counts],
+                            encoding, timeout, memory_mb)
+        previous = lo
+        for j, count in enumerate(counts):
+            results = {engine: outcomes[engine][j] for engine in ENGINES}
+            if not same(*results.values()):
+                lo, hi, found = previous, count, results
+                break
+            previous = count
+        else:
+            # the unpicklers aren't deterministic, keep what was found so far
+            break
+    return (hi - 1, found) if found is not None else (None, None)
+
+
+def instruction_at(disasm: Disassembly, pos: int):
+    """Returns the index of the instruction an unpickler was reading when it stopped at `pos`."""
+    if pos is None or not len(disasm) or pos > disasm.end:
+        return None
+    return max(bisect_right(disasm.offsets, pos - 1) - 1, 0)
+
+
+def difference(py: dict, c: dict) -> str:
+    """Describes how two outcomes of the same prefix differ."""
+    if not py["ok"] or not c["ok"]:
+        return f"python {summary(py)} and c {summary(c)}"
+    if py["value_digest"] != c["value_digest"]:
+        return f"the top of the stack is {py['value']} in python and {c['value']} in c"
+    return f"the memo is {py['memo']} in python and {c['memo']} in c"
+
+
+def summary(result: dict) -> str:
+    """One line describing an outcome, for the report."""
+    if result["ok"]:
+        return f"returned {result['value']}"
+    return f"raised {result['error']}" if not result.get("failed") else result["error"]
+
+
+def diff_file(path: str, encoding: str = "ASCII", timeout: float = 10, memory_mb: int = 1024) -> dict:
+    """Runs one file through both unpicklers and the disassembler and reports where they diverge.
+
+    Returns:
+        dict: The report. `result` is "agree", "diverge" or "error" (the
+            file couldn't be read), and for a divergence, `address` and
+            `opcode` are the first instruction that behaved differently
+            and `reason` says how.
+    """
+    report = {"path": path, "size": None, "instructions": 0, "result": None, "address": None,
+              "opcode": None, "reason": None, "python": None, "c": None, "disasm": None, "seconds": 0.0}
+    start = perf_counter()
+    source = None
+    try:
+        source = open_source(path, arrays=False)
+        data = source.data
+        report["size"] = len(source)
+        disasm = Disassembly(data)
+        report["instructions"] = len(disasm)
+        report["disasm"] = "ok" if disasm.error is None else disasm.error
+
+        outcomes = run_both(path, None, encoding, timeout, memory_mb)
+        py, c = outcomes["python"][0], outcomes["c"][0]
+        report["python"], report["c"] = summary(py), summary(c)
+
+        index, reason = None, None
+        if py["ok"] != c["ok"]:
+            failed, other = ("python", "c") if not py["ok"] else ("c", "python")
+            index = instruction_at(disasm, outcomes[failed][0]["pos"])
+            if disasm.opcode_lines(FRAME):
+                # unpicklers read a frame at once, so the offset only places the failure in its frame
+                narrowed, _ = narrow(path, data, disasm, encoding, timeout, memory_mb)
+                index = narrowed if narrowed is not None else index
+            reason = f"{failed} {summary(outcomes[failed][0])}, {other} did not"
+        elif not py["ok"]:
+            where = {engine: instruction_at(disasm, outcomes[engine][0]["pos"]) for engine in ENGINES}
+            if where["python"] != where["c"]:
+                known = [i for i in where.values() if i is not None]
+                index = min(known) if known else None
+                reason = f"both raised, python at instruction {where['python']} and c at {where['c']}"
+        elif not same(py, c):
+            index, found = narrow(path, data, disasm, encoding, timeout, memory_mb)
+            if found is None:
+                reason = "the results differ, but every prefix agrees"
+            else:
+                reason = "after this instruction, " + difference(found["python"], found["c"])
+        elif disasm.error is not None:
+            index = len(disasm) if disasm.end < len(data) else None
+            reason = f"both unpicklers returned, the disassembler stopped: {disasm.error}"
+
+        report["result"] = "agree" if reason is None else "diverge"
+        report["reason"] = reason
+        if index is not None:
+            if index < len(disasm):
+                report["address"] = disasm.offsets[index]
+                report["opcode"] = OPCODE_NAMES.get(disasm.opcodes[index], "UNKNOWN")
+            else:
+                report["address"] = disasm.end
+                report["opcode"] = OPCODE_NAMES.get(data[disasm.end], "UNKNOWN") if disasm.end < len(data) else None
+    except Exception as e:
+        report["result"] = "error"
+        report["reason"] = f"{type(e).__name__}: {e}"
+    finally:
+        if source is not None:
+            source.close()
+    report["seconds"] = round(perf_counter() - start, 6)
+    return report
+
+
+def _init_worker() -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def diff(paths: list[str], jobs: int = None, encoding: str = "ASCII", timeout: float = 10,
+         memory_mb: int = 1024):
+    """Diffs files in parallel worker processes, yielding a report per file as each finishes."""
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker) as pool:
+        futures = {pool.submit(diff_file, path, encoding, timeout, memory_mb): path for path in paths}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except BrokenProcessPool:
+                yield {"path": futures[future], "result": "error", "reason": "worker process died"}
+
+
+def write_csv(reports, out) -> None:
+    """Writes the reports as CSV."""
+    writer = csv.DictWriter(out, fieldnames=CSV_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    for report in reports:
+        writer.writerow(report)
+
+
+def main(argv: list[str]) -> int:
+    """Runs `pickledbg diff`. Returns the exit code: 1 if any file diverged."""
+    if argv[:1] == ["--engine"]:
+        # an unpickler subprocess started by start_engines()
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--engine", choices=ENGINES)
+        parser.add_argument("--encoding", default="ASCII")
+        parser.add_argument("path")
+        args = parser.parse_args(argv)
+        run_engine(args.engine, args.path, args.encoding)
+        return 0
+
+    parser = argparse.ArgumentParser(
+        prog="pickledbg diff",
+        description="Run pickles through the pure-Python and C unpicklers and the disassembler, "
+                    "and report the first instruction where they diverge. The pickles' code is run.")
+    parser.add_argument("paths", nargs="+", metavar="file-or-corpus",
+                        help="pickle files, directories (searched recursively) or glob patterns")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of files diffed at once (default: number of CPUs)")
+    parser.add_argument("-f", "--format", choices=("json", "csv"), default="json",
+                        help="report format (default: json)")
+    parser.add_argument("-o", "--output", default="-",
+                        help="report file (default: stdout)")
+    parser.add_argument("--diverging", action="store_true",
+                        help="only report files where the unpicklers diverge or that couldn't be read")
+    parser.add_argument("--encoding", default="ASCII",
+                        help="encoding for protocol 0-2 str instances, passed to both unpicklers (default: ASCII)")
+    parser.add_argument("--timeout", type=float, default=10,
+                        help="seconds allowed per unpickler run, 0 for no limit (default: 10)")
+    parser.add_argument("--memory-mb", type=int, default=1024,
+                        help="address space cap per unpickler in MB, 0 for no limit (default: 1024)")
+    args = parser.parse_args(argv)
+
+    from scan import expand, write_json
+
+    paths = expand(args.paths)
+    if not paths:
+        print("[-] Error: no files matched", file=sys.stderr)
+        return 1
+
+    counts = {"agree": 0, "diverge": 0, "error": 0}
+    def counted(reports):
+        for report in reports:
+            counts[report["result"]] += 1
+            if report["result"] != "agree" or not args.diverging:
+                yield report
+
+    out = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+    try:
+        reports = counted(diff(paths, max(args.jobs, 1), args.encoding, args.timeout, args.memory_mb))
+        if args.format == "csv":
+            write_csv(reports, out)
+        else:
+            write_json(reports, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"[+] {counts['agree']} agree, {counts['diverge']} diverge, {counts['error']} could not be read",
+          file=sys.stderr)
+    return 1 if counts["diverge"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,440 @@
+###############################################################################
+#
+# Streaming disassembly for pickledbg
+#
+# Instead of running `pickletools.dis` over the whole pickle up front, the
+# pickle is scanned once to record where every instruction starts. Nothing
+# is decoded during that scan; the text for an instruction is only produced
+# (with `pickletools.genops`) when it is actually displayed or exported.
+# Pickles that seek their own input can run code past the first STOP; that
+# code is indexed as a new region when execution first reaches it. The
+# interactive debugger builds the index on a background thread, so the
+# prompt doesn't wait for it.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import re, pickletools, threading
+from array import array
+from bisect import bisect_left, bisect_right
+from pickletools import (code2op, markobject, UP_TO_NEWLINE, TAKEN_FROM_ARGUMENT1,
+                         TAKEN_FROM_ARGUMENT4, TAKEN_FROM_ARGUMENT4U, TAKEN_FROM_ARGUMENT8U)
+
+
+### CONSTANTS ###
+MARK = ord('(')
+POP = ord('0')
+STOP = ord('.')
+MEMOIZE = 0x94
+PUT, BINPUT, LONG_BINPUT = ord('p'), ord('q'), ord('r')
+GET, BINGET, LONG_BINGET = ord('g'), ord('h'), ord('j')
+MEMO_WRITE_PATTERN = re.compile(b'[\x94pqr]')    # MEMOIZE, PUT, BINPUT, LONG_BINPUT
+
+# arguments longer than this are previewed rather than decoded when displayed
+ARG_PREVIEW = 256
+
+# width of the length prefix for counted arguments
+COUNT_WIDTH = {
+    TAKEN_FROM_ARGUMENT1: 1,
+    TAKEN_FROM_ARGUMENT4: 4,
+    TAKEN_FROM_ARGUMENT4U: 4,
+    TAKEN_FROM_ARGUMENT8U: 8,
+}
+
+
+def _opcode_table() -> list:
+    """Builds a table indexed by opcode byte describing how to skip over each instruction.
+
+    Each entry is None for unknown opcodes, otherwise a tuple of
+    (OpcodeInfo, argument size or pickletools length code, number of
+    newline-terminated lines, stack items popped, stack items pushed,
+    whether a MARK is consumed).
+    """
+    table = [None] * 256
+    for op in pickletools.opcodes:
+        if op.arg is None:
+            n, lines = 0, 0
+        else:
+            n = op.arg.n
+            lines = 2 if op.arg.name == 'stringnl_noescape_pair' else 1
+        before = op.stack_before
+        consumes_mark = markobject in before
+        pops = before.index(markobject) if consumes_mark else len(before)
+        pushes = 0 if markobject in op.stack_after else len(op.stack_after)
+        table[ord(op.code)] = (op, n, lines, pops, pushes, consumes_mark)
+    return table
+
+OPCODE_TABLE = _opcode_table()
+
+
+def memo_slot(data, pos: int, code: int, memo_size: int) -> int:
+    """Returns the memo slot the memo instruction at `pos` writes or reads, or -1 if its argument is bad.
+
+    MEMOIZE stores at `memo_size`, the number of distinct slots written
+    before it, which is `len(memo)` in `Unpickler.load_memoize`.
+    """
+    if code == MEMOIZE:
+        return memo_size
+    if code == BINPUT or code == BINGET:
+        return data[pos+1]
+    if code == LONG_BINPUT or code == LONG_BINGET:
+        return int.from_bytes(data[pos+1:pos+5], 'little')
+    # PUT and GET take a decimal line
+    try:
+        return int(data[pos+1:data.find(b'\n', pos+1)])
+    except ValueError:
+        return -1
+
+
+### CLASSES ###
+class Disassembly:
+    """An index of every instruction in a pickle, built in a single pass.
+
+    The index is a compact array of instruction offsets, a bytearray of
+    opcodes and an array of MARK nesting depths (used for indentation, like
+    `pickletools.dis`). Instruction text is decoded on demand by `line()`.
+
+    Like `pickletools.dis`, the scan stops at the first STOP. If the pickle
+    is malformed, the scan stops at the bad instruction, `error` describes
+    the problem and everything before it is still available. Code beyond
+    the end of the index, which a pickle can only reach by seeking its
+    input, is added by `extend()`.
+
+    With `background`, the index is built on a thread started by
+    `start()`, and `wait()` must return before anything else is used.
+
+    Args:
+        data: The pickle. Anything that supports len(), indexing, slicing
+            and `find()`, such as bytes or an mmap.
+        skips (dict): Offset -> number of bytes of data embedded in the
+            stream there, such as the arrays joblib writes after a BUILD,
+            which are skipped instead of disassembled.
+        background (bool): Leave the index empty until `start()` is called.
+    """
+    def __init__(self, data, skips: dict = None, background: bool = False):
+        self.data = data
+        self.skips = skips or {}
+        self.offsets = array('Q')
+        self.opcodes = bytearray()
+        self.depths = array('I')
+        self.end = 0            # offset just past the last instruction
+        self.end_depth = 0      # MARK depth after the last instruction
+        self.error = None
+        self._lines = {}
+        self._line_index = {}   # address -> instruction index, for addresses looked up before
+        # instructions that write a memo slot for the first time, found up to
+        # `_memo_scanned`, see `memo_size_before()`
+        self._memo_firsts = array('Q')
+        self._memo_scanned = 0
+        self._memo_slots = None     # the slots written so far, None while only MEMOIZE has written any
+        self.regions = {}       # index of the last instruction of each region -> (end, MARK depth after it)
+        self.ready = threading.Event()
+        if not background:
+            self.index()
+            self.ready.set()
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def start(self, build=None) -> None:
+        """Builds the index on a daemon thread.
+
+        Args:
+            build: Called on the thread instead of `index()`, to build the
+                index another way, e.g. to find the `skips` first or to
+                load it from a cache, without delaying the caller. It may
+                return a function to call on the thread once the index is
+                ready, for work nothing needs to wait for, such as saving it.
+        """
+        def run():
+            then = None
+            try:
+                then = (build or self.index)()
+            except Exception as e:
+                self.error = "indexing failed: %s" % e
+            finally:
+                self.ready.set()
+            if then is not None:
+                then()
+        threading.Thread(target=run, name="pickledbg-index", daemon=True).start()
+
+    def index(self) -> None:
+        """Scans the pickle from the start, which `__init__` does unless building in the background."""
+        self._scan()
+
+    def wait(self, timeout: float = None) -> bool:
+        """Waits for the index to be built. Returns False if `timeout` seconds passed first."""
+        return self.ready.wait(timeout)
+
+    def _scan(self, pos: int = 0) -> None:
+        """Records the offset, opcode and MARK depth of every instruction from `pos` to the next STOP."""
+        data = self.data
+        size = len(data)
+        find = data.find
+        table = OPCODE_TABLE
+        offsets_append = self.offsets.append
+        opcodes_append = self.opcodes.append
+        depths_append = self.depths.append
+        skips = self.skips
+
+        # items above the topmost MARK, and the same count saved for every
+        # enclosing MARK, so a protocol 0 POP of a MARK can be recognized
+        above = 0
+        saved = []
+
+        while True:
+            if pos >= size:
+                self.error = "pickle exhausted before seeing STOP"
+                break
+
+            code = data[pos]
+            entry = table[code]
+            if entry is None:
+                self.error = "at position %d, opcode %r unknown" % (pos, bytes([code]))
+                break
+            op, n, lines, pops, pushes, consumes_mark = entry
+
+            # find where the next instruction starts
+            if n >= 0:
+                end = pos + 1 + n
+            elif n == UP_TO_NEWLINE:
+                end = find(b'\n', pos + 1) + 1
+                if lines == 2 and end:
+                    end = find(b'\n', end) + 1
+                if not end:
+                    end = -1
+            else:
+                width = COUNT_WIDTH[n]
+                count = int.from_bytes(data[pos+1:pos+1+width], 'little', signed=(n == TAKEN_FROM_ARGUMENT4))
+                if count < 0:
+                    self.error = "at position %d, %s has a negative length" % (pos, op.name)
+                    break
+                end = pos + 1 + width + count
+
+            if end < 0 or end > size:
+                self.error = "at position %d, pickle exhausted while reading %s" % (pos, op.name)
+                break
+
+            offsets_append(pos)
+            opcodes_append(code)
+            depths_append(len(saved))
+            pos = end
+            if skips and pos in skips:
+                pos += skips[pos]
+
+            # crude stack emulation, only precise enough to track MARKs
+            if consumes_mark or (code == POP and not above and saved):
+                above = saved.pop() if saved else 0
+                above = (above - pops if above > pops else 0) + pushes
+            elif code == MARK:
+                saved.append(above)
+                above = 0
+            else:
+                above = (above - pops if above > pops else 0) + pushes
+
+            if code == STOP:
+                break
+
+        self.end = pos
+        self.end_depth = len(saved)
+
+    def line_of(self, addr: int):
+        """Returns the index of the instruction at address `addr`, or None.
+
+        Addresses found before are answered from a dictionary, so a loop
+        jumping to the same address millions of times costs a lookup each.
+        """
+        i = self._line_index.get(addr)
+        if i is not None:
+            return i
+        i = bisect_left(self.offsets, addr)
+        if i < len(self.offsets) and self.offsets[i] == addr:
+            self._line_index[addr] = i
+            return i
+        return None
+
+    def extend(self, addr: int):
+        """Indexes the code from `addr`, beyond the end of the index, to the next STOP.
+
+        Returns:
+            int | None: The index of the instruction at `addr`, or None if
+                `addr` is inside the indexed code or no instruction could
+                be decoded there.
+        """
+        first = len(self.offsets)
+        if addr < self.end or addr >= len(self.data):
+            return None
+        end, end_depth, error = self.end, self.end_depth, self.error
+        self._scan(addr)
+        if len(self.offsets) == first:
+            self.end, self.end_depth = end, end_depth
+            return None
+        # the first error found stays the one reported
+        self.error = error
+        if first:
+            self.regions[first - 1] = (end, end_depth)
+        return first
+
+    def opcode_lines(self, code: int) -> list[int]:
+        """Returns the indices of every instruction with the given opcode byte."""
+        found = []
+        needle = bytes([code])
+        i = self.opcodes.find(needle)
+        while i >= 0:
+            found.append(i)
+            i = self.opcodes.find(needle, i + 1)
+        return found
+
+    def find(self, needle: bytes) -> list[int]:
+        """Returns the indices of every instruction whose bytes contain `needle`.
+
+        The raw pickle is searched, so this finds strings and byte patterns
+        inside arguments as well as opcodes. A match that runs on into the
+        next instruction belongs to the instruction it starts in, and each
+        instruction is reported once.
+        """
+        found = []
+        if not needle:
+            return found
+        find = self.data.find
+        offsets = self.offsets
+        end = self.end
+        last = len(offsets) - 1
+        pos = find(needle, 0, end)
+        while pos >= 0:
+            i = bisect_right(offsets, pos) - 1
+            found.append(i)
+            # skip the rest of the instruction, it is already reported
+            next_pos = offsets[i+1] if i < last else end
+            pos = find(needle, next_pos, end) if next_pos < end else -1
+        return found
+
+    def line(self, i: int, full: bool = False) -> str:
+        """Returns the disassembly of instruction `i` in `pickletools.dis` format.
+
+        Args:
+            i (int): The instruction index.
+            full (bool): Decode long arguments completely instead of
+                previewing the first `ARG_PREVIEW` bytes.
+        Returns:
+            str: The disassembled instruction.
+        """
+        if not full and i in self._lines:
+            return self._lines[i]
+
+        pos = self.offsets[i]
+        if i in self.regions:
+            end, depth_after = self.regions[i]
+        elif i + 1 < len(self.offsets):
+            end, depth_after = self.offsets[i+1], self.depths[i+1]
+        else:
+            end, depth_after = self.end, self.end_depth
+        op = code2op[chr(self.opcodes[i])]
+        depth = self.depths[i]
+
+        line = "%5d: %-4s %s%s" % (pos, repr(op.code)[1:-1], '    ' * depth, op.name)
+
+        if op.arg is None:
+            arg = None
+        elif full or end - pos <= ARG_PREVIEW:
+            try:
+                _, arg, _ = next(pickletools.genops(bytes(self.data[pos:end])))
+                arg = repr(arg)
+            except Exception as e:
+                arg = "<invalid argument: %s>" % e
+        else:
+            arg = self._preview_arg(op, pos, end)
+
+        markmsg = None
+        if depth_after < depth:
+            markmsg = "(MARK at %d)" % self.offsets[self._mark_for(i)]
+        elif op.name == "MEMOIZE":
+            markmsg = "(as %d)" % self.memo_size_before(i)
+        elif self.skips and op.arg is None and pos + 1 in self.skips:
+            markmsg = "(followed by %d bytes of embedded data)" % self.skips[pos + 1]
+
+        if arg is not None or markmsg:
+            line += ' ' * (10 - len(op.name))
+            if arg is not None:
+                line += ' ' + arg
+            if markmsg:
+                line += ' ' + markmsg
+
+        if not full:
+            if len(self._lines) > 1024:
+                self._lines.clear()
+            self._lines[i] = line
+        return line
+
+    def memo_size_before(self, i: int) -> int:
+        """Returns the number of distinct memo slots written by the instructions before `i`.
+
+        That is the slot a MEMOIZE at `i` stores into. A slot written again,
+        e.g. by a PUT reusing it, is only counted once. The instructions
+        that first write each slot are found the first time they are needed,
+        so every memo write is only decoded once.
+        """
+        if i > self._memo_scanned:
+            self._scan_memo(i)
+        return bisect_left(self._memo_firsts, i)
+
+    def _scan_memo(self, stop: int) -> None:
+        """Finds the first writes of memo slots from `_memo_scanned` to instruction `stop`."""
+        opcodes = self.opcodes
+        offsets = self.offsets
+        data = self.data
+        firsts = self._memo_firsts
+        slots = self._memo_slots
+        for match in MEMO_WRITE_PATTERN.finditer(opcodes, self._memo_scanned, stop):
+            j = match.start()
+            code = opcodes[j]
+            slot = memo_slot(data, offsets[j], code, len(firsts))
+            if slot < 0:
+                continue
+            if slots is None and code != MEMOIZE:
+                slots = set(range(len(firsts)))
+            if slots is not None:
+                if slot in slots:
+                    continue
+                slots.add(slot)
+            firsts.append(j)
+        self._memo_slots = slots
+        self._memo_scanned = stop
+
+    def _mark_for(self, i: int) -> int:
+        """Returns the index of the MARK consumed by instruction `i`."""
+        depth = self.depths[i] - 1
+        j = self.opcodes.rfind(b'(', 0, i)
+        while self.depths[j] != depth:
+            j = self.opcodes.rfind(b'(', 0, j)
+        return j
+
+    def _preview_arg(self, op, pos: int, end: int) -> str:
+        """Returns a short repr of a long argument without decoding all of it."""
+        n = op.arg.n
+        start = pos + 1 + COUNT_WIDTH.get(n, 0)
+        length = end - start
+        prefix = bytes(self.data[start:start+ARG_PREVIEW])
+        name = op.arg.name
+        if name.startswith('unicodestring'):
+            text = repr(prefix.decode('utf-8', 'ignore'))
+        elif name.startswith('string'):
+            text = repr(prefix.decode('latin-1'))
+        elif name.startswith('bytearray'):
+            text = repr(bytearray(prefix))
+        else:
+            text = repr(prefix)
+        return "%s… (%d bytes)" % (text, length)
+
+    def max_proto(self) -> int:
+        """Returns the highest protocol among the opcodes, like `pickletools.dis` reports."""
+        return max((code2op[chr(code)].proto for code in set(self.opcodes)), default=-1)
+
+    def export(self, out) -> None:
+        """Writes the full disassembly to a text file, one instruction at a time."""
+        write = out.write
+        for i in range(len(self.offsets)):
+            write(self.line(i, full=True))
+            write('\n')
+        write("highest protocol among opcodes = %d\n" % self.max_proto())
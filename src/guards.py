@@ -0,0 +1,211 @@
+###############################################################################
+#
+# Resource guards for pickledbg
+#
+# A malicious or broken pickle can exhaust the host long before it finishes:
+# memo expansion, DUP/APPENDS loops and a few REDUCEs are enough. Guards
+# stop execution when the instruction budget runs out, when the process
+# grows past a memory ceiling, or when a container, the stack or the memo
+# gets too long. Like checkpoints, the budget, memory and size checks are
+# sampled every few instructions. Opcodes that can grow a container or
+# call a function, which can allocate any amount at once, are checked
+# exactly, by wrapping only their handlers.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import os, sys
+from collections import deque
+from time import perf_counter
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+
+### LOCAL IMPORTS ###
+from watchpoints import MUTATORS
+
+
+### CONSTANTS ###
+SAMPLE_INTERVAL = 1024     # instructions between samples of memory and sizes
+SAMPLES_KEPT = 16          # samples the growth rate is measured over
+
+# opcodes that leave a new or grown container on top of the stack: APPEND(S),
+# SETITEM(S), ADDITEMS, BUILD, and LIST, TUPLE, DICT, FROZENSET from a MARK
+GROWERS = frozenset(MUTATORS) | frozenset(map(ord, 'ltd\x91'))
+# opcodes that call something from the pickle: REDUCE, NEWOBJ(_EX), INST,
+# OBJ, and BUILD, which may call __setstate__
+CALLERS = frozenset(map(ord, 'R\x81\x92iob'))
+SIZED_TYPES = (list, dict, set, frozenset, tuple, bytearray)
+
+try:
+    PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    PAGE_SIZE = 4096
+
+
+### CLASSES ###
+class Guards:
+    """The resource limits enforced while the debugger executes instructions.
+
+    A limit of 0 means unlimited. `next_at` is the instruction count at
+    which `check()` must next be called, or None if no limit is set.
+
+    Attributes:
+        max_instructions (int): Instructions that may be executed in total.
+        max_memory_mb (int): Resident memory of the process, in MB.
+        max_container_len (int): Items in any one container, on the stack
+            (counting the items under every MARK) or in the memo.
+        hits (int): How many times a guard has stopped execution.
+    """
+    title = "Guard"
+
+    def __init__(self, max_instructions: int = 0, max_memory_mb: int = 0, max_container_len: int = 0):
+        self.samples = deque(maxlen=SAMPLES_KEPT)  # (executed, seconds, rss, stack items, memo size)
+        self.hits = 0
+        self.configure(max_instructions, max_memory_mb, max_container_len)
+
+    def configure(self, max_instructions: int, max_memory_mb: int, max_container_len: int,
+                  executed: int = 0) -> None:
+        """Changes the limits, `executed` instructions into the pickle."""
+        self.max_instructions = max_instructions
+        self.max_memory_mb = max_memory_mb
+        self.max_container_len = max_container_len
+        self.samples.clear()
+        self.schedule(executed)
+
+    def schedule(self, executed: int) -> None:
+        """Sets `next_at` to the next sample, or to the end of the instruction budget if that comes first."""
+        if not (self.max_instructions or self.max_memory_mb or self.max_container_len):
+            self.next_at = None
+            return
+        self.next_at = executed + SAMPLE_INTERVAL
+        if self.max_instructions:
+            self.next_at = min(self.next_at, max(self.max_instructions, executed + 1))
+
+    def check(self, unpickler) -> str | None:
+        """Samples the Pickle Machine and the process.
+
+        Returns:
+            str | None: Why execution must stop, or None if every limit holds.
+        """
+        executed = unpickler.executed
+        if self.samples and self.samples[-1][0] > executed:
+            # went back, the old samples describe a different run
+            self.samples.clear()
+        rss = rss_bytes() if self.max_memory_mb else None
+        stack_items = len(unpickler.stack) + sum(map(len, unpickler.metastack))
+        memo_size = len(unpickler.memo)
+        self.samples.append((executed, perf_counter(), rss, stack_items, memo_size))
+        self.schedule(executed)
+
+        # the container a guarded handler stopped on is still on top of the
+        # stack, so execution stays stopped until the limit is raised
+        top = unpickler.stack[-1] if unpickler.stack else None
+
+        message = None
+        if self.max_instructions and executed >= self.max_instructions:
+            message = f"{executed} instructions executed, max-instructions is {self.max_instructions}"
+            option = 'max-instructions'
+        elif self.max_memory_mb and rss is not None and rss > self.max_memory_mb << 20:
+            message = f"process uses {rss >> 20} MB, max-memory-mb is {self.max_memory_mb}"
+            option = 'max-memory-mb'
+        elif self.max_container_len and stack_items > self.max_container_len:
+            message = f"stack holds {stack_items} items, max-container-len is {self.max_container_len}"
+            option = 'max-container-len'
+        elif self.max_container_len and memo_size > self.max_container_len:
+            message = f"memo holds {memo_size} entries, max-container-len is {self.max_container_len}"
+            option = 'max-container-len'
+        elif self.max_container_len and isinstance(top, SIZED_TYPES) and len(top) > self.max_container_len:
+            message = (f"{type(top).__name__} of {len(top)} items on top of the stack, "
+                       f"max-container-len is {self.max_container_len}")
+            option = 'max-container-len'
+        if message is None:
+            return None
+        self.hits += 1
+        return f"{self.title}: {message}{self.growth()}{hint(option)}"
+
+    def growth(self) -> str:
+        """Describes how fast memory, the stack and the memo grew over the recent samples."""
+        if len(self.samples) < 2:
+            return ""
+        executed0, seconds0, rss0, stack0, memo0 = self.samples[0]
+        executed1, seconds1, rss1, stack1, memo1 = self.samples[-1]
+        instructions = executed1 - executed0
+        if instructions <= 0:
+            return ""
+        parts = []
+        if rss0 is not None and rss1 is not None:
+            parts.append(f"memory {(rss1 - rss0) / (1 << 20):+.1f} MB "
+                         f"({(rss1 - rss0) / instructions / 1024:+.2f} KB/instruction)")
+        parts.append(f"stack {stack1 - stack0:+d} items")
+        parts.append(f"memo {memo1 - memo0:+d} entries")
+        return (f". Over the last {instructions} instructions ({seconds1 - seconds0:.2f} s): "
+                + ", ".join(parts))
+
+
+### FUNCTIONS ###
+def hint(option: str) -> str:
+    """Tells the user how to get past a limit, which keeps stopping execution until it is raised."""
+    return f". Enter 'set {option} <n>' with a higher limit, or 0 for none, to continue"
+
+
+def rss_bytes() -> int | None:
+    """Returns the resident memory of this process in bytes, or None if it can't be measured.
+
+    Where /proc is not available, the peak resident memory is used, which
+    is just as good for enforcing a ceiling.
+    """
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def instrument_guards(dispatch: dict, guards: Guards, hits: list) -> dict:
+    """Returns a copy of `dispatch` that enforces the guards after every instruction that could break one at once.
+
+    With `max_container_len` set, the length of every container built or
+    grown is checked; with `max_memory_mb` set, memory is checked after
+    every call. When a limit is crossed, (guards, message) is appended to
+    `hits` for the execution loop to act on, like a watchpoint.
+    """
+    codes = set()
+    if guards.max_container_len:
+        codes |= GROWERS
+    if guards.max_memory_mb:
+        codes |= CALLERS
+    guarded = dict(dispatch)
+    for code in codes:
+        if code in dispatch:
+            guarded[code] = _guard(dispatch[code], guards, hits,
+                                   guards.max_container_len if code in GROWERS else 0,
+                                   guards.max_memory_mb << 20 if code in CALLERS else 0)
+    return guarded
+
+
+def _guard(handler, guards: Guards, hits: list, max_len: int, max_memory: int):
+    def guarded(unpickler):
+        before = rss_bytes() if max_memory else None
+        handler(unpickler)
+        if max_len:
+            # every opcode that grows a container leaves it on top of the stack
+            top = unpickler.stack[-1]
+            if isinstance(top, SIZED_TYPES) and len(top) > max_len:
+                hits.append((guards, f"{type(top).__name__} of {len(top)} items on top of the stack, "
+                                     f"max-container-len is {max_len}{guards.growth()}{hint('max-container-len')}"))
+        if max_memory:
+            rss = rss_bytes()
+            if rss is not None and rss > max_memory:
+                grew = f" ({(rss - before) / (1 << 20):+.1f} MB in this call)" if before is not None else ""
+                hits.append((guards, f"process uses {rss >> 20} MB after a call{grew}, "
+                                     f"max-memory-mb is {guards.max_memory_mb}{guards.growth()}{hint('max-memory-mb')}"))
+    return guarded
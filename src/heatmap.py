@@ -0,0 +1,110 @@
+###############################################################################
+#
+# Execution heatmap for pickledbg
+#
+# Pickles that seek their own input can jump backwards and loop. The
+# debugger follows the input offset after every instruction that can run
+# code, counts how many times each instruction executes and records every
+# jump it sees, so the hottest instructions and the loops they form can be
+# shown. Counters live in an anonymous mapping, so a pickle with millions
+# of instructions only pays for the pages of counters actually used.
+# Checkpoints save the counters with the rest of the state, so stepping
+# backwards takes the counts back too.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import mmap
+from array import array
+from heapq import nlargest
+
+
+### CLASSES ###
+class Heatmap:
+    """How many times each instruction has executed, and the jumps taken.
+
+    Args:
+        size (int): The number of instructions in the disassembly.
+
+    Attributes:
+        counts (memoryview): Executions per instruction index. One extra
+            slot at the end counts instructions executed outside the
+            disassembly.
+        jumps (dict): (from address, to address) -> times taken, for every
+            instruction after which execution did not continue with the
+            next instruction.
+    """
+    def __init__(self, size: int):
+        self._map = None
+        self.counts = None
+        self.jumps = {}
+        self.resize(size)
+
+    def resize(self, size: int) -> None:
+        """Makes room for `size` instructions, keeping the counts so far."""
+        old_map, old = self._map, self.counts
+        self._map = mmap.mmap(-1, 8 * (size + 1))
+        self.counts = memoryview(self._map).cast('Q')
+        if old is not None:
+            kept = min(len(old) - 1, size)
+            self.counts[:kept] = old[:kept]
+            old.release()
+            old_map.close()
+
+    def reset(self) -> None:
+        """Forgets every count and jump."""
+        size = len(self.counts) - 1
+        self.counts.release()
+        self._map.close()
+        self._map = self.counts = None
+        self.resize(size)
+        self.jumps.clear()
+
+    def snapshot(self) -> tuple:
+        """Returns what `restore()` needs to put the counts and jumps back as they are now.
+
+        Until something jumps, every instruction so far has run once in
+        order, so the counts themselves are only copied after a jump.
+        """
+        data = bytes(self._map) if self.jumps else None
+        return data, dict(self.jumps), self.counts[-1]
+
+    def restore(self, snapshot: tuple, line: int) -> None:
+        """Puts back the counts and jumps saved by `snapshot()` when instruction `line` was next."""
+        data, jumps, outside = snapshot
+        counts = self.counts
+        size = len(counts) - 1
+        if data is None:
+            kept = min(line, size)
+            counts[:kept] = array('Q', [1]) * kept
+        else:
+            # the disassembly may have grown since, but never shrinks
+            saved = memoryview(data).cast('Q')
+            kept = len(saved) - 1
+            counts[:kept] = saved[:kept]
+            saved.release()
+        counts[kept:size] = array('Q', bytes(8 * (size - kept)))
+        counts[size] = outside
+        self.jumps = dict(jumps)
+
+    def jump(self, source: int, target: int) -> None:
+        """Records that execution went from the instruction at `source` to `target`."""
+        key = (source, target)
+        self.jumps[key] = self.jumps.get(key, 0) + 1
+
+    def hottest(self, limit: int) -> list[tuple[int, int]]:
+        """Returns (instruction index, count) for the `limit` most executed instructions."""
+        counts = self.counts
+        return [(i, n) for n, i in nlargest(limit, ((counts[i], i) for i in range(len(counts) - 1)))
+                if n > 0]
+
+    def loops(self) -> list[tuple[int, int, int]]:
+        """Returns (first address, last address, iterations) for every backward jump, most taken first.
+
+        A backward jump from the instruction at `last` to `first` closes a
+        loop whose body starts at `first`.
+        """
+        loops = [(target, source, count) for (source, target), count in self.jumps.items() if target <= source]
+        loops.sort(key=lambda loop: -loop[2])
+        return loops
@@ -0,0 +1,163 @@
+###############################################################################
+#
+# Python hooks for pickledbg
+#
+# Plugins register functions to run on every instruction with a given opcode
+# (`on_opcode("REDUCE", fn)`) or at a given address (`on_address(120, fn)`).
+# Hooks are called with the live DbgUnpickler. Like watchpoints, only the
+# dispatch handlers of hooked opcodes are wrapped, so unhooked instructions
+# run at the speed of the unhooked debugger.
+#
+###############################################################################
+
+
+### LOCAL IMPORTS ###
+from errors import *
+from tracer import OPCODE_NAMES
+
+
+### CLASSES ###
+class Hook:
+    """A function called before or after an instruction runs.
+
+    The function is called with the DbgUnpickler while the hooked
+    instruction is the current one, so `curr_addr()` is its address. If it
+    returns something true, execution stops after the instruction, with
+    the returned value as the reason if it is a string. An exception
+    raised by the function also stops execution.
+
+    Attributes:
+        number (int): The number shown by 'info hooks'.
+        function: The function called.
+        code (int|None): The opcode hooked, or None for an address hook.
+        addr (int|None): The address hooked, or None for an opcode hook.
+        after (bool): Whether the function is called after the instruction rather than before.
+        hits (int): How many times the hook has stopped execution.
+        calls (int): How many times the function has been called.
+    """
+    def __init__(self, number: int, function, code: int = None, addr: int = None, after: bool = False):
+        self.number = number
+        self.function = function
+        self.code = code
+        self.addr = addr
+        self.after = after
+        self.hits = 0
+        self.calls = 0
+
+    @property
+    def name(self) -> str:
+        return getattr(self.function, "__qualname__", None) or repr(self.function)
+
+    @property
+    def title(self) -> str:
+        """How stop messages refer to the hook."""
+        return f"Hook {self.number} ({self.name})"
+
+    def call(self, unpickler, hits: list) -> None:
+        """Calls the function, appending (hook, message) to `hits` if execution should stop."""
+        self.calls += 1
+        try:
+            stop = self.function(unpickler)
+        except Exception as e:
+            hits.append((self, f"raised {type(e).__name__}: {e}"))
+            return
+        if stop:
+            hits.append((self, stop if isinstance(stop, str) else f"stopped at {unpickler.curr_addr()}"))
+
+    def describe(self) -> str:
+        """Returns a one-line description of the hook."""
+        where = f"opcode {OPCODE_NAMES[self.code]}" if self.addr is None else f"address {self.addr}"
+        return (f"{self.name} {'after' if self.after else 'before'} {where}, "
+                f"called {self.calls} time{'s' if self.calls != 1 else ''}")
+
+
+class Hooks:
+    """The hooks registered with a debugger.
+
+    Attributes:
+        by_number (dict): hook number -> Hook.
+        enabled (bool): Whether hooks are called; they are not while
+            instructions are replayed to go back.
+    """
+    def __init__(self):
+        self.by_number = {}
+        self.next_number = 1
+        self.enabled = True
+
+    def __len__(self) -> int:
+        return len(self.by_number)
+
+    def add(self, function, code: int = None, addr: int = None, after: bool = False) -> Hook:
+        if not callable(function):
+            raise PickleDBGError(f"A hook must be callable, not {type(function).__name__}.")
+        hook = Hook(self.next_number, function, code, addr, after)
+        self.by_number[hook.number] = hook
+        self.next_number += 1
+        return hook
+
+    def remove(self, number: int) -> None:
+        """Removes a hook by number.
+
+        Raises:
+            PickleDBGError: If there is no such hook.
+        """
+        if self.by_number.pop(number, None) is None:
+            raise PickleDBGError(f"No hook number {number}.")
+
+
+### FUNCTIONS ###
+def instrument_hooks(dispatch: dict, hooks: Hooks, disasm, hits: list) -> dict:
+    """Returns a copy of `dispatch` with the handlers of hooked opcodes wrapped.
+
+    An address hook wraps the handler of the opcode at its address, and the
+    wrapper only calls it when that is the current address. When a hook
+    asks to stop, (hook, message) is appended to `hits` for the execution
+    loop to act on, like a watchpoint.
+    """
+    by_code = {}
+    for hook in hooks.by_number.values():
+        code = hook.code
+        if code is None:
+            line = disasm.line_of(hook.addr)
+            if line is None:
+                continue
+            code = disasm.opcodes[line]
+        by_code.setdefault(code, []).append(hook)
+
+    hooked = dict(dispatch)
+    for code, code_hooks in by_code.items():
+        if code in dispatch:
+            hooked[code] = _wrap(dispatch[code], code_hooks, hooks, hits)
+    return hooked
+
+
+def _wrap(handler, code_hooks: list, hooks: Hooks, hits: list):
+    before = tuple(h for h in code_hooks if h.addr is None and not h.after)
+    after = tuple(h for h in code_hooks if h.addr is None and h.after)
+    # address -> (hooks before, hooks after)
+    at = {}
+    for h in code_hooks:
+        if h.addr is not None:
+            at.setdefault(h.addr, ([], []))[h.after].append(h)
+
+    def hooked(unpickler):
+        if not hooks.enabled:
+            handler(unpickler)
+            return
+        here = ()
+        if at:
+            line = unpickler.disasm_line_no
+            addresses = unpickler.addresses
+            here = at.get(addresses[line], ()) if line < len(addresses) else ()
+        for h in before:
+            h.call(unpickler, hits)
+        if here:
+            for h in here[0]:
+                h.call(unpickler, hits)
+        handler(unpickler)
+        for h in after:
+            h.call(unpickler, hits)
+        if here:
+            for h in here[1]:
+                h.call(unpickler, hits)
+    return hooked
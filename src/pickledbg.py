@@ -14,26 +14,61 @@
 
 
 ### GLOBAL IMPORTS ###
-import sys, io, pickletools
-from os import system, get_terminal_size
-import readline
-from pickle import _Unpickler, _Unframer, _Stop
+import sys, io, argparse, pickle, pickletools
+from shutil import get_terminal_size
+from pickle import _Unpickler, _Unframer, _Stop, APPEND, APPENDS, SETITEM, SETITEMS
 
 
 ### LOCAL IMPORTS ###
 from colors import *
 from errors import *
 from util import *
+from tracer import OPCODE_NAMES
+from breakpoints import Breakpoint
+from watchpoints import MemoWatch, DepthWatch, ObjectWatch, instrument
+from guards import Guards, instrument_guards
+from hooks import Hook, Hooks, instrument_hooks
+from heatmap import Heatmap
+from screen import Screen
+from disasm import Disassembly
+from source import map_buffer
+from containers import open_source, find_arrays, persistent_stub, reattach_terminal
+from snapshots import Checkpoints
+
+
+### CONSTANTS ###
+INDEX_WAIT = 0.02   # seconds the prompt waits for the disassembly before showing up without it
+CACHE_SIZE_MB = 1024
+
+# opcodes that may change objects already on the stack or in the memo, or run
+# arbitrary code (which may also print to the terminal). After one of these,
+# cached previews can no longer be trusted and the screen is redrawn in full.
+MUTATING_OPCODES = frozenset(
+    ord(op.code) for op in pickletools.opcodes if op.name in (
+        'APPEND', 'APPENDS', 'SETITEM', 'SETITEMS', 'ADDITEMS', 'BUILD',
+        'REDUCE', 'INST', 'OBJ', 'NEWOBJ', 'NEWOBJ_EX', 'GLOBAL',
+        'STACK_GLOBAL', 'PERSID', 'BINPERSID', 'EXT1', 'EXT2', 'EXT4'))
+
+# opcodes that only change one container when it is a plain list, dict or set
+# and its new keys are hashed without running code, see `mutated_container()`
+CONTAINER_OPCODES = frozenset(
+    ord(op.code) for op in pickletools.opcodes if op.name in (
+        'APPEND', 'APPENDS', 'SETITEM', 'SETITEMS', 'ADDITEMS'))
+PLAIN_KEYS = frozenset((str, bytes, int, float, bool, type(None)))
 
 
 ### CLASSES ###
 class DbgUnpickler(_Unpickler):
     def __init__(self, file, *, fix_imports=True,
                  encoding="ASCII", errors="strict", buffers=None,
-                 pickle_disasm: list[str] = []):
-        self._buffers = iter(buffers) if buffers is not None else None
+                 disasm: Disassembly = None, payloads: dict = None, stubs: dict = None):
+        # a list rather than an iterator, so that going back can rewind it
+        self._buffers = list(buffers) if buffers is not None else None
         self._file_readline = file.readline
         self._file_read = file.read
+        self._file_tell = file.tell
+        self._file_readinto = getattr(file, "readinto", None)
+        self._file_seek = getattr(file, "seek", None)
         self.memo = {}
         self.encoding = encoding
         self.errors = errors
@@ -41,42 +76,204 @@ class DbgUnpickler(_Unpickler):
         self.fix_imports = fix_imports
 
         ### EVERYTHING BELOW THIS LINE IS CUSTOM DEBUGGER CODE ###
-        self.pickle_disasm = pickle_disasm
+        self.input = file           # the file being unpickled, see `setup_machine()`
+        self.disasm = disasm if disasm is not None else Disassembly(b'')
+        # offset -> stub for data embedded in the stream, e.g. joblib arrays
+        self.payloads = payloads if payloads is not None else {}
+        # "module.name" -> object find_class returns instead of importing it
+        self.stubs = stubs if stubs is not None else {}
         self.disasm_line_no = 0
-        self.addresses = [int(line.split(":")[0]) for line in self.pickle_disasm]
-        self.curr_addr = lambda: self.addresses[self.disasm_line_no]
-        self.options = {'step-verbose': False}
-        if self.pickle_disasm == []:
-            self.disas_failed = True
-        else:
-            self.disas_failed = False
+        self.executed = 0           # instructions executed since the start
+        self.addresses = self.disasm.offsets
+        # outside the disassembly (see `locate()`), the address is the input offset
+        self.curr_addr = lambda: (self.addresses[self.disasm_line_no]
+                                  if self.disasm_line_no < len(self.addresses) else self.tell())
+        self.heatmap = Heatmap(0)
+        self.breakpoints = {}       # breakpoint number -> Breakpoint
+        self.break_addrs = {}       # address -> list of Breakpoints set on it
+        self.watchpoints = {}       # watchpoint number -> Watchpoint, numbered with the breakpoints
+        self.watch_hits = []        # (Watchpoint or Guards, message) appended by the instrumented handlers
+        self.next_breakpoint = 1
+        self.hooks = Hooks()
+        self.stop_reason = None
+        self.stopped_by = ()        # the breakpoints or watchpoints that stopped the last run()
+        self.in_stop_commands = False
+        self.read_line = input      # where a 'commands' block reads its lines from, see `source()`
+        self.scripts = []           # command files and plugins run before the prompt (-x)
+        self.batch = False          # whether to quit after running them rather than show the prompt
+        self.screen = Screen()
+        self.options = {
+            'step-verbose': False,
+            'render-max-items': 50,
+            'render-max-depth': 6,
+            'render-max-width': 500,
+            'checkpoint-interval': 1000,
+            'checkpoint-limit': 64,
+            'profile-memory': True,
+            'max-instructions': 0,
+            'max-memory-mb': 0,
+            'max-container-len': 0,
+        }
+        self.checkpoints = Checkpoints(self.options['checkpoint-interval'],
+                                       self.options['checkpoint-limit'])
+        self.guards = Guards()
+        self.renderer = Renderer(self.options['render-max-items'],
+                                 self.options['render-max-depth'],
+                                 self.options['render-max-width'])
+        self.disas_failed = False
+        self.indexed = False        # whether the disassembly has been waited for, see `wait_for_index()`
+        if self.disasm.ready.is_set():
+            # built in the foreground, e.g. for the server
+            self.index_built()
+        self.profiler = None
+        self.xref = None        # built by the first 'xref' command
+        self.cache = None       # the IndexCache of the pickle, if the index was looked up in one
+        self.search_results = None  # (description, addresses) of the last search
 
     def load(self):
+        self.setup_machine()
+
+        ### EVERYTHING BELOW THIS LINE IS CUSTOM DEBUGGER CODE ###
+        self.last_command = None
+        self.start = False
+        if self.disasm.ready.is_set():
+            self.wait_for_index()
+        try:
+            for path in self.scripts:
+                self.source(path)
+            if self.batch:
+                raise PickleDBGError("Quitting...")
+            while True:
+                frames = self.screen.frames
+                self.handle_input()
+                # anything else printed may have scrolled the last frame away
+                if self.screen.frames == frames:
+                    self.screen.invalidate()
+        except _Stop as stopinst:
+            return stopinst.value
+
+    def index_built(self) -> None:
+        """Sizes everything that depends on the number of instructions, once the disassembly is built."""
+        self.disas_failed = len(self.disasm) == 0
+        self.heatmap.resize(len(self.disasm))
+
+    def wait_for_index(self) -> None:
+        """Waits for the disassembly being built in the background, reporting its errors the first time."""
+        if self.indexed:
+            return
+        if not self.disasm.ready.is_set():
+            print(grayify("[*] Waiting for the disassembly..."))
+            self.disasm.wait()
+        self.index_built()
+        self.indexed = True
+
+        disasm = self.disasm
+        if self.payloads:
+            print(greenify(f"[+] {len(self.payloads)} embedded joblib arrays are stubbed out"))
+        if disasm.error is not None:
+            if len(disasm) == 0:
+                print(redify("[-] Error: could not disassemble pickle file, will try to continue anyway"))
+            else:
+                print(redify(f"[-] Error: disassembly stopped after {len(disasm)} instructions, will try to continue anyway"))
+            print(redify(disasm.error))
+
+    def setup_machine(self):
+        """Prepares the Pickle Machine for execution.
+
+        This is the setup half of `_Unpickler.load()`, split out so that the
+        interactive debugger and the headless tracer share it.
+        """
         if not hasattr(self, "_file_read"):
             raise UnpicklingError("Unpickler.__init__() was not called by "
                                   "%s.__init__()" % (self.__class__.__name__,))
         self._unframer = _Unframer(self._file_read, self._file_readline)
         self.read = self._unframer.read
-        self.readinto = self._unframer.readinto
+        self.readinto = self._unframer.readinto if self._file_readinto is None else self._readinto
         self.readline = self._unframer.readline
         self.metastack = []
         self.stack = []
         self.append = self.stack.append
         self.proto = 0
+        self.next_buffer = 0    # index of the out-of-band buffer NEXT_BUFFER pushes
+        # pickles like examples/sickle.pickle seek their own input through
+        # `globals().get('f')`, which they call from `load_reduce()`, so in
+        # the pickle module's globals, where `f` is bound to the input
+        pickle.f = self.input
 
-        ### EVERYTHING BELOW THIS LINE IS CUSTOM DEBUGGER CODE ###
-        self.last_command = None
-        self.start = False
-        try:
-            while True:
-                self.handle_input()
-        except _Stop as stopinst:
-            return stopinst.value
+    def _readinto(self, buf) -> int:
+        """Reads into `buf` straight from the file when not inside a frame.
+
+        `_Unframer.readinto()` always goes through `read()`, which makes an
+        intermediate copy of BYTEARRAY8 payloads.
+        """
+        if self._unframer.current_frame:
+            return self._unframer.readinto(buf)
+        n = self._file_readinto(buf)
+        if n < len(buf):
+            raise UnpicklingError("pickle exhausted before end of BYTEARRAY8")
+        return n
+
+    def tell(self) -> int:
+        """Returns the input offset of the next instruction to be read.
+
+        Inside a protocol 4+ frame the underlying file has already been read
+        past the whole frame, so the unread part of the frame is subtracted.
+        The frame is never written to, so `getvalue()` returns its bytes
+        without copying them, and is cheaper than exporting a buffer.
+        """
+        offset = self._file_tell()
+        frame = self._unframer.current_frame
+        if frame:
+            offset -= len(frame.getvalue()) - frame.tell()
+        return offset
+
+    def find_class(self, module: str, name: str):
+        stub = self.stubs.get(f"{module}.{name}")
+        if stub is not None:
+            return stub
+        return super().find_class(module, name)
+
+    def persistent_load(self, pid):
+        # the objects persistent ids refer to live outside the pickle, e.g.
+        # in the data/ directory of a PyTorch checkpoint
+        return persistent_stub(pid)
+
+    def load_next_buffer(self):
+        if self._buffers is None:
+            raise UnpicklingError("pickle stream refers to out-of-band data "
+                                  "but no *buffers* argument was given")
+        if self.next_buffer >= len(self._buffers):
+            raise UnpicklingError("not enough out-of-band buffers")
+        self.append(self._buffers[self.next_buffer])
+        self.next_buffer += 1
+
+    def load_build(self):
+        _Unpickler.load_build(self)
+        if self.payloads:
+            self.skip_payload()
+
+    def skip_payload(self) -> None:
+        """Skips the data embedded in the stream at the current offset, if any.
+
+        joblib writes each numpy array's data right after the BUILD of its
+        NumpyArrayWrapper; the object built is replaced by the payload's stub
+        and execution continues after the data.
+        """
+        pos = self.tell()
+        payload = self.payloads.get(pos)
+        if payload is not None:
+            # joblib ends the frame before writing the data
+            self._unframer.current_frame = None
+            self._file_seek(pos + payload.length)
+            self.stack[-1] = payload
 
     def handle_input(self, inp=None):
         """Handles user input for the debugger.
         
-        If ENTER is pressed without any input, the last command is repeated."""
+        The first word of the input is looked up in `command_table`, and the
+        handler found is called with the rest of the input, its case kept
+        for arguments such as breakpoint conditions and filenames. If ENTER
+        is pressed without any input, the last command is repeated."""
         # get input from the user
         if inp is None:
             try:
@@ -84,197 +281,971 @@ class DbgUnpickler(_Unpickler):
             except (EOFError, KeyboardInterrupt):
                 raise PickleDBGError("Quitting...")
 
-        # case-insensitive handling
-        inp = inp.lower().strip()
+        # the prompt is shown before the disassembly is ready, commands wait for it
+        self.wait_for_index()
 
-        if inp == "ni" or inp == "next":
-            if not self.start:
-                print(redify("[-] You must start the debugger first. Try using the 'start' command."))
-                return
+        raw = inp.strip()
+        if raw == "":
+            # repeat last command
+            if self.last_command is not None:
+                self.handle_input(self.last_command)
+            return
 
-            self.last_command = inp
+        name, _, args = raw.partition(" ")
+        handler = self.command_table.get(name.lower())
+        if handler is None:
+            print(redify("[-] Invalid command. Type 'help' for a list of available commands."))
+            return
+        if handler not in self.no_repeat:
+            self.last_command = raw
+        handler(self, args.strip())
 
-            # run the next instruction
-            key = self.read(1)
-            if not key:
-                raise EOFError
-            assert isinstance(key, (bytes, bytearray))
+        # run what is attached to the breakpoints or watchpoints execution stopped at
+        if self.stopped_by and not self.in_stop_commands:
+            self.run_stop_commands()
 
-            self.dispatch[key[0]](self)
+    def require_start(self) -> bool:
+        """Returns whether the debugger has been started, telling the user to start it if not."""
+        if not self.start:
+            print(redify("[-] You must start the debugger first. Try using the 'start' command."))
+        return self.start
 
-            # print current state
-            self.disasm_line_no += 1
-            self.print_state()
+    def do_next(self, args: str) -> None:
+        if not self.require_start():
+            return
 
-        elif inp.startswith("step "):
-            if not self.start:
-                print(redify("[-] You must start the debugger first. Try using the 'start' command."))
-                return
+        self.run(count=1)
+        self.print_stop()
 
-            self.last_command = inp
+    def do_step(self, args: str) -> None:
+        if not self.require_start():
+            return
 
-            try:
-                steps = int(inp[5:])
-            except:
-                print(redify("[-] Invalid command. Enter 'step <number>' to step through a number of instructions."))
-                return
-
-            for _ in range(steps):
-                # run the next instruction
-                key = self.read(1)
-                if not key:
-                    raise EOFError
-                assert isinstance(key, (bytes, bytearray))
+        try:
+            steps = int(args)
+        except ValueError:
+            print(redify("[-] Invalid command. Enter 'step <number>' to step through a number of instructions."))
+            return
 
-                self.dispatch[key[0]](self)
+        if steps > 0:
+            self.run(count=steps)
+        self.print_stop()
 
-                # print current state
-                self.disasm_line_no += 1
-                if self.options['step-verbose']:
-                    self.print_state()
+    def do_step_to(self, args: str) -> None:
+        if not self.require_start():
+            return
 
-            if not self.options['step-verbose']:
-                self.print_state()
+        if self.disas_failed:
+            print(redify("[-] Disassembly failed. Cannot step to a specific instruction."))
+            return
 
-        elif inp.startswith("step-to "):
-            if not self.start:
-                print(redify("[-] You must start the debugger first. Try using the 'start' command."))
-                return
+        try:
+            step_to = int(args)
+        except ValueError:
+            print(redify("[-] Invalid command. Enter 'step-to <address>' to step to a specific instruction address."))
+            return
+
+        if step_to < self.curr_addr() and not self.heatmap.loops():
+            print(redify("[-] Invalid command. You cannot step backwards."))
+            return
+
+        if self.disasm.line_of(step_to) is None:
+            print(redify("[-] Invalid command. Invalid instruction address, check the disassembly."))
+            return
+
+        if step_to != self.curr_addr():
+            self.run(until=step_to)
+        self.print_stop()
+
+    def do_continue(self, args: str) -> None:
+        if not self.require_start():
+            return
+
+        self.run()
+        self.print_stop()
+
+    def do_break(self, args: str) -> None:
+        self.add_breakpoint(args)
+
+    def do_delete(self, args: str) -> None:
+        if not args:
+            for number in list(self.breakpoints):
+                self.delete_breakpoint(number)
+            if self.watchpoints:
+                self.watchpoints.clear()
+                self.update_dispatch()
+            print(greenify("[+] Deleted all breakpoints and watchpoints"))
+            return
 
-            if self.disas_failed:
-                print(redify("[-] Disassembly failed. Cannot step to a specific instruction."))
+        try:
+            number = int(args)
+        except ValueError:
+            print(redify("[-] Invalid command. Enter 'delete [number]' to delete a breakpoint."))
+            return
+
+        if number in self.watchpoints:
+            self.delete_watchpoint(number)
+            print(greenify(f"[+] Deleted watchpoint {number}"))
+            return
+
+        if number not in self.breakpoints:
+            print(redify(f"[-] No breakpoint number {number}."))
+            return
+
+        self.delete_breakpoint(number)
+        print(greenify(f"[+] Deleted breakpoint {number}"))
+
+    def do_watch(self, args: str) -> None:
+        self.add_watchpoint(args.lower().split())
+
+    def do_info(self, args: str) -> None:
+        what, _, rest = args.lower().partition(" ")
+
+        if what in ("breakpoints", "break", "b", "watchpoints", "watch"):
+            # 'info breakpoints' lists watchpoints too, like gdb
+            watch_only = what.startswith("watch")
+            points = {} if watch_only else dict(self.breakpoints)
+            points.update(self.watchpoints)
+            if not points:
+                print("No watchpoints." if watch_only else "No breakpoints or watchpoints.")
                 return
 
-            self.last_command = inp
+            for number in sorted(points):
+                kind = "watch " if number in self.watchpoints else "break "
+                print(blueify(f"{number:<4}") + grayify(kind) + points[number].describe())
+                for line in points[number].commands:
+                    print("        " + grayify(line))
 
+        elif what == "hot":
             try:
-                step_to = int(inp[8:])
-            except:
-                print(redify("[-] Invalid command. Enter 'step-to <address>' to step to a specific instruction address."))
+                limit = int(rest) if rest.strip() else 10
+                if limit < 1:
+                    raise ValueError
+            except ValueError:
+                print(redify("[-] Invalid command. Enter 'info hot [number]' to list the most executed instructions."))
                 return
+            self.print_hot(limit)
 
-            if step_to < self.curr_addr():
-                print(redify("[-] Invalid command. You cannot step backwards."))
+        elif what == "hooks":
+            if not self.hooks:
+                print("No hooks.")
                 return
+            for number, hook in sorted(self.hooks.by_number.items()):
+                print(blueify(f"{number:<4}") + grayify("hook  ") + hook.describe())
+
+        else:
+            print(redify("[-] Invalid command. Enter 'info breakpoints', 'info watchpoints', 'info hooks' or 'info hot [number]'."))
 
-            if step_to not in self.addresses:
-                print(redify("[-] Invalid command. Invalid instruction address, check the disassembly."))
+    def do_back(self, args: str, restart: bool = False) -> None:
+        if not self.require_start():
+            return
+
+        if self._file_seek is None:
+            print(redify("[-] The pickle input is not seekable, so it cannot be replayed."))
+            return
+
+        if restart:
+            steps = self.executed
+        elif not args:
+            steps = 1
+        else:
+            try:
+                steps = int(args)
+                if steps < 1:
+                    raise ValueError
+            except ValueError:
+                print(redify("[-] Invalid command. Enter 'back [number]' to step backwards a number of instructions."))
                 return
 
-            while self.curr_addr() < step_to:
-                # run the next instruction
-                key = self.read(1)
-                if not key:
-                    raise EOFError
-                assert isinstance(key, (bytes, bytearray))
+        if self.executed == 0:
+            print(redify("[-] Already at the first instruction."))
+            return
 
-                self.dispatch[key[0]](self)
+        self.step_back(steps)
+        self.stop_reason = None
+        self.print_state()
 
-                # print current state
-                self.disasm_line_no += 1
+    def do_restart(self, args: str) -> None:
+        self.do_back(args, restart=True)
 
-                if self.options['step-verbose']:
-                    self.print_state()
+    def do_start(self, args: str) -> None:
+        if self.start:
+            print(redify("[-] Debugger already started. You must exit and restart the program again."))
+            return
 
-            if not self.options['step-verbose']:
-                self.print_state()
+        self.start = True
+        self.print_state()
 
-        elif inp == "start" or inp == "run":
-            self.last_command = inp
+    def do_profile(self, args: str) -> None:
+        self.handle_profile(args.split())
 
-            if self.start:
-                print(redify("[-] Debugger already started. You must exit and restart the program again."))
-                return
+    def do_search(self, args: str) -> None:
+        self.handle_search(args.split(None, 1))
 
-            self.start = True
-            self.print_state()
+    def do_xref(self, args: str) -> None:
+        self.handle_xref(args.lower().split())
 
-        elif inp == "":
-            # repeat last command
-            self.handle_input(self.last_command)
+    def do_export(self, args: str) -> None:
+        filename = args or "out.disasm"
+
+        print("Exporting disassembly to " + filename + "...")
 
-        elif inp[:6] == "export":
-            self.last_command = inp
+        try:
+            with open(filename, "w") as tmpfile:
+                self.disasm.export(tmpfile)
+        except:
+            print(redify("[-] Error: could not export pickle disassembly"))
+            return
 
-            filename = "out.disasm"
+        if self.disasm.error is not None:
+            print(redify("[-] Warning: disassembly stopped early: " + self.disasm.error))
 
-            if len(inp) > 6:
-                if inp[6] == " ":
-                    filename = inp[7:].strip()
+    def do_help(self, args: str) -> None:
+        arg = args.lower().split()[0] if args else 'pickledbg help'
+
+        terminal_width = get_terminal_size()[0]
+        lengths = (terminal_width - len(f' {arg} '))//2
+        print(grayify('─'*lengths)+cyanify(f' {arg} ')+grayify('─'*lengths))
+
+        if arg == 'pickledbg help':
+            print_help(terminal_width)
+
+        elif arg == 'options':
+            print_options_help(terminal_width)
+
+    def do_show(self, args: str) -> None:
+        if args.lower() != "options":
+            print(redify("[-] Invalid command. Type 'help' for a list of available commands."))
+            return
+
+        terminal_width = get_terminal_size()[0]
+        lengths = (terminal_width - len(' options '))//2
+        print(grayify('─'*lengths)+cyanify(' options ')+grayify('─'*lengths))
+        for option in self.options:
+            print(blueify(option)+": "+str(self.options[option]))
+        print(grayify('─' * terminal_width))    
+
+    def do_set(self, args: str) -> None:
+        try:
+            option, value = args.lower().split()[:2]
+        except ValueError:
+            print(redify("[-] Invalid command. Enter 'set <option> <value>' to set an option."))
+            return
+
+        if option in self.options:
+            if type(self.options[option]) == bool:
+                if value == "true":
+                    self.options[option] = True
+                elif value == "false":
+                    self.options[option] = False
                 else:
-                    print(redify("[-] Invalid command. Type 'help' for a list of available commands."))
+                    print(redify("[-] Invalid command. Enter 'set <option> <True/False>' to set this option."))
+            elif type(self.options[option]) == int:
+                try:
+                    number = int(value)
+                    if number < 0:
+                        raise ValueError
+                except ValueError:
+                    print(redify("[-] Invalid command. Enter 'set <option> <number>' with a number of 0 or more to set this option."))
                     return
+                self.options[option] = number
+            else:
+                self.options[option] = value # When adding more options, add more checks here
+
+            if option.startswith("checkpoint-"):
+                self.checkpoints.configure(self.options['checkpoint-interval'],
+                                           self.options['checkpoint-limit'])
+
+            if option.startswith("render-"):
+                self.renderer.configure(self.options['render-max-items'],
+                                        self.options['render-max-depth'],
+                                        self.options['render-max-width'])
+
+            if option.startswith("max-"):
+                self.guards.configure(self.options['max-instructions'],
+                                      self.options['max-memory-mb'],
+                                      self.options['max-container-len'],
+                                      self.executed)
+                self.update_dispatch()
+        else:
+            print(redify("[-] Invalid command. Option does not exist."))
+
+    def do_commands(self, args: str) -> None:
+        """Reads the commands to run when a breakpoint or watchpoint stops execution, up to 'end'.
 
-            print("Exporting disassembly to " + filename + "...")
+        Without a number, the commands are attached to the last breakpoint
+        or watchpoint set. The lines are read from the command file being
+        run, or from the prompt.
+        """
+        try:
+            number = int(args) if args else self.next_breakpoint - 1
+        except ValueError:
+            number = None
+        point = self.breakpoints.get(number) or self.watchpoints.get(number)
 
+        lines = []
+        while True:
             try:
-                with open(filename, "w") as tmpfile:
-                    pickletools.dis(open(sys.argv[1], "rb"), out=tmpfile)
-            except:
-                print(redify("[-] Error: could not export pickle disassembly"))
+                line = self.read_line(">")
+            except (EOFError, KeyboardInterrupt):
+                break
+            line = line.strip()
+            if line.lower() == "end":
+                break
+            if line and not line.startswith("#"):
+                lines.append(line)
+
+        if point is None:
+            print(redify("[-] Invalid command. Enter 'commands [number]' with the number of a breakpoint or watchpoint, then the commands and 'end'."))
+            return
+        point.commands = lines
+
+    def do_source(self, args: str) -> None:
+        if not args:
+            print(redify("[-] Invalid command. Enter 'source <file>' to run a command file, or a Python plugin ending in .py."))
+            return
+        self.source(args)
+
+    def do_exit(self, args: str) -> None:
+        raise PickleDBGError("Quitting...")
+
+    def run_stop_commands(self) -> None:
+        """Runs the commands attached to what stopped execution.
+
+        If one of them resumes execution and it stops again, the rest are
+        skipped and the commands of the new stop are run instead, like gdb.
+        """
+        self.in_stop_commands = True
+        try:
+            while self.stopped_by:
+                lines = [line for point in self.stopped_by for line in getattr(point, "commands", ())]
+                self.stopped_by = ()
+                for line in lines:
+                    if line.lower() == "silent":
+                        continue
+                    self.handle_input(line)
+                    if self.stopped_by:
+                        break
+        finally:
+            self.in_stop_commands = False
+
+    def source(self, path: str) -> None:
+        """Runs a command file, one command per line, or loads a Python plugin if `path` ends in .py.
+
+        Blank lines and lines starting with '#' are skipped in command files.
+        A 'commands' block in the file takes its lines from the file too.
+        """
+        if path.endswith(".py"):
+            self.load_plugin(path)
+            return
 
-        elif inp == '?' or inp.startswith('help'):
-            self.last_command = inp
+        try:
+            with open(path) as f:
+                lines = f.read().splitlines()
+        except OSError as e:
+            print(redify(f"[-] Error: could not read command file '{path}': {e.strerror}"))
+            return
+
+        remaining = iter(lines)
+        def read_line(prompt: str) -> str:
+            line = next(remaining, None)
+            if line is None:
+                raise EOFError
+            return line
 
-            try:
-                arg = inp.split()[1]
-            except:
-                arg='pickledbg help'
+        saved = self.read_line
+        self.read_line = read_line
+        try:
+            for line in remaining:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    self.handle_input(line)
+        finally:
+            self.read_line = saved
+
+    def load_plugin(self, path: str) -> None:
+        """Runs a Python plugin file.
+
+        The plugin runs with `debugger` (this DbgUnpickler), `on_opcode`,
+        `on_address` and `execute` (which runs a debugger command) in its
+        globals. Errors are reported rather than ending the session.
+        """
+        namespace = {
+            "__name__": "__pickledbg_plugin__",
+            "__file__": path,
+            "debugger": self,
+            "on_opcode": self.on_opcode,
+            "on_address": self.on_address,
+            "execute": self.handle_input,
+        }
+        try:
+            with open(path) as f:
+                code = compile(f.read(), path, "exec")
+            exec(code, namespace)
+        except OSError as e:
+            print(redify(f"[-] Error: could not read plugin '{path}': {e.strerror}"))
+        except PickleDBGError:
+            raise
+        except Exception as e:
+            print(redify(f"[-] Error: plugin '{path}' raised {type(e).__name__}: {e}"))
+
+    def on_opcode(self, opcode: str, function, after: bool = False) -> Hook:
+        """Calls `function(debugger)` on every instruction with the opcode named `opcode`.
+
+        The function is called before the instruction runs, or after it if
+        `after` is true. If it returns something true, execution stops
+        after the instruction. Only the handler of this opcode is wrapped.
+
+        Raises:
+            PickleDBGError: If the opcode is unknown or `function` is not callable.
+        """
+        name = opcode.upper()
+        code = next((byte for byte, opname in OPCODE_NAMES.items() if opname == name), None)
+        if code is None:
+            raise PickleDBGError(f"Unknown opcode '{name}'.")
+        hook = self.hooks.add(function, code=code, after=after)
+        self.update_dispatch()
+        return hook
+
+    def on_address(self, addr: int, function, after: bool = False) -> Hook:
+        """Calls `function(debugger)` whenever the instruction at address `addr` runs.
+
+        Like `on_opcode()`, but only the handler of the opcode at `addr` is
+        wrapped, and the hook is only called at that address.
+
+        Raises:
+            PickleDBGError: If there is no instruction at `addr` or `function` is not callable.
+        """
+        self.wait_for_index()
+        if self.disasm.line_of(addr) is None:
+            raise PickleDBGError("Invalid instruction address, check the disassembly.")
+        hook = self.hooks.add(function, addr=addr, after=after)
+        self.update_dispatch()
+        return hook
+
+    def remove_hook(self, hook: Hook) -> None:
+        """Removes a hook returned by `on_opcode()` or `on_address()`."""
+        self.hooks.remove(hook.number)
+        self.update_dispatch()
+
+    def run(self, count: int = None, until: int = None) -> None:
+        """Executes instructions until something stops execution.
+
+        Execution stops after `count` instructions, when the next instruction
+        is at address `until`, when a breakpoint or watchpoint hits, or when
+        a guard's limit is crossed. Without either argument this runs until
+        one of those or the pickle finishes.
+        The reason execution stopped is stored in `self.stop_reason`.
+
+        This is the hot path for stepping, so everything it needs is looked
+        up once before the loop and a breakpoint check costs a single
+        dictionary lookup per instruction.
+        """
+        read = self.read
+        dispatch = self.dispatch
+        addresses = self.addresses
+        break_addrs = self.break_addrs
+        num_addresses = len(addresses)
+        verbose = self.options['step-verbose']
+        renderer = self.renderer
+        screen = self.screen
+        checkpoints = self.checkpoints
+        guards = self.guards
+        hits = self.watch_hits
+        counts = self.heatmap.counts
+        steps = 0
+        self.stop_reason = None
+        self.stopped_by = ()
+
+        if guards.next_at is not None:
+            # a limit crossed earlier keeps stopping execution until it is raised
+            self.stop_reason = guards.check(self)
+            if self.stop_reason is not None:
+                return
+
+        while True:
+            key = read(1)
+            if not key:
+                raise EOFError
+            code = key[0]
+            line = self.disasm_line_no
+            counts[line] += 1
+            target = mutated_container(self, code) if code in CONTAINER_OPCODES else None
+            dispatch[code](self)
+            self.executed += 1
+            steps += 1
+            if target is not None:
+                # only the previews showing this container are out of date
+                renderer.touch(target)
+            if code in MUTATING_OPCODES and target is None:
+                renderer.generation += 1
+                screen.invalidate()
+                # it may have run code that moved the input
+                line = self.locate(line)
+                num_addresses = len(addresses)
+                counts = self.heatmap.counts
+            elif line + 1 < num_addresses:
+                line += 1
+            else:
+                line = self.locate(line)
+                num_addresses = len(addresses)
+                counts = self.heatmap.counts
+            self.disasm_line_no = line
 
-            terminal_width = get_terminal_size()[0]
-            lengths = (terminal_width - len(f' {arg} '))//2
-            print(grayify('─'*lengths)+cyanify(f' {arg} ')+grayify('─'*lengths))
+            if checkpoints.next_at is not None and self.executed >= checkpoints.next_at:
+                checkpoints.take(self)
 
-            if arg == 'pickledbg help':
-                print_help(terminal_width)
+            if verbose:
+                self.print_state()
+
+            if hits:
+                # the instruction that just ran triggered a watchpoint
+                for watchpoint, _ in hits:
+                    watchpoint.hits += 1
+                self.stop_reason = "; ".join(f"{w.title}: {message}" for w, message in hits)
+                self.stopped_by = [w for w, _ in hits]
+                hits.clear()
+                return
 
-            elif arg == 'options':
-                print(redify("step-verbose"))
-                print(f"When set to {blueify('true')}, the debugger will print the state of the Pickle Machine after each instruction rather than just the final state.")
-                print(f"{yellowify("Default:")} {blueify('false')}")
-                print()
-                print(grayify('─'*terminal_width))
+            if guards.next_at is not None and self.executed >= guards.next_at:
+                self.stop_reason = guards.check(self)
+                if self.stop_reason is not None:
+                    return
+
+            if steps == count:
+                return
 
+            if self.disasm_line_no < num_addresses:
+                addr = addresses[self.disasm_line_no]
+                if addr == until:
+                    return
+                if addr in break_addrs:
+                    for bp in break_addrs[addr]:
+                        if bp.should_stop(self, addr):
+                            self.stopped_by = [bp]
+                            return
 
-        elif inp == "show options":
-            self.last_command = inp
+    def replay(self, count: int) -> None:
+        """Executes `count` instructions without printing anything, checking breakpoints or calling hooks.
 
-            terminal_width = get_terminal_size()[0]
-            lengths = (terminal_width - len(' options '))//2
-            print(grayify('─'*lengths)+cyanify(' options ')+grayify('─'*lengths))
-            for option in self.options:
-                print(blueify(option)+": "+str(self.options[option]))
-            print(grayify('─' * terminal_width))    
+        They are counted in the heatmap again, since restoring the checkpoint
+        they are replayed from took the counts back to before they ran.
+        """
+        read = self.read
+        dispatch = self.dispatch
+        addresses = self.addresses
+        counts = self.heatmap.counts
+        # hooks already ran for these instructions
+        self.hooks.enabled = False
+        try:
+            for _ in range(count):
+                key = read(1)
+                if not key:
+                    raise EOFError
+                line = self.disasm_line_no
+                counts[line] += 1
+                dispatch[key[0]](self)
+                if key[0] in MUTATING_OPCODES or line + 1 >= len(addresses):
+                    self.disasm_line_no = self.locate(line)
+                    counts = self.heatmap.counts
+                else:
+                    self.disasm_line_no = line + 1
+                self.executed += 1
+        finally:
+            self.hooks.enabled = True
+        # instructions being replayed don't trigger watchpoints
+        self.watch_hits.clear()
+        self.renderer.generation += 1
+        self.screen.invalidate()
+
+    def locate(self, prev: int) -> int:
+        """Returns the index of the instruction at the current input offset, which follows instruction `prev`.
+
+        The offset only needs checking after instructions that can run code
+        from the pickle, which may seek the input, and when execution leaves
+        the disassembly; every other instruction is followed by the next one.
+        Code past the end of the disassembly is indexed when it is first
+        reached. If the offset is inside another instruction, the result is
+        `len(self.addresses)` until execution is back on an instruction.
+
+        Args:
+            prev (int): The index of the instruction that just ran.
+        """
+        addresses = self.addresses
+        pos = self.tell()
+        line = prev + 1
+        if line < len(addresses) and addresses[line] == pos:
+            return line
+
+        source = addresses[prev] if prev < len(addresses) else None
+        line = self.disasm.line_of(pos)
+        if line is None:
+            line = self.disasm.extend(pos)
+            if line is None:
+                line = len(addresses)
+            else:
+                self.heatmap.resize(len(addresses))
+                # the cross-reference index only covers the code it was built from
+                self.xref = None
+        if source is not None and line != prev + 1:
+            self.heatmap.jump(source, pos)
+        return line
+
+    def restart_machine(self) -> None:
+        """Resets the Pickle Machine to before the first instruction."""
+        self._file_seek(0)
+        self.memo = {}
+        self.setup_machine()
+        self.disasm_line_no = 0
+        self.executed = 0
+        self.heatmap.reset()
+        self.renderer.generation += 1
 
-        elif inp.startswith("set "):
-            self.last_command = inp
+    def step_back(self, count: int) -> None:
+        """Goes back `count` instructions by restoring a checkpoint and replaying forward.
 
+        Instructions between the checkpoint and the target are executed
+        again, including any side effects they have.
+        """
+        target = max(self.executed - count, 0)
+        checkpoints = self.checkpoints
+        checkpoint = checkpoints.before(target)
+        if checkpoint is None:
+            self.restart_machine()
+        else:
+            checkpoint.restore(self)
+        # checkpoints grow further apart with the state, so leave one close to
+        # the target for going back again from there
+        near = target - checkpoints.interval
+        if checkpoints.interval and near - self.executed > checkpoints.interval:
+            self.replay(near - self.executed)
+            checkpoints.take(self)
+        self.replay(target - self.executed)
+
+    def handle_profile(self, args: list[str]) -> None:
+        """Handles the `profile` subcommands: on, off, show [n], save [filename] and reset."""
+        action = args[0].lower() if args else "show"
+
+        if action == "on":
+            if self.profiler is None or self.profiler.memory != self.options['profile-memory']:
+                if self.profiler is not None:
+                    self.profiler.stop()
+                from profiler import Profiler
+                self.profiler = Profiler(self, self.options['profile-memory'])
+            self.profiler.start()
+            print(greenify("[+] Profiling enabled. Instructions executed from now on are timed."))
+
+        elif action == "off":
+            if self.profiler is not None:
+                self.profiler.stop()
+            print(greenify("[+] Profiling disabled."))
+
+        elif action == "reset":
+            if self.profiler is not None:
+                self.profiler.reset()
+
+        elif self.profiler is None or not self.profiler.sites:
+            print(redify("[-] Nothing has been profiled yet. Use 'profile on' and run some instructions."))
+
+        elif action == "show":
             try:
-                option = inp[4:].split(" ")[0]
-                value = inp[4:].split(" ")[1]
-            except:
-                print(redify("[-] Invalid command. Enter 'set <option> <value>' to set an option."))
+                limit = int(args[1]) if len(args) > 1 else 20
+            except ValueError:
+                print(redify("[-] Invalid command. Enter 'profile show [number]'."))
                 return
+            for line in self.profiler.report(limit):
+                print(line)
+
+        elif action == "save":
+            filename = args[1] if len(args) > 1 else "profile.json"
+            print("Saving profile to " + filename + "...")
+            try:
+                with open(filename, "w") as tmpfile:
+                    self.profiler.save(tmpfile)
+            except OSError:
+                print(redify("[-] Error: could not save profile"))
+
+        else:
+            print(redify("[-] Invalid command. Enter 'profile on', 'profile off', 'profile show [number]', 'profile save [filename]' or 'profile reset'."))
+
+    def handle_search(self, args: list[str]) -> None:
+        """Handles the `search` subcommands: opcode <NAME>, string <text> and bytes <hex>.
 
-            if option in self.options:
-                if type(self.options[option]) == bool:
-                    if value == "true":
-                        self.options[option] = True
-                    elif value == "false":
-                        self.options[option] = False
-                    else:
-                        print(redify("[-] Invalid command. Enter 'set <option> <True/False>' to set this option."))
+        The opcode index or the raw pickle is searched, never the rendered
+        disassembly. The matching addresses are remembered for `break search`.
+        """
+        usage = "[-] Invalid command. Enter 'search opcode <NAME>', 'search string <text>' or 'search bytes <hex>'."
+        if len(args) != 2:
+            print(redify(usage))
+            return
+        kind, pattern = args[0].lower(), args[1].strip()
+
+        if self.disas_failed:
+            print(redify("[-] Disassembly failed. Cannot search instructions."))
+            return
+
+        if kind == "opcode":
+            name = pattern.upper()
+            code = next((byte for byte, opname in OPCODE_NAMES.items() if opname == name), None)
+            if code is None:
+                print(redify(f"[-] Invalid command. Unknown opcode '{name}'."))
+                return
+            lines = self.disasm.opcode_lines(code)
+            description = f"opcode {name}"
+
+        elif kind == "string" or kind == "bytes":
+            try:
+                if kind == "bytes":
+                    needle = bytes.fromhex(pattern)
+                elif len(pattern) >= 2 and pattern[0] == pattern[-1] and pattern[0] in "'\"":
+                    # quoted strings may use Python escapes
+                    import ast
+                    needle = ast.literal_eval(pattern)
+                    needle = needle.encode('utf-8') if isinstance(needle, str) else needle
                 else:
-                    self.options[option] = value # When adding more options, add more checks here
+                    needle = pattern.encode('utf-8')
+            except (ValueError, SyntaxError):
+                print(redify(f"[-] Invalid command. Could not parse {kind} '{pattern}'."))
+                return
+            if not needle:
+                print(redify(usage))
+                return
+            lines = self.disasm.find(needle)
+            description = f"{kind} {pattern}"
+
+        else:
+            print(redify(usage))
+            return
+
+        addresses = [self.addresses[i] for i in lines]
+        self.search_results = (description, addresses)
+        print(greenify(f"[+] {len(addresses)} match{'es' if len(addresses) != 1 else ''} for {description}"))
+        self.print_lines("Matches:", lines)
+        if addresses:
+            print(grayify("Use 'step-to <address>' to run to a match or 'break search' to break on all of them."))
+
+    def handle_xref(self, args: list[str]) -> None:
+        """Handles the `xref` subcommands: memo <index> and addr <address>."""
+        if len(args) != 2 or args[0] not in ("memo", "addr") or not args[1].isdigit():
+            print(redify("[-] Invalid command. Enter 'xref memo <index>' or 'xref addr <address>'."))
+            return
+
+        if self.disas_failed:
+            print(redify("[-] Disassembly failed. Cannot cross-reference instructions."))
+            return
+
+        if self.xref is None:
+            if self.cache is not None:
+                self.xref = self.cache.load_xref(self.disasm)
+            if self.xref is None:
+                from xref import CrossReference
+                self.xref = CrossReference(self.disasm)
+                if self.cache is not None:
+                    self.cache.save_xref(self.xref)
+
+        if args[0] == "memo":
+            slot = int(args[1])
+            self.print_lines(f"Memo slot {slot} written by:", self.xref.memo_writers(slot))
+            self.print_lines(f"Memo slot {slot} read by:", self.xref.memo_readers(slot))
+            return
+
+        i = self.disasm.line_of(int(args[1]))
+        if i is None:
+            print(redify("[-] Invalid command. Invalid instruction address, check the disassembly."))
+            return
+        print(greenify(' ➤ '+self.disasm.line(i)))
+        self.print_lines("Uses values pushed by:", self.xref.uses(i))
+        self.print_lines("Pushes values used by:", self.xref.users(i))
+
+    def print_lines(self, title: str, lines, limit: int = 50) -> None:
+        """Prints a heading and the disassembly of up to `limit` instructions."""
+        print(yellowify(title) + ("" if lines else " (none)"))
+        for i in lines[:limit]:
+            print('   '+self.disasm.line(i))
+        if len(lines) > limit:
+            print(grayify(f"   ... and {len(lines) - limit} more"))
+
+    def print_hot(self, limit: int) -> None:
+        """Prints the `limit` most executed instructions and the loops formed by backward jumps."""
+        hottest = self.heatmap.hottest(limit)
+        print(yellowify("Most executed:") + ("" if hottest else " (none)"))
+        for i, count in hottest:
+            print(blueify(f"{count:>10}x ") + self.disasm.line(i))
+        outside = self.heatmap.counts[len(self.addresses)]
+        if outside:
+            print(grayify(f"{outside:>10}x outside the disassembly"))
+
+        loops = self.heatmap.loops()
+        print(yellowify("Loops:") + ("" if loops else " (none)"))
+        for first, last, count in loops[:limit]:
+            body = ""
+            start, end = self.disasm.line_of(first), self.disasm.line_of(last)
+            if start is not None and end is not None:
+                body = grayify(f" ({end - start + 1} instructions)")
+            print(blueify(f"{count:>10}x ") + f"{last} -> {first}" + body)
+
+    def print_stop(self) -> None:
+        """Prints the Pickle Machine state after `run()` returns, plus why it stopped.
+
+        Nothing is printed if what stopped execution has commands starting with 'silent'.
+        """
+        if any(getattr(point, "commands", [None])[:1] == ["silent"] for point in self.stopped_by):
+            return
+        if not self.options['step-verbose'] or self.stop_reason is not None:
+            self.print_state()
+        if self.stop_reason is not None:
+            print(yellowify("[*] " + self.stop_reason))
+
+    def add_breakpoint(self, spec: str) -> None:
+        """Parses a breakpoint specification and sets the breakpoint.
+
+        Args:
+            spec (str): '<address> [if <condition>]', 'opcode <NAME> [if <condition>]'
+                or 'search [if <condition>]'.
+        """
+        location, _, condition = spec.partition(" if ")
+        location = location.split()
+        condition = condition.strip() or None
+
+        try:
+            if len(location) == 1 and location[0].lower() == "search":
+                bp = self.set_breakpoint(search=True, condition=condition)
+            elif len(location) == 1:
+                try:
+                    addr = int(location[0])
+                except ValueError:
+                    raise PickleDBGError("Invalid command. Invalid instruction address, check the disassembly.")
+                bp = self.set_breakpoint(addr=addr, condition=condition)
+            elif len(location) == 2 and location[0].lower() == "opcode":
+                bp = self.set_breakpoint(opcode=location[1], condition=condition)
             else:
-                print(redify("[-] Invalid command. Option does not exist."))
+                raise PickleDBGError("Invalid command. Enter 'break <address> [if <condition>]', 'break opcode <NAME> [if <condition>]' or 'break search [if <condition>]'.")
+        except PickleDBGError as e:
+            print(redify("[-] " + str(e)))
+            return
 
+        print(greenify(f"[+] Breakpoint {bp.number} at ") + bp.describe())
 
-        elif inp == "exit" or inp == "quit":
-            raise PickleDBGError("Quitting...")
+    def set_breakpoint(self, addr: int = None, opcode: str = None, condition: str = None,
+                       search: bool = False) -> Breakpoint:
+        """Sets a breakpoint on an address, on every instruction with an opcode or on every match of the last search.
 
+        Exactly one of `addr`, `opcode` and `search` must be given.
+
+        Raises:
+            PickleDBGError: If the location or the condition is invalid.
+        """
+        if (addr is not None) + (opcode is not None) + bool(search) != 1:
+            raise PickleDBGError("A breakpoint needs exactly one of an address, an opcode or 'search'.")
+
+        if self.disas_failed:
+            raise PickleDBGError("Disassembly failed. Cannot set breakpoints.")
+
+        description = None
+        if addr is not None:
+            if self.disasm.line_of(addr) is None:
+                raise PickleDBGError("Invalid command. Invalid instruction address, check the disassembly.")
+            addresses = [addr]
+        elif opcode is not None:
+            opcode = opcode.upper()
+            if opcode not in OPCODE_NAMES.values():
+                raise PickleDBGError(f"Invalid command. Unknown opcode '{opcode}'.")
+            code = next(byte for byte, name in OPCODE_NAMES.items() if name == opcode)
+            addresses = [self.addresses[i] for i in self.disasm.opcode_lines(code)]
         else:
-            print(redify("[-] Invalid command. Type 'help' for a list of available commands."))
+            if not self.search_results or not self.search_results[1]:
+                raise PickleDBGError("The last search found nothing. Try using the 'search' command first.")
+            description, addresses = self.search_results
+
+        bp = Breakpoint(self.next_breakpoint, addresses, opcode, condition, description)
+        self.breakpoints[bp.number] = bp
+        for addr in addresses:
+            self.break_addrs.setdefault(addr, []).append(bp)
+        self.next_breakpoint += 1
+        return bp
+
+    def add_watchpoint(self, args: list[str]) -> None:
+        """Parses a watchpoint specification and sets the watchpoint.
+
+        Args:
+            args (list[str]): ['memo', <slot>], ['stack-depth', <comparison>, <limit>] or ['obj', <slot>].
+        """
+        kind = args[0].lower() if args else ""
+        try:
+            if kind in ("memo", "obj") and len(args) == 2:
+                watchpoint = self.set_watchpoint(kind, slot=int(args[1]))
+            elif kind == "stack-depth" and len(args) == 3:
+                watchpoint = self.set_watchpoint(kind, comparison=args[1], limit=int(args[2]))
+            elif kind == "stack-depth" and len(args) == 2:
+                # 'watch stack-depth >1000'
+                comparison = args[1].rstrip("0123456789")
+                watchpoint = self.set_watchpoint(kind, comparison=comparison, limit=int(args[1][len(comparison):]))
+            else:
+                raise ValueError
+        except (ValueError, PickleDBGError):
+            print(redify("[-] Invalid command. Enter 'watch memo <index>', 'watch stack-depth <comparison> <number>' or 'watch obj <memo index>'."))
+            return
+
+        print(greenify(f"[+] Watchpoint {watchpoint.number}: ") + watchpoint.describe())
+
+    def set_watchpoint(self, kind: str, slot: int = None, comparison: str = None, limit: int = None):
+        """Sets a 'memo' or 'obj' watchpoint on a memo slot, or a 'stack-depth' watchpoint.
+
+        Raises:
+            PickleDBGError: If the kind or its arguments are invalid.
+        """
+        number = self.next_breakpoint
+        if kind in ("memo", "obj") and isinstance(slot, int):
+            watchpoint = (MemoWatch if kind == "memo" else ObjectWatch)(number, slot)
+        elif kind == "stack-depth" and isinstance(limit, int):
+            watchpoint = DepthWatch(number, comparison, limit)
+        else:
+            raise PickleDBGError("A watchpoint is 'memo' or 'obj' with a memo slot, or 'stack-depth' with a comparison and a limit.")
+
+        self.watchpoints[number] = watchpoint
+        self.next_breakpoint += 1
+        self.update_dispatch()
+        return watchpoint
+
+    def update_dispatch(self) -> None:
+        """Instruments the dispatch table for the current hooks, watchpoints and guards.
+
+        Only the handlers of hooked opcodes and of opcodes that can trigger
+        a watchpoint or break a guard at once are wrapped; with none of
+        them, the class's dispatch table is used directly. A running
+        profiler is re-wrapped around the new table.
+        """
+        profiling = self.profiler is not None and self.profiler.running
+        if profiling:
+            self.profiler.stop()
+        dispatch = type(self).dispatch
+        if self.hooks:
+            dispatch = instrument_hooks(dispatch, self.hooks, self.disasm, self.watch_hits)
+        if self.watchpoints:
+            dispatch = instrument(dispatch, list(self.watchpoints.values()), self.watch_hits)
+        if self.guards.max_container_len or self.guards.max_memory_mb:
+            dispatch = instrument_guards(dispatch, self.guards, self.watch_hits)
+        if dispatch is not type(self).dispatch:
+            self.dispatch = dispatch
+        else:
+            self.__dict__.pop('dispatch', None)
+        if profiling:
+            self.profiler.start()
+
+    def delete_watchpoint(self, number: int) -> None:
+        """Removes a watchpoint by number."""
+        del self.watchpoints[number]
+        self.update_dispatch()
+
+    def delete_breakpoint(self, number: int) -> None:
+        """Removes a breakpoint by number."""
+        bp = self.breakpoints.pop(number)
+        for addr in bp.addresses:
+            remaining = [other for other in self.break_addrs[addr] if other is not bp]
+            if remaining:
+                self.break_addrs[addr] = remaining
+            else:
+                del self.break_addrs[addr]
 
     def print_state(self):
         """Prints the current state of the Pickle Machine.
@@ -285,78 +1256,380 @@ class DbgUnpickler(_Unpickler):
         including the current instruction and 3 instructions before and after
         it.
 
-        All information is printed after a `clear -x` command to move the data
-        to the top of the terminal windows, *without* clearing the history.
+        The frame is drawn at the top of the terminal by `self.screen`, which
+        only rewrites the lines that changed since the previous frame.
         """
-        system('clear -x')
+        terminal_width = self.screen.width()
+        lines = []
 
         ### STACK & MEMO ###
-        terminal_width = get_terminal_size()[0]
-        print(header('stack & memo', terminal_width))
-        print(blueify("stack     ")+": ", colorize_array(self.stack))
+        lines.append(header('stack & memo', terminal_width))
+        self.renderer.memo = self.memo
+        lines.append(blueify("stack     ")+":  "+self.renderer.render_items(self.stack))
         if self.metastack != []: 
-            print(blueify("metastack ")+": ", colorize_array(self.metastack))
-        print(blueify("memo      ")+": ", colorize_dict(self.memo))
+            lines.append(blueify("metastack ")+":  "+self.renderer.render_items(self.metastack))
+        lines.append(blueify("memo      ")+":  "+self.renderer.render_mapping(self.memo))
+        self.renderer.end_frame()
 
         ### DISASSEMBLY ###
-        print(header('disassembly', terminal_width))
+        lines.append(header('disassembly', terminal_width))
+
+        line_no = self.disasm_line_no
+        num_lines = len(self.disasm)
+        # once the pickle has jumped, show how often each instruction ran
+        counts = self.heatmap.counts if self.heatmap.jumps else None
+        heat = lambda i: (yellowify if counts[i] > 1 else grayify)(f"{counts[i]:>8}x ") if counts else ""
+        if line_no < num_lines:
+            # up to 3 previous instructions, the current one and up to 3 next ones
+            for i in range(max(0,line_no-3), line_no):
+                lines.append('   '+heat(i)+grayify(self.disasm.line(i)))
+            lines.append(greenify(' ➤ ')+heat(line_no)+greenify(self.disasm.line(line_no)))
+            for i in range(line_no+1, min(line_no+4, num_lines)):
+                lines.append('   '+heat(i)+self.disasm.line(i))
+        elif num_lines and self.start:
+            lines.append(redify(f"[-] Execution is at offset {self.tell()}, inside another instruction of the disassembly"))
+        else:
+            lines.append(redify("[-] Error: could not print disassembly"))
 
-        try:
-            # get up to 3 previous instructions
-            tmp = '\n   '.join(self.pickle_disasm[max(0,self.disasm_line_no-3):self.disasm_line_no])
-            if tmp != '':
-                print('   '+grayify(tmp))
+        # footer
+        lines.append(grayify('─'*terminal_width))
+
+        self.screen.draw(lines)
+
+    dispatch = dict(_Unpickler.dispatch)
+    dispatch[b'\x97'[0]] = load_next_buffer
+    dispatch[b'b'[0]] = load_build
+
+    # command name -> handler called with the rest of the input
+    command_table = {
+        'ni': do_next, 'next': do_next,
+        'step': do_step,
+        'step-to': do_step_to,
+        'continue': do_continue, 'c': do_continue,
+        'break': do_break, 'b': do_break,
+        'delete': do_delete,
+        'watch': do_watch,
+        'info': do_info,
+        'back': do_back,
+        'restart': do_restart,
+        'start': do_start, 'run': do_start,
+        'profile': do_profile,
+        'search': do_search,
+        'xref': do_xref,
+        'export': do_export,
+        'help': do_help, '?': do_help,
+        'show': do_show,
+        'set': do_set,
+        'commands': do_commands,
+        'source': do_source,
+        'exit': do_exit, 'quit': do_exit,
+    }
+    # commands that ENTER doesn't repeat
+    no_repeat = frozenset((do_commands, do_source))
 
-            # print current instruction
-            print(greenify(' ➤ '+self.pickle_disasm[self.disasm_line_no]))
 
-            # print up to 3 next instructions
-            tmp = '\n   '.join(self.pickle_disasm[self.disasm_line_no+1:self.disasm_line_no+4])
-            if tmp != '':
-                print('   '+tmp)
-        except IndexError:
-            print(redify("[-] Error: could not print disassembly"))
 
-        # footer
-        print(grayify(''.join(['─' for _ in range(terminal_width)])))
+### MAIN ###
+def mutated_container(unpickler, code: int):
+    """Returns the container the next instruction changes, if it can do so without running code.
+
+    Called before one of `CONTAINER_OPCODES` runs. The instruction only
+    calls the container's own methods when it is a plain list, dict or set,
+    and hashing the new keys only runs code from the pickle when they are
+    instances of its classes, so anything else returns None.
+    """
+    stack = unpickler.stack
+    try:
+        if code == APPEND[0]:
+            target = stack[-2]
+            return target if type(target) is list else None
+        if code == SETITEM[0]:
+            target = stack[-3]
+            return target if type(target) is dict and type(stack[-2]) in PLAIN_KEYS else None
+        target = unpickler.metastack[-1][-1]
+    except IndexError:
+        return None
+    if code == APPENDS[0]:
+        return target if type(target) is list else None
+    if code == SETITEMS[0]:
+        keys, kind = stack[::2], dict
+    else:
+        keys, kind = stack, set
+    if type(target) is not kind:
+        return None
+    for key in keys:
+        if type(key) not in PLAIN_KEYS:
+            return None
+    return target
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    """Parses the command-line arguments."""
+    parser = argparse.ArgumentParser(
+        prog="pickledbg",
+        description="A GDB+GEF-style debugger, where pickles are unpacked instruction by instruction",
+        epilog="To summarize a pickle without running it, see 'pickledbg summary -h'. "
+               "To triage many pickles at once, see 'pickledbg scan -h'. "
+               "To step through a trace written by --record, see 'pickledbg replay -h'. "
+               "To compare the pure-Python and C unpicklers, see 'pickledbg diff -h'.")
+    parser.add_argument("picklefile",
+                        help="the pickle file to debug, a PyTorch checkpoint, joblib dump or compressed file containing one, or '-' for stdin")
+    parser.add_argument("--member", metavar="NAME",
+                        help="the pickle to debug inside a zip archive, by default its data.pkl")
+    parser.add_argument("--buffer", metavar="N=FILE", action="append", default=[],
+                        help="memory-map FILE as protocol 5 out-of-band buffer N (counting from 0), for NEXT_BUFFER; may be repeated")
+    parser.add_argument("-x", "--command", dest="scripts", metavar="FILE", action="append", default=[],
+                        help="run the debugger commands in FILE, or load it as a Python plugin if it ends in .py, before showing the prompt; may be repeated")
+    parser.add_argument("--batch", action="store_true",
+                        help="quit after running the -x files instead of showing the prompt")
+    headless = parser.add_mutually_exclusive_group()
+    headless.add_argument("--trace", metavar="OUT",
+                          help="run without the interactive prompt and write one JSON record per instruction to OUT ('-' for stdout)")
+    headless.add_argument("--profile", metavar="OUT",
+                          help="run without the interactive prompt, print the time and memory used per opcode and per address, and write them as JSON to OUT ('-' for stdout)")
+    headless.add_argument("--record", metavar="OUT",
+                          help="run without the interactive prompt and write a compact binary trace to OUT, for 'pickledbg replay'")
+    headless.add_argument("--serve", metavar="ADDRESS",
+                          help="instead of the interactive prompt, serve a JSON-RPC debugging API on a local socket, e.g. 'unix:/tmp/pdbg.sock'")
+    parser.add_argument("--no-profile-memory", dest="profile_memory", action="store_false",
+                        help="with --profile, only measure time, which is several times faster than also tracking allocations")
+    parser.add_argument("--cache-dir", metavar="DIR",
+                        help="where indexes of large pickles are cached between runs (default: $PICKLEDBG_CACHE_DIR or ~/.cache/pickledbg)")
+    parser.add_argument("--cache-size-mb", metavar="N", type=int, default=CACHE_SIZE_MB,
+                        help=f"size the cache directory is kept under by deleting the least recently used indexes, 0 to disable the cache (default: {CACHE_SIZE_MB})")
+    return parser.parse_args(argv)
+
+
+def open_buffers(specs: list[str]) -> list | None:
+    """Maps the out-of-band buffers given as 'N=FILE', in the order NEXT_BUFFER consumes them.
+
+    Returns:
+        list | None: The buffers, or None if there are none.
+    Raises:
+        OSError: If a file can't be read.
+        PickleDBGError: If the specs are malformed or don't number the buffers 0 to n-1.
+    """
+    if not specs:
+        return None
+    paths = {}
+    for spec in specs:
+        index, sep, path = spec.partition("=")
+        if not sep or not index.strip().isdigit() or not path:
+            raise PickleDBGError(f"Invalid buffer '{spec}', expected N=FILE")
+        if int(index) in paths:
+            raise PickleDBGError(f"Buffer {int(index)} given more than once")
+        paths[int(index)] = path
+    missing = [str(i) for i in range(len(paths)) if i not in paths]
+    if missing:
+        raise PickleDBGError(f"Buffers must be numbered from 0 without gaps, missing {', '.join(missing)}")
+    return [map_buffer(paths[i]) for i in range(len(paths))]
+
+
+def open_unpickler(source, disasm: Disassembly = None, buffers: list = None) -> DbgUnpickler:
+    """Returns a DbgUnpickler over `source` that stubs out whatever its container keeps outside the pickle."""
+    return DbgUnpickler(source.reader(), disasm=disasm, buffers=buffers,
+                        payloads=source.payloads, stubs=source.stubs)
+
+
+def open_cache(directory: str, size_mb: int, path: str, member: str = None):
+    """Returns the IndexCache of the pickle at `path`, or None if caching is disabled.
+
+    Pickles read from stdin aren't cached, since they are only recognized by a file's stat.
+    """
+    if size_mb <= 0 or path == "-":
+        return None
+    from cache import IndexCache, default_directory
+    return IndexCache(directory or default_directory(), size_mb << 20, path, member)
+
+
+def index_source(disasm: Disassembly, source, cache=None):
+    """Builds the index of `source`, loading it from `cache` if it is there.
+
+    The joblib arrays embedded in the pickle are found first, since the
+    index skips them; a cached index says whether there are any.
+
+    Returns:
+        A function that saves the index to `cache` if it wasn't there, to
+        call once the index is in use, or None.
+    """
+    if cache is not None and cache.load_index(disasm):
+        if disasm.skips:
+            find_arrays(source)
+        return None
+    find_arrays(source)
+    disasm.skips = source.skips
+    disasm.index()
+    if cache is not None:
+        return lambda: cache.save_index(disasm)
+    return None
+
+
+def run_trace(filename: str, out_name: str, member: str = None, buffers: list = None) -> int:
+    """Runs the pickle headlessly, writing a JSONL trace. Returns the exit code."""
+    out = sys.stdout if out_name == "-" else open(out_name, "w", buffering=1 << 20)
+    try:
+        from tracer import trace
+        source = open_source(filename, member)
+        trace(open_unpickler(source, buffers=buffers), out)
+    except Exception as e:
+        print(f"[-] Error: {type(e).__name__}: {e}", file=sys.stderr)
+        return 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
 
 
+def run_record(filename: str, out_name: str, member: str = None, buffers: list = None) -> int:
+    """Runs the pickle headlessly, writing a binary trace. Returns the exit code."""
+    from recorder import record
 
-### MAIN ###
-def main():
-    # check that pickle file is provided
-    if len(sys.argv) != 2:
-        print(f"Usage: {sys.argv[0]} <picklefile>")
-        sys.exit(1)
+    status = 0
+    try:
+        source = open_source(filename, member)
+        out = open(out_name, "wb")
+    except (OSError, PickleDBGError) as e:
+        print(f"[-] Error: {e}", file=sys.stderr)
+        return 1
+    try:
+        recorder = record(open_unpickler(source, buffers=buffers), out)
+    except Exception as e:
+        print(f"[-] Error: {type(e).__name__}: {e}", file=sys.stderr)
+        recorder = getattr(e, "recorder", None)
+        if recorder is None:
+            return 1
+        status = 1
+    finally:
+        out.close()
+    print(f"[+] Recorded {recorder.count} instructions to {out_name} ({recorder.pos} bytes)", file=sys.stderr)
+    return status
+
+
+def run_serve(filename: str, address: str, member: str = None, buffers: list = None, cache=None) -> int:
+    """Serves the debugger over JSON-RPC until a client shuts it down. Returns the exit code."""
+    from server import serve
 
-    # try to read pickle_file
     try:
-        pickle_file = open(sys.argv[1], "rb")
-    except:
-        print(redify(f"[-] Error: could not open '{sys.argv[1]}'"))
-        sys.exit(1)
+        source = open_source(filename, member, arrays=False)
+    except (OSError, PickleDBGError) as e:
+        print(f"[-] Error: {e}", file=sys.stderr)
+        return 1
+
+    disasm = Disassembly(source.data, background=True)
+    disasm.start(lambda: index_source(disasm, source, cache))
+    disasm.wait()
+    if disasm.error is not None:
+        print(f"[-] Disassembly stopped after {len(disasm)} instructions: {disasm.error}", file=sys.stderr)
+
+    try:
+        serve(open_unpickler(source, disasm, buffers), address, source.name)
+    except PickleDBGError as e:
+        print(f"[-] Error: {e}", file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
+
 
-    # get pickletools disassembly
+def run_profile(filename: str, out_name: str, memory: bool = True, member: str = None,
+                buffers: list = None) -> int:
+    """Runs the pickle headlessly under the profiler. Returns the exit code.
+
+    The report goes to stdout, or to stderr when the JSON is written to stdout.
+    """
+    from profiler import profile
+
+    status = 0
     try:
-        output = io.StringIO()
-        pickletools.dis(pickle_file, out=output)
-        pickle_disasm = output.getvalue().split('\n')[:-2]
+        source = open_source(filename, member)
+        profiler, _ = profile(open_unpickler(source, buffers=buffers), memory)
     except Exception as e:
-        print(redify("[-] Error: could not disassemble pickle file, will try to continue anyway"))
-        print(redify(str(e)))
-        pickle_disasm = []
+        print(f"[-] Error: {type(e).__name__}: {e}", file=sys.stderr)
+        profiler = getattr(e, "profiler", None)
+        if profiler is None:
+            return 1
+        status = 1
+
+    report = sys.stderr if out_name == "-" else sys.stdout
+    for line in profiler.report():
+        print(line, file=report)
 
-    # configure readline
-    readline.set_completer_delims(' ')
-    readline.set_completer(completer)
-    readline.parse_and_bind("tab: complete")
+    out = sys.stdout if out_name == "-" else open(out_name, "w")
+    try:
+        profiler.save(out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return status
+
+
+def main():
+    # subcommands that work on many files have their own arguments
+    if len(sys.argv) > 1 and sys.argv[1] == "scan":
+        from scan import main as scan_main
+        sys.exit(scan_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "summary":
+        from symbolic import main as summary_main
+        sys.exit(summary_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "replay":
+        from replay import main as replay_main
+        sys.exit(replay_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "diff":
+        from diff import main as diff_main
+        sys.exit(diff_main(sys.argv[2:]))
+
+    args = parse_args(sys.argv[1:])
+
+    try:
+        buffers = open_buffers(args.buffer)
+    except (OSError, PickleDBGError) as e:
+        print(f"[-] Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    # headless mode never touches the terminal or the disassembler
+    if args.trace is not None:
+        sys.exit(run_trace(args.picklefile, args.trace, args.member, buffers))
+    if args.profile is not None:
+        sys.exit(run_profile(args.picklefile, args.profile, args.profile_memory, args.member, buffers))
+    if args.record is not None:
+        sys.exit(run_record(args.picklefile, args.record, args.member, buffers))
+    if args.serve is not None:
+        sys.exit(run_serve(args.picklefile, args.serve, args.member, buffers,
+                           open_cache(args.cache_dir, args.cache_size_mb, args.picklefile, args.member)))
+
+    # try to map pickle_file, it is shared by the disassembler and the unpickler
+    try:
+        source = open_source(args.picklefile, args.member, arrays=False)
+    except (OSError, PickleDBGError) as e:
+        print(redify(f"[-] Error: could not open '{args.picklefile}': {e}"))
+        sys.exit(1)
+    if args.picklefile == "-" and not reattach_terminal():
+        print(redify("[-] Error: the pickle was read from stdin and there is no terminal to read commands from"))
+        sys.exit(1)
+    if source.kind != "pickle":
+        print(greenify(f"[+] Debugging {source.name} ({source.kind})"))
+
+    # index the instructions on a thread, started once everything else is
+    # set up since it competes for the GIL; the text is only decoded when
+    # displayed. Small pickles are indexed before the prompt appears, and
+    # large ones are loaded from the cache if they were indexed before.
+    def build():
+        unpickler.cache = open_cache(args.cache_dir, args.cache_size_mb, args.picklefile, args.member)
+        return index_source(disasm, source, unpickler.cache)
+    disasm = Disassembly(source.data, background=True)
+    setup_readline()
 
     try:
-        final_value = DbgUnpickler(open(sys.argv[1], "rb"), pickle_disasm=pickle_disasm).load()
-        print(greenify("\n[+] Unpickling complete. Final value: ") + cyanify(ascii(final_value)))
+        unpickler = open_unpickler(source, disasm, buffers)
+        unpickler.scripts = args.scripts
+        unpickler.batch = args.batch
+        disasm.start(build)
+        disasm.wait(INDEX_WAIT)
+        final_value = unpickler.load()
+        print(greenify("\n[+] Unpickling complete. Final value: ") + unpickler.renderer.render_value(final_value))
     except PickleDBGError as e:
         print(redify("\n[-] "+str(e)))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
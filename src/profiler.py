@@ -0,0 +1,271 @@
+###############################################################################
+#
+# Per-opcode profiler for pickledbg
+#
+# Every handler in the unpickler's dispatch table is wrapped so each executed
+# instruction records its wall time and the memory it allocated (measured
+# with tracemalloc). Costs are kept per instruction address, so the REDUCE,
+# BUILD or APPENDS sites that make a pickle slow or large can be found, and
+# are summed per opcode when reported.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import heapq, json, tracemalloc
+from array import array
+from time import perf_counter_ns
+from pickle import _Stop
+
+
+### LOCAL IMPORTS ###
+from tracer import OPCODE_NAMES
+
+
+### CLASSES ###
+class Profiler:
+    """Collects the cost of every instruction executed through `dispatch`.
+
+    For each address the profiler records the opcode, how many times the
+    instruction ran, the total and maximum wall time in nanoseconds, the net
+    number of bytes it left allocated and the largest temporary peak of
+    memory it used. The records are kept in flat arrays rather than one
+    object per address, so the garbage collector never has to walk them.
+
+    Tracking memory makes every allocation slower, so execution is several
+    times slower with it than with timing alone.
+
+    Args:
+        unpickler (DbgUnpickler): The unpickler to profile. Its `tell()` is
+            used to find the address of each instruction.
+        memory (bool): Whether to measure allocations as well as time.
+    """
+    def __init__(self, unpickler, memory: bool = True):
+        self.unpickler = unpickler
+        self.memory = memory
+        self.sites = {}         # address -> row in the arrays below
+        self.codes = bytearray()
+        self.calls = array('Q')
+        self.total_ns = array('Q')
+        self.max_ns = array('Q')
+        self.alloc = array('q')
+        self.peak = array('q')
+        self.running = False
+        self._saved_dispatch = None
+        self._started_tracemalloc = False
+
+    def _wrap(self, dispatch: dict) -> dict:
+        """Returns a copy of `dispatch` with every handler wrapped for profiling."""
+        return {code: self._wrap_handler(code, handler) for code, handler in dispatch.items()}
+
+    def _row(self, addr: int, code: int) -> int:
+        """Adds an empty record for the instruction at `addr` and returns its row."""
+        row = self.sites[addr] = len(self.codes)
+        self.codes.append(code)
+        self.calls.append(0)
+        self.total_ns.append(0)
+        self.max_ns.append(0)
+        self.alloc.append(0)
+        self.peak.append(0)
+        return row
+
+    def _wrap_handler(self, code: int, handler):
+        sites = self.sites
+        new_row = self._row
+        calls = self.calls
+        total_ns = self.total_ns
+        max_ns = self.max_ns
+        alloc = self.alloc
+        peak_alloc = self.peak
+        tell = self.unpickler.tell
+        get_traced_memory = tracemalloc.get_traced_memory
+        reset_peak = tracemalloc.reset_peak
+
+        if not self.memory:
+            def timed(unpickler):
+                # the opcode byte has already been read
+                addr = tell() - 1
+                start = perf_counter_ns()
+                try:
+                    handler(unpickler)
+                finally:
+                    elapsed = perf_counter_ns() - start
+                    row = sites.get(addr)
+                    if row is None:
+                        row = new_row(addr, code)
+                    calls[row] += 1
+                    total_ns[row] += elapsed
+                    if elapsed > max_ns[row]:
+                        max_ns[row] = elapsed
+            return timed
+
+        def profiled(unpickler):
+            addr = tell() - 1
+            before = get_traced_memory()[0]
+            reset_peak()
+            start = perf_counter_ns()
+            try:
+                handler(unpickler)
+            finally:
+                elapsed = perf_counter_ns() - start
+                current, peak = get_traced_memory()
+                row = sites.get(addr)
+                if row is None:
+                    row = new_row(addr, code)
+                calls[row] += 1
+                total_ns[row] += elapsed
+                alloc[row] += current - before
+                if elapsed > max_ns[row]:
+                    max_ns[row] = elapsed
+                if peak - before > peak_alloc[row]:
+                    peak_alloc[row] = peak - before
+        return profiled
+
+    def start(self) -> None:
+        """Makes the unpickler run through the profiled handlers.
+
+        The handlers the unpickler uses at this point are the ones wrapped,
+        so profiling composes with watchpoints, which also replace them.
+        """
+        if self.running:
+            return
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        unpickler = self.unpickler
+        self._saved_dispatch = unpickler.__dict__.get('dispatch')
+        unpickler.dispatch = self._wrap(unpickler.dispatch)
+        self.running = True
+
+    def stop(self) -> None:
+        """Makes the unpickler run through the handlers it used before `start()` again."""
+        if self.running:
+            if self._saved_dispatch is None:
+                # removing the instance attribute uncovers the class's dispatch table
+                self.unpickler.__dict__.pop('dispatch', None)
+            else:
+                self.unpickler.dispatch = self._saved_dispatch
+            self._saved_dispatch = None
+            self.running = False
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def reset(self) -> None:
+        """Forgets everything recorded so far."""
+        self.sites.clear()
+        del self.codes[:], self.calls[:], self.total_ns[:], self.max_ns[:], self.alloc[:], self.peak[:]
+
+    def opcodes(self) -> list[dict]:
+        """Returns the costs summed per opcode, most expensive first."""
+        totals = {}
+        for row, code in enumerate(self.codes):
+            entry = totals.get(code)
+            if entry is None:
+                entry = totals[code] = {"op": OPCODE_NAMES.get(code, "UNKNOWN"), "calls": 0, "total_ns": 0,
+                                        "max_ns": 0, "alloc_bytes": 0, "peak_bytes": 0}
+            entry["calls"] += self.calls[row]
+            entry["total_ns"] += self.total_ns[row]
+            entry["max_ns"] = max(entry["max_ns"], self.max_ns[row])
+            entry["alloc_bytes"] += self.alloc[row]
+            entry["peak_bytes"] = max(entry["peak_bytes"], self.peak[row])
+        return sorted(totals.values(), key=lambda entry: entry["total_ns"], reverse=True)
+
+    def addresses(self, limit: int = None) -> list[dict]:
+        """Returns the costs of the `limit` (or all) most expensive instruction addresses."""
+        total_ns = self.total_ns
+        by_cost = lambda item: total_ns[item[1]]
+        if limit is None:
+            ranked = sorted(self.sites.items(), key=by_cost, reverse=True)
+        else:
+            ranked = heapq.nlargest(limit, self.sites.items(), key=by_cost)
+        return [self._entry(addr, row) for addr, row in ranked]
+
+    def _entry(self, addr: int, row: int) -> dict:
+        return {"addr": addr, "op": OPCODE_NAMES.get(self.codes[row], "UNKNOWN"), "calls": self.calls[row],
+                "total_ns": self.total_ns[row], "max_ns": self.max_ns[row], "alloc_bytes": self.alloc[row],
+                "peak_bytes": self.peak[row]}
+
+    def report(self, limit: int = 20) -> list[str]:
+        """Returns the opcode table and the `limit` most expensive addresses as lines of text."""
+        # the allocation columns are left out when only time was measured
+        memory = self.memory
+
+        def header(label):
+            line = "%-28s %10s %12s %12s" % (label, "calls", "total ms", "max µs")
+            if memory:
+                line += " %12s %12s" % ("alloc KiB", "peak KiB")
+            return line
+
+        def row(label, entry):
+            line = "%-28s %10d %12.3f %12.1f" % (label, entry["calls"], entry["total_ns"] / 1e6, entry["max_ns"] / 1e3)
+            if memory:
+                line += " %12.1f %12.1f" % (entry["alloc_bytes"] / 1024, entry["peak_bytes"] / 1024)
+            return line
+
+        lines = ["Per opcode:", header("opcode")]
+        lines += [row(entry["op"], entry) for entry in self.opcodes()]
+        lines.append("")
+        lines.append(f"Top {limit} addresses:")
+        lines.append(header("address"))
+        lines += [row(f"{entry['addr']} {entry['op']}", entry) for entry in self.addresses(limit)]
+        return lines
+
+    def save(self, out) -> None:
+        """Writes the per-opcode and per-address costs as JSON to a text file.
+
+        Each entry is written on its own line as it is produced, so profiles
+        of pickles with millions of instructions don't need a second copy in
+        memory.
+        """
+        write = out.write
+        dumps = json.dumps
+        separator = "\n  "
+        write('{"opcodes": [')
+        for entry in self.opcodes():
+            write(separator + dumps(entry))
+            separator = ",\n  "
+        write('\n ],\n "addresses": [')
+        separator = "\n  "
+        codes, calls, total_ns, max_ns, alloc, peak = (self.codes, self.calls, self.total_ns,
+                                                       self.max_ns, self.alloc, self.peak)
+        for addr, row in sorted(self.sites.items(), key=lambda item: total_ns[item[1]], reverse=True):
+            write('%s{"addr": %d, "op": "%s", "calls": %d, "total_ns": %d, "max_ns": %d, "alloc_bytes": %d, "peak_bytes": %d}' % (
+                separator, addr, OPCODE_NAMES.get(codes[row], "UNKNOWN"), calls[row], total_ns[row],
+                max_ns[row], alloc[row], peak[row]))
+            separator = ",\n  "
+        write('\n ]}\n')
+
+
+### FUNCTIONS ###
+def profile(unpickler, memory: bool = True) -> tuple[Profiler, object]:
+    """Runs the unpickler to completion under the profiler.
+
+    Args:
+        unpickler (DbgUnpickler): A freshly constructed unpickler.
+        memory (bool): Whether to measure allocations as well as time.
+    Returns:
+        tuple[Profiler, object]: The profiler and the unpickled value. If the
+            pickle fails, the exception is re-raised with the profiler
+            attached as `profiler`, so the costs up to the failure can still
+            be reported.
+    """
+    profiler = Profiler(unpickler, memory)
+    unpickler.setup_machine()
+    profiler.start()
+
+    read = unpickler.read
+    dispatch = unpickler.dispatch
+    try:
+        while True:
+            key = read(1)
+            if not key:
+                raise EOFError
+            dispatch[key[0]](unpickler)
+    except _Stop as stopinst:
+        return profiler, stopinst.value
+    except Exception as e:
+        e.profiler = profiler
+        raise
+    finally:
+        profiler.stop()
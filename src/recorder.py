@@ -0,0 +1,455 @@
+###############################################################################
+#
+# Binary execution recorder for pickledbg
+#
+# Runs a DbgUnpickler to completion and records the effect of every
+# instruction on the Pickle Machine as compact deltas (pushes, pops, MARKs,
+# memo stores and object mutations) instead of snapshots. Keyframes of the
+# stack, metastack and memo are written to a separate section with an index,
+# so `pickledbg replay` can seek to any instruction without running the
+# pickle again.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import struct, tempfile
+from array import array
+from itertools import islice
+from pickle import _Stop, PickleBuffer
+
+
+### LOCAL IMPORTS ###
+from colors import describe_buffer
+from disasm import OPCODE_TABLE, POP
+from tracer import TracingMemo
+
+
+### CONSTANTS ###
+MAGIC = b"PDBGREC1"
+
+# File layout:
+#   MAGIC
+#   stream      one record per instruction: opcode byte, varint address delta,
+#               events, END. VERSION events describe objects as they are
+#               created or mutated, the other events change the stack,
+#               metastack and memo, which hold object ids.
+#   strings     UTF-8 text of every string in the string table
+#   keyframes   the stack, metastack and memo at some instruction boundaries
+#   indexes     raw arrays: string offsets, keyframe instruction numbers,
+#               keyframe stream offsets, keyframe offsets, the offset of the
+#               latest version of every object
+#   FOOTER
+FOOTER = struct.Struct("<QQQQQQQqq8s")
+
+# events
+END, PUSH, POPN, MARK, POP_MARK, MEMO, RESYNC, VERSION = range(8)
+
+# kinds of object versions
+(K_NONE, K_TRUE, K_FALSE, K_INT, K_FLOAT, K_STR, K_BYTES, K_BYTEARRAY, K_TEXT, K_PENDING,
+ K_LIST, K_TUPLE, K_DICT, K_SET, K_FROZENSET, K_OBJECT, K_LENGTH) = range(17)
+CONTAINER_KINDS = {list: K_LIST, tuple: K_TUPLE, dict: K_DICT, set: K_SET, frozenset: K_FROZENSET}
+
+# opcodes that mutate the object left on top of the stack
+MUTATING = frozenset(map(ord, ('a', 'e', 's', 'u', '\x90', 'b')))   # APPEND(S), SETITEM(S), ADDITEMS, BUILD
+MEMO_WRITES = frozenset(map(ord, ('\x94', 'p', 'q', 'r')))         # MEMOIZE, PUT, BINPUT, LONG_BINPUT
+
+# how much of each object is recorded
+CHILD_LIMIT = 64        # items per container
+TEXT_LIMIT = 1024       # characters per string, bytes per bytes object
+MAX_DEPTH = 4           # levels of new objects described at once
+
+# a keyframe is written once the stream has grown by KEYFRAME_RATIO times the
+# size of the previous keyframe, but at most every KEYFRAME_MIN instructions,
+# so keyframes stay a fraction of the file and a seek replays little
+KEYFRAME_MIN = 1024
+KEYFRAME_RATIO = 2
+
+
+### CLASSES ###
+class Recorder:
+    """Records the execution of an unpickler to a binary trace file.
+
+    The stack, metastack and memo are shadowed by lists and a dict of object
+    ids. Every object is described by a version when it is first seen and
+    again after an opcode mutates it, so a replay can show each object as
+    it was at any instruction. Mutations made by the callables REDUCE runs
+    are not seen.
+
+    Recorded objects are kept alive until the recording ends, so their ids
+    are never reused for other objects.
+
+    Args:
+        unpickler (DbgUnpickler): A freshly constructed unpickler.
+        out: A writable binary file object.
+    """
+    def __init__(self, unpickler, out):
+        self.unpickler = unpickler
+        self.out = out
+        self.buf = bytearray()
+        self.pos = 0                    # bytes already written to `out`
+        self.count = 0                  # instructions recorded
+        self.prev_addr = 0
+        self.result = -1                # object id of the unpickled value
+        self.error = None
+
+        self.ids = {}                   # id(obj) -> object id
+        self.objects = []               # object id -> obj
+        self.last_version = array('Q')  # object id -> offset + 1 of its latest version
+        self.children = {}              # object id -> (length, children) of its latest version
+        self.pending = set()            # object ids that are not described yet
+        self.strings = {}               # string -> index in the string table
+
+        self.stack = []
+        self.metastack = []
+        self.memo = {}
+
+        self.keyframes = tempfile.TemporaryFile()
+        self.keyframe_size = 0         # bytes in the keyframe section
+        self.last_keyframe = 0         # bytes in the last keyframe
+        self.kf_insn = array('Q')
+        self.kf_stream = array('Q')
+        self.kf_offset = array('Q')
+        self.next_keyframe = 0
+
+        self.write(MAGIC)
+
+    def write(self, data) -> None:
+        self.out.write(data)
+        self.pos += len(data)
+
+    def tell(self) -> int:
+        """Returns the offset in the file of the next byte of the stream."""
+        return self.pos + len(self.buf)
+
+    def string(self, text: str) -> int:
+        """Returns the index of `text` in the string table, adding it if needed."""
+        index = self.strings.get(text)
+        if index is None:
+            index = self.strings[text] = len(self.strings)
+        return index
+
+    def register(self, obj, depth: int = 0) -> int:
+        """Returns the object id of `obj`, describing it if it is new.
+
+        Objects nested more than MAX_DEPTH levels inside a new object are
+        left pending, and are described once they reach the stack or memo.
+        """
+        oid = self.ids.get(id(obj))
+        if oid is not None:
+            if depth == 0 and oid in self.pending:
+                self.pending.discard(oid)
+                self.describe(oid, obj, 0)
+            return oid
+
+        oid = self.ids[id(obj)] = len(self.objects)
+        self.objects.append(obj)
+        self.last_version.append(0)
+        self.describe(oid, obj, depth)
+        return oid
+
+    def describe(self, oid: int, obj, depth: int) -> None:
+        """Records a new version of object `oid`."""
+        payload = bytearray()
+        t = type(obj)
+
+        if obj is None:
+            payload.append(K_NONE)
+        elif t is bool:
+            payload.append(K_TRUE if obj else K_FALSE)
+        elif t is int and obj.bit_length() <= 4096:
+            payload.append(K_INT)
+            write_varint(payload, zigzag(obj))
+        elif t is int:
+            payload.append(K_TEXT)
+            write_varint(payload, self.string(f'<int with {obj.bit_length()} bits>'))
+        elif t is float:
+            payload.append(K_FLOAT)
+            payload += struct.pack("<d", obj)
+        elif t is str:
+            payload.append(K_STR)
+            write_varint(payload, self.string(obj[:TEXT_LIMIT]))
+            write_varint(payload, len(obj))
+        elif t is bytes or t is bytearray:
+            payload.append(K_BYTES if t is bytes else K_BYTEARRAY)
+            write_varint(payload, self.string(bytes(obj[:TEXT_LIMIT]).decode('latin-1')))
+            write_varint(payload, len(obj))
+        elif depth >= MAX_DEPTH:
+            payload.append(K_PENDING)
+            write_varint(payload, self.string(t.__name__))
+            self.pending.add(oid)
+        else:
+            base = next((base for base in CONTAINER_KINDS if isinstance(obj, base)), None)
+            state = None if base is not None else getattr(obj, '__dict__', None)
+            # instances are shown by their attributes, anything else by its repr
+            if base is None and (type(state) is not dict or not state):
+                payload.append(K_TEXT)
+                try:
+                    # out-of-band buffers are summarized, not copied into the trace
+                    text = describe_buffer(obj) if t is PickleBuffer or t is memoryview else repr(obj)
+                except Exception as e:
+                    text = f'<{t.__name__} object, repr failed: {type(e).__name__}>'
+                write_varint(payload, self.string(text[:TEXT_LIMIT]))
+            else:
+                if base is None:
+                    items, length = state.items(), len(state)
+                else:
+                    items, length = (obj.items() if base is dict else obj), len(obj)
+                children = []
+                for item in islice(items, CHILD_LIMIT):
+                    if base is None or base is dict:
+                        children.append(self.register(item[0], depth + 1))
+                        children.append(self.register(item[1], depth + 1))
+                    else:
+                        children.append(self.register(item, depth + 1))
+                children = tuple(children)
+
+                previous = self.children.get(oid)
+                if previous is not None and previous[1] == children:
+                    if previous[0] == length:
+                        return
+                    # only items past CHILD_LIMIT changed
+                    payload.append(K_LENGTH)
+                    write_varint(payload, length)
+                else:
+                    payload.append(K_OBJECT if base is None else CONTAINER_KINDS[base])
+                    write_varint(payload, 0 if t is base else self.string(t.__name__) + 1)
+                    write_varint(payload, length)
+                    write_varint(payload, len(children))
+                    for child in children:
+                        write_varint(payload, child)
+                self.children[oid] = (length, children)
+
+        buf = self.buf
+        offset = self.tell()
+        buf.append(VERSION)
+        write_varint(buf, oid)
+        write_varint(buf, self.count + 1)
+        write_varint(buf, self.last_version[oid])
+        write_varint(buf, len(payload))
+        buf += payload
+        self.last_version[oid] = offset + 1
+
+    def keyframe(self) -> None:
+        """Writes the shadowed Pickle Machine to the keyframe section.
+
+        Object ids and memo keys are written as differences from the
+        previous one, since neighbouring items were usually created together.
+        """
+        kf = bytearray()
+        write_varint(kf, self.prev_addr)
+        write_varint(kf, len(self.metastack))
+        for items in (*self.metastack, self.stack):
+            write_varint(kf, len(items))
+            prev = 0
+            for oid in items:
+                write_varint(kf, zigzag(oid - prev))
+                prev = oid
+        write_varint(kf, len(self.memo))
+        prev_key = prev = 0
+        for key, oid in self.memo.items():
+            write_varint(kf, zigzag(key - prev_key))
+            write_varint(kf, zigzag(oid - prev))
+            prev_key, prev = key, oid
+        self.kf_insn.append(self.count)
+        self.kf_stream.append(self.tell())
+        self.kf_offset.append(self.keyframe_size)
+        self.keyframes.write(kf)
+        self.keyframe_size += len(kf)
+        self.last_keyframe = len(kf)
+
+    def maybe_keyframe(self) -> None:
+        """Writes a keyframe if the stream has grown enough since the last one."""
+        if not self.kf_insn or self.tell() - self.kf_stream[-1] >= KEYFRAME_RATIO * self.last_keyframe:
+            self.keyframe()
+            self.next_keyframe = self.count + KEYFRAME_MIN
+        else:
+            self.next_keyframe = self.count + KEYFRAME_MIN // 4
+
+    def instruction(self, code: int, addr: int, depth: int, touched: list) -> None:
+        """Records the effect of the instruction that was just executed."""
+        unpickler = self.unpickler
+        stack = unpickler.stack
+        buf = self.buf
+        buf.append(code)
+        write_varint(buf, addr - self.prev_addr)
+        self.prev_addr = addr
+
+        shadow = self.stack
+        _, _, _, pops, pushes, _ = OPCODE_TABLE[code]
+        now = len(unpickler.metastack)
+        if now > depth:
+            buf.append(MARK)
+            self.metastack.append(shadow)
+            shadow = self.stack = []
+            pops = pushes = 0
+        elif now < depth:
+            buf.append(POP_MARK)
+            shadow = self.stack = self.metastack.pop()
+            if code == POP:
+                # protocol 0 pickles may POP a MARK
+                pops = pushes = 0
+
+        base = len(shadow) - pops
+        if base < 0 or len(stack) - pushes != base:
+            self.resync()
+        elif pops or pushes:
+            new = [self.register(obj) for obj in stack[base:]]
+            # items that were popped and pushed back unchanged stay put
+            kept = 0
+            while kept < pops and kept < pushes and shadow[base + kept] == new[kept]:
+                kept += 1
+            if kept < pops:
+                buf.append(POPN)
+                write_varint(buf, pops - kept)
+                del shadow[base + kept:]
+            for oid in new[kept:]:
+                buf.append(PUSH)
+                write_varint(buf, oid)
+                shadow.append(oid)
+
+        if code in MUTATING and stack:
+            obj = stack[-1]
+            oid = self.register(obj)
+            self.describe(oid, obj, 0)
+        if code in MEMO_WRITES:
+            memo = unpickler.memo
+            for key in touched:
+                # dict.get doesn't go through TracingMemo, which would add to `touched`
+                oid = self.register(memo.get(key))
+                buf.append(MEMO)
+                write_varint(buf, zigzag(key))
+                write_varint(buf, oid)
+                self.memo[key] = oid
+
+        buf.append(END)
+        self.count += 1
+        if len(buf) > 1 << 20:
+            self.write(buf)
+            del buf[:]
+
+    def resync(self) -> None:
+        """Records the whole stack, for an instruction whose effect was unexpected."""
+        stack = self.unpickler.stack
+        oids = [self.register(obj) for obj in stack]
+        self.buf.append(RESYNC)
+        write_varint(self.buf, len(oids))
+        for oid in oids:
+            write_varint(self.buf, oid)
+        self.stack = oids
+
+    def run(self) -> object:
+        """Runs the unpickler to completion, recording every instruction."""
+        unpickler = self.unpickler
+        unpickler.memo = memo = TracingMemo(unpickler.memo)
+        unpickler.setup_machine()
+
+        read = unpickler.read
+        tell = unpickler.tell
+        dispatch = unpickler.dispatch
+        metastack = unpickler.metastack
+        touched = memo.touched
+        addr = 0
+        try:
+            while True:
+                if self.count >= self.next_keyframe:
+                    self.maybe_keyframe()
+                addr = tell()
+                key = read(1)
+                if not key:
+                    raise EOFError
+                del touched[:]
+                depth = len(metastack)
+                try:
+                    dispatch[key[0]](unpickler)
+                except _Stop as stopinst:
+                    self.instruction(key[0], addr, depth, touched)
+                    self.result = self.register(stopinst.value)
+                    return stopinst.value
+                self.instruction(key[0], addr, depth, touched)
+        except Exception as e:
+            self.error = f"at position {addr}, {type(e).__name__}: {e}"
+            raise
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """Writes the string table, keyframes, indexes and footer."""
+        self.write(self.buf)
+        del self.buf[:]
+        stream_end = self.pos
+        error = -1 if self.error is None else self.string(self.error)
+
+        string_offsets = array('Q', [0])
+        for text in self.strings:
+            data = text.encode('utf-8', 'surrogatepass')
+            self.write(data)
+            string_offsets.append(string_offsets[-1] + len(data))
+
+        keyframes_start = self.pos
+        self.keyframes.seek(0)
+        while True:
+            chunk = self.keyframes.read(1 << 20)
+            if not chunk:
+                break
+            self.write(chunk)
+        self.keyframes.close()
+
+        index_start = self.pos
+        for table in (string_offsets, self.kf_insn, self.kf_stream, self.kf_offset, self.last_version):
+            self.write(table.tobytes())
+
+        self.write(FOOTER.pack(self.count, stream_end, keyframes_start, index_start,
+                               len(self.strings), len(self.kf_insn), len(self.objects),
+                               self.result, error, MAGIC))
+
+
+### FUNCTIONS ###
+def write_varint(buf: bytearray, n: int) -> None:
+    """Appends a non-negative integer as a little-endian base 128 varint."""
+    while n > 0x7f:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def read_varint(data, pos: int) -> tuple[int, int]:
+    """Returns the varint at `pos` and the position after it."""
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def zigzag(n: int) -> int:
+    """Maps signed integers to non-negative ones, small magnitudes first."""
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+
+def unzigzag(n: int) -> int:
+    return n >> 1 if not n & 1 else -(n >> 1) - 1
+
+
+def record(unpickler, out) -> Recorder:
+    """Runs the unpickler to completion, writing a binary trace of every instruction.
+
+    Args:
+        unpickler (DbgUnpickler): A freshly constructed unpickler.
+        out: A writable binary file object.
+    Returns:
+        Recorder: The recorder, with `count` instructions recorded. If the
+            pickle fails, the trace is still completed up to the failure and
+            the exception is re-raised with the recorder attached as
+            `recorder`.
+    """
+    recorder = Recorder(unpickler, out)
+    try:
+        recorder.run()
+    except Exception as e:
+        e.recorder = recorder
+        raise
+    return recorder
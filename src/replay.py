@@ -0,0 +1,565 @@
+###############################################################################
+#
+# Offline replayer for pickledbg
+#
+# `pickledbg replay trace.bin` steps forward and backward through a trace
+# written by `--record`. Any instruction is reached by loading the nearest
+# keyframe before it and applying the recorded deltas, so nothing from the
+# pickle is ever run again and no REDUCE is repeated.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import sys, mmap, struct, argparse
+from array import array
+from bisect import bisect_right
+from collections import deque
+
+
+### LOCAL IMPORTS ###
+from colors import *
+from errors import PickleDBGError
+from screen import Screen
+from tracer import OPCODE_NAMES
+from recorder import (MAGIC, FOOTER, END, PUSH, POPN, MARK, POP_MARK, MEMO, RESYNC, VERSION,
+                      K_NONE, K_TRUE, K_FALSE, K_INT, K_FLOAT, K_STR, K_BYTES, K_BYTEARRAY,
+                      K_TEXT, K_PENDING, K_LIST, K_TUPLE, K_DICT, K_SET, K_FROZENSET, K_OBJECT,
+                      K_LENGTH, read_varint, unzigzag)
+
+
+### CONSTANTS ###
+CONTAINER_TYPES = {K_LIST: list, K_TUPLE: tuple, K_DICT: dict, K_SET: set, K_FROZENSET: frozenset}
+
+# levels of nesting rebuilt for display
+MATERIALIZE_DEPTH = 8
+
+
+### CLASSES ###
+class Opaque:
+    """Stands in for an object that was recorded only as text."""
+    __slots__ = ('text',)
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def __repr__(self) -> str:
+        return self.text
+
+
+class Position:
+    """The Pickle Machine after `n` instructions, as object ids.
+
+    `offset` is where the record of instruction `n` starts in the stream
+    and `addr` is the address of the last instruction read.
+    """
+    __slots__ = ('n', 'offset', 'addr', 'stack', 'metastack', 'memo')
+
+    def __init__(self, n: int, offset: int, addr: int, stack: list, metastack: list, memo: dict):
+        self.n = n
+        self.offset = offset
+        self.addr = addr
+        self.stack = stack
+        self.metastack = metastack
+        self.memo = memo
+
+
+class TraceReader:
+    """Random access to a trace file written by `Recorder`.
+
+    The file is memory-mapped and its indexes are loaded as arrays, so
+    opening a trace doesn't read the stream.
+
+    Args:
+        path (str): The trace file.
+    """
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                data = b""
+        self.data = data
+        if len(data) < len(MAGIC) + FOOTER.size or data[:len(MAGIC)] != MAGIC or data[-len(MAGIC):] != MAGIC:
+            raise PickleDBGError(f"'{path}' is not a pickledbg trace")
+
+        (self.count, self.stream_end, self.keyframes_start, index_start, num_strings, num_keyframes,
+         num_objects, self.result, self.error, _) = FOOTER.unpack_from(data, len(data) - FOOTER.size)
+
+        tables = []
+        pos = index_start
+        for length in (num_strings + 1, num_keyframes, num_keyframes, num_keyframes, num_objects):
+            table = array('Q')
+            table.frombytes(data[pos:pos + 8 * length])
+            tables.append(table)
+            pos += 8 * length
+        self.string_offsets, self.kf_insn, self.kf_stream, self.kf_offset, self.last_version = tables
+        self.strings_start = self.stream_end
+        self._strings = {}
+        self._versions = {}
+
+    def close(self) -> None:
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def string(self, i: int) -> str:
+        """Returns entry `i` of the string table."""
+        text = self._strings.get(i)
+        if text is None:
+            start = self.strings_start + self.string_offsets[i]
+            end = self.strings_start + self.string_offsets[i+1]
+            text = self._strings[i] = self.data[start:end].decode('utf-8', 'surrogatepass')
+        return text
+
+    def keyframe(self, n: int) -> Position:
+        """Returns the Pickle Machine at the latest keyframe at or before instruction `n`."""
+        k = bisect_right(self.kf_insn, n) - 1
+        data = self.data
+        pos = self.keyframes_start + self.kf_offset[k]
+        addr, pos = read_varint(data, pos)
+        depth, pos = read_varint(data, pos)
+        frames = []
+        for _ in range(depth + 1):
+            length, pos = read_varint(data, pos)
+            frame = []
+            oid = 0
+            for _ in range(length):
+                delta, pos = read_varint(data, pos)
+                oid += unzigzag(delta)
+                frame.append(oid)
+            frames.append(frame)
+        length, pos = read_varint(data, pos)
+        memo = {}
+        key = oid = 0
+        for _ in range(length):
+            delta, pos = read_varint(data, pos)
+            key += unzigzag(delta)
+            delta, pos = read_varint(data, pos)
+            oid += unzigzag(delta)
+            memo[key] = oid
+        return Position(self.kf_insn[k], self.kf_stream[k], addr, frames.pop(), frames, memo)
+
+    def header(self, offset: int) -> tuple[int, int, int]:
+        """Returns the opcode and address delta of the record at `offset`, and where its events start."""
+        code = self.data[offset]
+        delta, pos = read_varint(self.data, offset + 1)
+        return code, delta, pos
+
+    def skip(self, pos: int) -> int:
+        """Returns the offset just past the events starting at `pos`."""
+        data = self.data
+        while True:
+            event = data[pos]
+            pos += 1
+            if event == END:
+                return pos
+            if event == PUSH or event == POPN:
+                _, pos = read_varint(data, pos)
+            elif event == MEMO:
+                _, pos = read_varint(data, pos)
+                _, pos = read_varint(data, pos)
+            elif event == RESYNC:
+                length, pos = read_varint(data, pos)
+                for _ in range(length):
+                    _, pos = read_varint(data, pos)
+            elif event == VERSION:
+                pos = self._skip_version(pos)
+
+    def _skip_version(self, pos: int) -> int:
+        data = self.data
+        for _ in range(3):
+            _, pos = read_varint(data, pos)
+        length, pos = read_varint(data, pos)
+        return pos + length
+
+    def step(self, position: Position) -> None:
+        """Applies the record of instruction `position.n` to `position`."""
+        data = self.data
+        code, delta, pos = self.header(position.offset)
+        position.addr += delta
+        stack = position.stack
+        while True:
+            event = data[pos]
+            pos += 1
+            if event == END:
+                break
+            if event == PUSH:
+                oid, pos = read_varint(data, pos)
+                stack.append(oid)
+            elif event == POPN:
+                count, pos = read_varint(data, pos)
+                del stack[len(stack) - count:]
+            elif event == MARK:
+                position.metastack.append(stack)
+                stack = []
+            elif event == POP_MARK:
+                stack = position.metastack.pop()
+            elif event == MEMO:
+                key, pos = read_varint(data, pos)
+                position.memo[unzigzag(key)], pos = read_varint(data, pos)
+            elif event == RESYNC:
+                length, pos = read_varint(data, pos)
+                stack = []
+                for _ in range(length):
+                    oid, pos = read_varint(data, pos)
+                    stack.append(oid)
+            elif event == VERSION:
+                pos = self._skip_version(pos)
+        position.stack = stack
+        position.offset = pos
+        position.n += 1
+
+    def versions(self, oid: int) -> list[tuple[int, int]]:
+        """Returns (instruction, payload offset) of every version of object `oid`, oldest first."""
+        found = self._versions.get(oid)
+        if found is None:
+            found = []
+            data = self.data
+            offset = self.last_version[oid]
+            while offset:
+                _, pos = read_varint(data, offset)       # offset + 1 skips the VERSION tag
+                insn, pos = read_varint(data, pos)
+                offset, pos = read_varint(data, pos)
+                _, pos = read_varint(data, pos)
+                found.append((insn, pos))
+            found.reverse()
+            self._versions[oid] = found
+        return found
+
+    def materialize(self, oid: int, n: int, built: dict, depth: int = 0):
+        """Rebuilds object `oid` as it was after `n` instructions, for display.
+
+        Leaves become real strings, numbers and bytes, containers become
+        containers of the same type (subclasses get a stand-in type of the
+        same name) and anything else becomes an `Opaque` with its recorded
+        text. Objects already rebuilt in this frame are taken from `built`,
+        so shared references stay shared.
+        """
+        if oid in built:
+            return built[oid]
+        if depth > MATERIALIZE_DEPTH:
+            return Opaque('…')
+
+        versions = self.versions(oid)
+        i = bisect_right(versions, (n, sys.maxsize)) - 1
+        if i < 0:
+            return Opaque('<unrecorded>')
+        data = self.data
+        pos = versions[i][1]
+        kind = data[pos]
+        length = None
+        while kind == K_LENGTH:
+            # the items are those of an earlier version
+            if length is None:
+                length, _ = read_varint(data, pos + 1)
+            i -= 1
+            pos = versions[i][1]
+            kind = data[pos]
+        pos += 1
+
+        if kind == K_NONE:
+            return None
+        if kind == K_TRUE or kind == K_FALSE:
+            return kind == K_TRUE
+        if kind == K_INT:
+            value, _ = read_varint(data, pos)
+            return unzigzag(value)
+        if kind == K_FLOAT:
+            return struct.unpack_from("<d", data, pos)[0]
+        if kind in (K_STR, K_BYTES, K_BYTEARRAY):
+            index, pos = read_varint(data, pos)
+            full, _ = read_varint(data, pos)
+            text = self.string(index)
+            if kind != K_STR:
+                text = text.encode('latin-1')
+                text = bytearray(text) if kind == K_BYTEARRAY else text
+            if full > len(text):
+                return Opaque(f'{text!r}… ({full} {"characters" if kind == K_STR else "bytes"})')
+            return text
+        if kind == K_TEXT:
+            index, _ = read_varint(data, pos)
+            return Opaque(self.string(index))
+        if kind == K_PENDING:
+            index, _ = read_varint(data, pos)
+            return Opaque(f'<{self.string(index)} …>')
+
+        name, pos = read_varint(data, pos)
+        full, pos = read_varint(data, pos)
+        if length is None:
+            length = full
+        num_children, pos = read_varint(data, pos)
+        children = []
+        for _ in range(num_children):
+            child, pos = read_varint(data, pos)
+            children.append(child)
+
+        base = CONTAINER_TYPES.get(kind, dict)
+        if name or kind == K_OBJECT:
+            t = stand_in(self.string(name - 1), base)
+        else:
+            t = base
+        more = length - (num_children // 2 if base is dict else num_children)
+
+        if base is list or base is dict or base is set:
+            value = built[oid] = t()
+            if base is dict:
+                for j in range(0, num_children, 2):
+                    key = self.materialize(children[j], n, built, depth + 1)
+                    try:
+                        value[key] = self.materialize(children[j+1], n, built, depth + 1)
+                    except TypeError:
+                        value[Opaque(repr(key))] = self.materialize(children[j+1], n, built, depth + 1)
+                if more > 0:
+                    value[Opaque('…')] = Opaque(f'{more} more')
+            else:
+                items = [self.materialize(child, n, built, depth + 1) for child in children]
+                if more > 0:
+                    items.append(Opaque(f'…{more} more'))
+                if base is list:
+                    value.extend(items)
+                else:
+                    for item in items:
+                        try:
+                            value.add(item)
+                        except TypeError:
+                            value.add(Opaque(repr(item)))
+            return value
+
+        # immutable containers can only be built once their items are
+        built[oid] = Opaque('<cycle>')
+        items = [self.materialize(child, n, built, depth + 1) for child in children]
+        if more > 0:
+            items.append(Opaque(f'…{more} more'))
+        try:
+            value = t(items)
+        except TypeError:
+            value = t(Opaque(repr(item)) for item in items)
+        built[oid] = value
+        return value
+
+
+class Replayer:
+    """An interactive prompt for scrubbing through a recorded trace.
+
+    Args:
+        reader (TraceReader): The trace.
+    """
+    def __init__(self, reader: TraceReader):
+        self.reader = reader
+        self.position = reader.keyframe(0)
+        self.previous = deque(maxlen=3)     # (address, opcode) of the last instructions
+        self.last_command = None
+        self.screen = Screen()
+        self.renderer = Renderer(50, 6, 500)
+
+    def goto(self, n: int) -> None:
+        """Moves to the Pickle Machine state after `n` instructions."""
+        reader = self.reader
+        n = min(max(n, 0), reader.count)
+        position = self.position
+        # start from a keyframe unless the current position is closer
+        start = max(n - self.previous.maxlen, 0)
+        k = bisect_right(reader.kf_insn, start) - 1
+        if not (reader.kf_insn[k] <= position.n <= n):
+            position = self.position = reader.keyframe(start)
+            self.previous.clear()
+        while position.n < n:
+            code, _, _ = reader.header(position.offset)
+            reader.step(position)
+            self.previous.append((position.addr, code))
+
+    def upcoming(self, count: int) -> list[tuple[int, int]]:
+        """Returns (address, opcode) of up to `count` instructions from the current one."""
+        reader = self.reader
+        found = []
+        offset = self.position.offset
+        addr = self.position.addr
+        for _ in range(min(count, reader.count - self.position.n)):
+            code, delta, pos = reader.header(offset)
+            addr += delta
+            found.append((addr, code))
+            offset = reader.skip(pos)
+        return found
+
+    def find_address(self, addr: int):
+        """Returns the number of the next instruction at address `addr`, or None."""
+        reader = self.reader
+        position = self.position
+        n, offset, current = position.n, position.offset, position.addr
+        while n < reader.count:
+            _, delta, pos = reader.header(offset)
+            current += delta
+            if current == addr:
+                return n
+            offset = reader.skip(pos)
+            n += 1
+        return None
+
+    def print_state(self) -> None:
+        """Prints the Pickle Machine at the current position."""
+        reader = self.reader
+        position = self.position
+        n = position.n
+        terminal_width = self.screen.width()
+        built = {}
+        renderer = self.renderer
+        renderer.generation += 1
+
+        def head(oids):
+            # a metastack frame is drawn from its first item like any list,
+            # so only those are rebuilt; when some are left out, the last
+            # shown slot says how many, since the renderer can't tell (in
+            # ASCII, as the renderer escapes the text of opaque values)
+            if not renderer.max_items or len(oids) <= renderer.max_items:
+                return [reader.materialize(oid, n, built) for oid in oids]
+            items = [reader.materialize(oid, n, built) for oid in oids[:renderer.max_items - 1]]
+            items.append(Opaque(f'...{len(oids) - len(items)} more'))
+            return items
+
+        # the stack is drawn from its top, so only that is rebuilt
+        stack = position.stack
+        hidden = max(len(stack) - renderer.max_items, 0)
+        top = [reader.materialize(oid, n, built) for oid in stack[hidden:]]
+
+        memo = dict.fromkeys(position.memo)
+        for key in list(position.memo)[-renderer.max_items:]:
+            memo[key] = reader.materialize(position.memo[key], n, built)
+
+        lines = [header('stack & memo', terminal_width)]
+        renderer.memo = memo
+        lines.append(blueify("stack     ")+":  "+renderer.render_items(top, hidden=hidden))
+        if position.metastack:
+            frames = position.metastack
+            hidden = max(len(frames) - renderer.max_items, 0)
+            lines.append(blueify("metastack ")+":  "+renderer.render_items([head(frame) for frame in frames[hidden:]],
+                                                                          hidden=hidden))
+        lines.append(blueify("memo      ")+":  "+renderer.render_mapping(memo))
+        renderer.end_frame()
+
+        lines.append(header('instructions', terminal_width))
+        for addr, code in self.previous:
+            lines.append('   '+grayify(f"{addr:5d}: {OPCODE_NAMES.get(code, 'UNKNOWN')}"))
+        upcoming = self.upcoming(4)
+        for i, (addr, code) in enumerate(upcoming):
+            line = f"{addr:5d}: {OPCODE_NAMES.get(code, 'UNKNOWN')}"
+            lines.append(greenify(' ➤ '+line) if i == 0 else '   '+line)
+        if not upcoming:
+            if reader.error >= 0:
+                lines.append(redify("[-] Unpickling failed " + reader.string(reader.error)))
+            elif reader.result >= 0:
+                lines.append(greenify("[+] Unpickling finished, the value is: ") +
+                             renderer.render_value(reader.materialize(reader.result, n, built)))
+        lines.append(grayify('─'*(terminal_width-24)) + cyanify(f" instruction {n}/{reader.count} ".rjust(24)))
+        self.screen.draw(lines)
+
+    def handle_input(self, inp: str = None) -> bool:
+        """Handles one command. Returns False when the user quits."""
+        if inp is None:
+            try:
+                inp = input(greenify("replay>  "))
+            except (EOFError, KeyboardInterrupt):
+                return False
+        inp = inp.strip().lower()
+        n = self.position.n
+
+        if inp == "":
+            if self.last_command is not None:
+                return self.handle_input(self.last_command)
+            return True
+        self.last_command = inp
+        command, _, arg = inp.partition(" ")
+
+        try:
+            value = int(arg) if arg else None
+        except ValueError:
+            print(redify("[-] Invalid command. The argument must be a number."))
+            return True
+
+        if command in ("ni", "next"):
+            self.goto(n + 1)
+        elif command == "step" and value is not None:
+            self.goto(n + value)
+        elif command == "back":
+            self.goto(n - (1 if value is None else value))
+        elif command == "goto" and value is not None:
+            self.goto(value)
+        elif command == "step-to" and value is not None:
+            found = self.find_address(value)
+            if found is None:
+                print(redify(f"[-] No instruction at address {value} after the current one."))
+                return True
+            self.goto(found)
+        elif command in ("continue", "c"):
+            self.goto(self.reader.count)
+        elif command == "restart":
+            self.goto(0)
+        elif command in ("help", "?"):
+            print_replay_help()
+            self.screen.invalidate()
+            return True
+        elif command in ("exit", "quit"):
+            return False
+        else:
+            print(redify("[-] Invalid command. Type 'help' for a list of commands."))
+            self.screen.invalidate()
+            return True
+
+        self.print_state()
+        return True
+
+
+### FUNCTIONS ###
+_stand_ins = {}
+
+def stand_in(name: str, base: type) -> type:
+    """Returns a subclass of `base` named `name`, so it is displayed like the recorded type."""
+    t = _stand_ins.get((name, base))
+    if t is None:
+        t = _stand_ins[(name, base)] = type(name, (base,), {'__hash__': object.__hash__})
+    return t
+
+
+def print_replay_help() -> None:
+    """Prints the commands of the replay prompt."""
+    commands = (
+        ("ni", "Moves forward one instruction. Aliases: next"),
+        ("step <number>", "Moves forward the given number of instructions."),
+        ("back [number]", "Moves backward the given number of instructions (default 1)."),
+        ("goto <number>", "Moves to the state after the given number of instructions."),
+        ("step-to <address>", "Moves forward to the next instruction at the given address."),
+        ("continue", "Moves to the end of the trace. Aliases: c"),
+        ("restart", "Moves to before the first instruction."),
+        ("exit", "Exits the replayer. Aliases: quit"),
+    )
+    for syntax, description in commands:
+        print(redify(syntax.ljust(20)) + description)
+
+
+def main(argv: list[str]) -> int:
+    """Runs `pickledbg replay`. Returns the exit code."""
+    parser = argparse.ArgumentParser(
+        prog="pickledbg replay",
+        description="Step forward and backward through a trace written by 'pickledbg --record', without running the pickle")
+    parser.add_argument("trace", help="the trace file")
+    parser.add_argument("--goto", type=int, default=0, metavar="N",
+                        help="start at the state after N instructions")
+    args = parser.parse_args(argv)
+
+    try:
+        reader = TraceReader(args.trace)
+    except (OSError, PickleDBGError) as e:
+        print(redify(f"[-] Error: {e}"))
+        return 1
+
+    try:
+        import readline     # line editing for input()
+    except ImportError:
+        pass
+
+    replayer = Replayer(reader)
+    replayer.goto(args.goto)
+    replayer.print_state()
+    while replayer.handle_input():
+        pass
+    reader.close()
+    return 0
@@ -0,0 +1,318 @@
+###############################################################################
+#
+# Corpus scanner for pickledbg
+#
+# `pickledbg scan <dir-or-glob>` triages many pickles at once. Each file is
+# run symbolically in a worker process by a SymbolicUnpickler, which never
+# imports or calls any global, so no code from the pickle is ever invoked.
+# Every file gets a timeout and workers
+# run under an address-space cap, so one hostile file can't stall the batch.
+# The cap is raised by the size of the file being scanned, since the file is
+# memory-mapped rather than read, and mapping it uses address space but no
+# memory of its own.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import os, sys, csv, glob, json, signal, argparse
+from time import perf_counter
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from pickletools import code2op
+
+try:
+    import resource
+except ImportError:     # not available on Windows
+    resource = None
+
+
+### LOCAL IMPORTS ###
+from containers import open_source
+from tracer import OPCODE_NAMES
+from symbolic import SymbolicUnpickler, COMPUTED
+
+
+### CONSTANTS ###
+REDUCE = ord('R')
+
+# globals that can run commands, execute code, touch files or the network or
+# import further modules when called
+DANGEROUS_MODULES = frozenset((
+    'os', 'posix', 'nt', 'subprocess', 'sys', 'shutil', 'socket', 'ctypes',
+    'importlib', 'runpy', 'code', 'codeop', 'pty', 'commands', 'webbrowser',
+    'marshal', 'pickle', '_pickle', 'dill', 'multiprocessing', 'signal',
+    'asyncio', 'platform', 'tempfile', 'pathlib', 'io', '_io', 'urllib',
+    'http', 'ftplib', 'smtplib', 'telnetlib',
+))
+DANGEROUS_GLOBALS = frozenset((
+    'builtins.eval', 'builtins.exec', 'builtins.compile', 'builtins.open',
+    'builtins.getattr', 'builtins.setattr', 'builtins.delattr', 'builtins.__import__',
+    'builtins.globals', 'builtins.locals', 'builtins.vars', 'builtins.breakpoint',
+    'builtins.input', 'builtins.help', 'builtins.apply', 'builtins.execfile',
+    '__builtin__.eval', '__builtin__.exec', '__builtin__.compile', '__builtin__.open',
+    '__builtin__.getattr', '__builtin__.__import__', '__builtin__.execfile',
+    'operator.attrgetter', 'operator.methodcaller', 'functools.partial',
+    'types.CodeType', 'types.FunctionType',
+))
+
+# globals that ordinary pickles of builtin and common types use
+KNOWN_SAFE_GLOBALS = frozenset((
+    'builtins.set', 'builtins.frozenset', 'builtins.bytearray', 'builtins.bytes',
+    'builtins.complex', 'builtins.slice', 'builtins.range', 'builtins.object',
+    'builtins.list', 'builtins.dict', 'builtins.tuple', 'builtins.int',
+    'builtins.float', 'builtins.str', 'builtins.bool', 'builtins.NotImplemented',
+    'builtins.Ellipsis',
+    '__builtin__.set', '__builtin__.frozenset', '__builtin__.bytearray',
+    '__builtin__.complex', '__builtin__.object', '__builtin__.unicode',
+    'copy_reg._reconstructor', 'copyreg._reconstructor', 'copyreg.__newobj__',
+    '_codecs.encode',
+    'collections.OrderedDict', 'collections.defaultdict', 'collections.deque',
+    'collections.Counter',
+    'datetime.datetime', 'datetime.date', 'datetime.time', 'datetime.timedelta',
+    'datetime.timezone', 'decimal.Decimal', 'fractions.Fraction', 'uuid.UUID',
+    'numpy.core.multiarray._reconstruct', 'numpy._core.multiarray._reconstruct',
+    'numpy.core.multiarray.scalar', 'numpy._core.multiarray.scalar',
+    'numpy.ndarray', 'numpy.dtype',
+))
+
+WORKER_DIED = "worker process died"
+
+CSV_FIELDS = ("path", "size", "protocol", "instructions", "reduce", "max_stack",
+              "max_marks", "globals", "opcodes", "verdict", "error", "seconds")
+
+
+### CLASSES ###
+class ScanTimeout(Exception):
+    pass
+
+
+### FUNCTIONS ###
+def verdict(targets) -> str:
+    """Classifies a pickle by the globals it refers to.
+
+    Returns "dangerous" if any global can run code or touch the system, or
+    its name was computed at runtime (which hides what it is), "suspicious"
+    if any global is not known to be harmless, otherwise "safe".
+    """
+    result = "safe"
+    for target in targets:
+        if (target in DANGEROUS_GLOBALS or COMPUTED in target
+                or target.split('.', 1)[0] in DANGEROUS_MODULES):
+            return "dangerous"
+        if target not in KNOWN_SAFE_GLOBALS:
+            result = "suspicious"
+    return result
+
+
+def _raise_timeout(signum, frame):
+    raise ScanTimeout("timed out")
+
+
+# the address-space cap of this worker process in bytes, 0 for none
+_memory_limit = 0
+
+def _init_worker(memory_mb: int) -> None:
+    """Caps the address space of a worker process and installs the timeout handler."""
+    global _memory_limit
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, "SIGALRM"):
+        signal.signal(signal.SIGALRM, _raise_timeout)
+    if resource is not None and memory_mb:
+        _memory_limit = memory_mb * 1024 * 1024
+        _set_address_space(0)
+
+
+def _set_address_space(mapped: int) -> None:
+    """Sets the soft address-space limit to the worker's cap plus `mapped` bytes.
+
+    Only the soft limit is lowered, so it can be raised again for the next
+    file. Nothing from the pickle runs in the worker, so nothing can raise
+    it in between.
+    """
+    if not _memory_limit:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = _memory_limit + mapped
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def scan_file(path: str, timeout: float = 0) -> dict:
+    """Runs one file symbolically and reports what it contains.
+
+    Args:
+        path (str): The pickle file.
+        timeout (float): Seconds before giving up on the file, 0 for no limit.
+    Returns:
+        dict: The report. If the file can't be read or unpickled, `error`
+            describes why and the rest covers the instructions run before
+            the failure.
+    """
+    report = {"path": path, "size": None, "protocol": None, "instructions": 0, "reduce": 0,
+              "max_stack": 0, "max_marks": 0, "globals": [], "opcodes": {}, "verdict": None,
+              "error": None, "seconds": 0.0}
+    source = reader = unpickler = None
+    start = perf_counter()
+
+    if timeout and hasattr(signal, "setitimer"):
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        # the file is mapped, not read, so the cap only applies to what's built from it
+        _set_address_space(os.path.getsize(path))
+        source = open_source(path)
+        report["size"] = len(source)
+        reader = source.reader()
+        unpickler = SymbolicUnpickler(reader, payloads=source.payloads)
+        unpickler.summarize()
+    except MemoryError:
+        report["error"] = "MemoryError: memory cap exceeded"
+    except Exception as e:
+        report["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        if timeout and hasattr(signal, "setitimer"):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        if reader is not None:
+            reader.close()
+        if source is not None:
+            source.close()
+        _set_address_space(0)
+
+    report["seconds"] = round(perf_counter() - start, 6)
+    if unpickler is None:
+        return report
+
+    counts = unpickler.counts
+    report["instructions"] = sum(counts)
+    report["reduce"] = counts[REDUCE]
+    report["max_stack"] = unpickler.max_stack
+    report["max_marks"] = unpickler.max_marks
+    report["opcodes"] = {OPCODE_NAMES.get(code, "UNKNOWN"): count for code, count in enumerate(counts) if count}
+    if report["opcodes"]:
+        report["protocol"] = max(code2op[chr(code)].proto for code, count in enumerate(counts)
+                                 if count and chr(code) in code2op)
+    report["globals"] = list(dict.fromkeys(unpickler.targets))
+    report["verdict"] = verdict(report["globals"])
+    return report
+
+
+def expand(patterns: list[str]) -> list[str]:
+    """Turns directories (searched recursively) and glob patterns into a sorted list of files."""
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, _, files in os.walk(pattern):
+                paths.update(os.path.join(root, name) for name in files)
+        else:
+            paths.update(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    return sorted(paths)
+
+
+def scan(paths: list[str], jobs: int = None, timeout: float = 10, memory_mb: int = 1024):
+    """Scans files in parallel worker processes, yielding a report per file as each finishes.
+
+    At most `jobs` files are handed to the pool at a time, so when a worker
+    process dies (for example, killed by the OS) the files that were
+    running are known. Each of those is scanned again on its own in a new
+    process, and reported as an error if that one dies too. The remaining
+    files carry on in a new pool.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    queue = deque(paths)
+    while queue:
+        suspects = yield from _scan_pool(queue, jobs, timeout, memory_mb)
+        for path in suspects:
+            yield _scan_alone(path, timeout, memory_mb)
+
+
+def _scan_pool(queue: deque, jobs: int, timeout: float, memory_mb: int):
+    """Scans files from `queue` in a pool of `jobs` workers until it's empty or the pool breaks.
+
+    Yields the reports, and returns the files that were running when the pool broke.
+    """
+    suspects = []
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(memory_mb,)) as pool:
+        running = {}
+        while queue or running:
+            while queue and len(running) < jobs and not suspects:
+                path = queue.popleft()
+                running[pool.submit(scan_file, path, timeout)] = path
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = running.pop(future)
+                try:
+                    yield future.result()
+                except BrokenProcessPool:
+                    # every other running file fails the same way, so each is a suspect
+                    suspects.append(path)
+    return suspects
+
+
+def _scan_alone(path: str, timeout: float, memory_mb: int) -> dict:
+    """Scans one file in a worker process of its own, so a crash can only be its fault."""
+    with ProcessPoolExecutor(max_workers=1, initializer=_init_worker, initargs=(memory_mb,)) as pool:
+        try:
+            return pool.submit(scan_file, path, timeout).result()
+        except BrokenProcessPool:
+            return {"path": path, "verdict": None, "error": WORKER_DIED}
+
+
+def write_json(reports, out) -> None:
+    """Writes the reports as a JSON list, one report per line."""
+    separator = "[\n"
+    for report in reports:
+        out.write(separator + json.dumps(report))
+        separator = ",\n"
+    out.write("[]\n" if separator == "[\n" else "\n]\n")
+
+
+def write_csv(reports, out) -> None:
+    """Writes the reports as CSV. Globals and opcode counts are joined with ';'."""
+    writer = csv.DictWriter(out, fieldnames=CSV_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    for report in reports:
+        row = dict(report)
+        row["globals"] = ";".join(report.get("globals") or ())
+        row["opcodes"] = ";".join(f"{name}={count}" for name, count in (report.get("opcodes") or {}).items())
+        writer.writerow(row)
+
+
+def main(argv: list[str]) -> int:
+    """Runs `pickledbg scan`. Returns the exit code."""
+    parser = argparse.ArgumentParser(
+        prog="pickledbg scan",
+        description="Triage many pickles in parallel without running any code from them")
+    parser.add_argument("paths", nargs="+", metavar="dir-or-glob",
+                        help="directories (searched recursively) or glob patterns of pickle files")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("-f", "--format", choices=("json", "csv"), default="json",
+                        help="report format (default: json)")
+    parser.add_argument("-o", "--output", default="-",
+                        help="report file (default: stdout)")
+    parser.add_argument("--timeout", type=float, default=10,
+                        help="seconds allowed per file, 0 for no limit (default: 10)")
+    parser.add_argument("--memory-mb", type=int, default=1024,
+                        help="address space cap per worker in MB, 0 for no limit (default: 1024)")
+    args = parser.parse_args(argv)
+
+    paths = expand(args.paths)
+    if not paths:
+        print("[-] Error: no files matched", file=sys.stderr)
+        return 1
+
+    out = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+    try:
+        reports = scan(paths, max(args.jobs, 1), args.timeout, args.memory_mb)
+        if args.format == "csv":
+            write_csv(reports, out)
+        else:
+            write_json(reports, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
@@ -0,0 +1,107 @@
+###############################################################################
+#
+# Terminal renderer for pickledbg
+#
+# Draws the Pickle Machine state using ANSI escape sequences directly instead
+# of forking `clear -x` for every frame. The previous frame is remembered so
+# only the lines that changed are rewritten.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import re, sys
+from shutil import get_terminal_size
+
+
+### CONSTANTS ###
+ANSI_RE = re.compile(r"\033\[[0-9;]*[A-Za-z]")
+
+CURSOR_HOME = "\033[H"
+CLEAR_SCREEN = "\033[2J"
+CLEAR_LINE_END = "\033[K"
+CLEAR_SCREEN_END = "\033[J"
+
+
+### FUNCTIONS ###
+def visible_len(line: str) -> int:
+    """Returns the number of terminal columns a line takes up, ignoring ANSI escapes."""
+    if "\033" in line:
+        line = ANSI_RE.sub("", line)
+    return len(line)
+
+
+### CLASSES ###
+class Screen:
+    """Draws frames of lines to the terminal, rewriting only what changed.
+
+    The frame is always drawn from the top-left corner of the terminal. When
+    the previous frame is still on screen, each line that differs from the
+    previous frame (or moved because a line above it wrapped differently) is
+    overwritten in place. Anything printed since the last frame, such as the
+    prompt, is cleared away afterwards.
+
+    Call `invalidate()` after printing anything that may have scrolled the
+    terminal so the next frame is drawn in full.
+    """
+    def __init__(self, out=None):
+        self.out = out if out is not None else sys.stdout
+        self.lines = []     # lines of the frame currently on screen
+        self.rows = []      # terminal row each of those lines starts on
+        self.size = None
+        self.valid = False
+        self.frames = 0
+
+    def invalidate(self) -> None:
+        """Forces the next frame to be drawn in full."""
+        self.valid = False
+
+    def width(self) -> int:
+        """Returns the width of the terminal in columns."""
+        return get_terminal_size().columns
+
+    def draw(self, lines: list[str]) -> None:
+        """Draws a frame, rewriting only the lines that changed since the last one.
+
+        Args:
+            lines (list[str]): The lines of the frame, without trailing newlines.
+        """
+        size = get_terminal_size()
+        columns = max(size.columns, 1)
+
+        # work out which terminal row each line starts on
+        rows = []
+        row = 1
+        for line in lines:
+            rows.append(row)
+            row += max(1, -(-visible_len(line) // columns))
+        end_row = row
+
+        # leave room below the frame for a status message and the prompt,
+        # otherwise the terminal scrolls and the old frame is no longer where
+        # we think it is
+        full = not self.valid or size != self.size or end_row + 2 > size.lines
+
+        parts = []
+        if full:
+            parts.append(CURSOR_HOME + CLEAR_SCREEN)
+            parts.append("\n".join(lines))
+            parts.append("\n")
+        else:
+            old_lines = self.lines
+            old_rows = self.rows
+            num_old = len(old_lines)
+            for i, line in enumerate(lines):
+                if i < num_old and old_rows[i] == rows[i] and old_lines[i] == line:
+                    continue
+                parts.append(f"\033[{rows[i]};1H{line}{CLEAR_LINE_END}")
+            parts.append(f"\033[{end_row};1H{CLEAR_SCREEN_END}")
+
+        self.out.write("".join(parts))
+        self.out.flush()
+
+        self.lines = lines
+        self.rows = rows
+        self.size = size
+        self.valid = True
+        self.frames += 1
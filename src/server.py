@@ -0,0 +1,422 @@
+###############################################################################
+#
+# JSON-RPC debug server for pickledbg
+#
+# `pickledbg --serve unix:/tmp/pdbg.sock file.pickle` exposes the debugger
+# over a local socket, so editors and test harnesses can drive it without
+# scraping the terminal UI. Requests and responses are JSON-RPC 2.0 objects,
+# one per line. The stack, metastack, memo and disassembly are fetched a page
+# at a time, so a round trip stays cheap however large the memo grows.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import asyncio, inspect, json, os, stat, sys
+from itertools import islice
+from pickle import _Stop
+
+
+### LOCAL IMPORTS ###
+from colors import Renderer
+from errors import PickleDBGError
+from screen import ANSI_RE
+
+
+### CONSTANTS ###
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+DEBUGGER_ERROR = -32000     # the request was understood but the debugger refused it
+
+MAX_PAGE = 1000             # most items returned by one stack, memo or disassembly request
+LINE_LIMIT = 1 << 20        # longest request line accepted, in bytes
+
+SIZED_TYPES = (list, tuple, dict, set, frozenset, str, bytes, bytearray)
+
+
+### CLASSES ###
+class DebugServer:
+    """Serves one debugging session over JSON-RPC.
+
+    Every client talks to the same unpickler. Requests are handled one at a
+    time, in the order they arrive; instructions run in a worker thread so a
+    long `continue` doesn't stop other clients from connecting. A method
+    `foo` is implemented by `rpc_foo`, and its parameters may be given by
+    name (an object) or by position (an array).
+
+    Values are returned as plain-text previews with the same budgets as the
+    terminal UI (`render-max-items`, `render-max-depth`, `render-max-width`).
+
+    Args:
+        unpickler (DbgUnpickler): The unpickler, with its machine set up.
+        name (str): The name of the pickle, reported by `info`.
+    """
+    def __init__(self, unpickler, name: str):
+        self.unpickler = unpickler
+        self.name = name
+        self.started = False
+        self.finished = False
+        self.result = None      # preview of the final value
+        self.error = None       # "<type>: <message>" if unpickling failed
+        options = unpickler.options
+        self.renderer = Renderer(options['render-max-items'], options['render-max-depth'],
+                                 options['render-max-width'])
+        self.lock = None
+        self.done = None
+
+    ### transport ###
+    async def serve_forever(self, path: str) -> None:
+        """Listens on the unix socket at `path` until a client calls `shutdown`."""
+        self.lock = asyncio.Lock()
+        self.done = asyncio.Event()
+        remove_stale_socket(path)
+        # only the user running the debugger may connect
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self.handle_client, path, limit=LINE_LIMIT)
+        finally:
+            os.umask(umask)
+        print(f"[+] Serving {self.name} on unix:{path}", file=sys.stderr)
+        try:
+            async with server:
+                await self.done.wait()
+        finally:
+            remove_stale_socket(path)
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Answers the requests of one connection, one line each, until it closes."""
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # longer than LINE_LIMIT, the rest of the stream can't be framed
+                    writer.write(encode(error_response(None, PARSE_ERROR, "Request too long")))
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                response = await self.respond(line)
+                if response is not None:
+                    writer.write(encode(response))
+                    await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            # the client went away, or the server is shutting down
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, line: bytes):
+        """Returns the response to one request line, or None if nothing is to be sent back."""
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return error_response(None, PARSE_ERROR, "Parse error")
+
+        if isinstance(request, list):
+            if not request:
+                return error_response(None, INVALID_REQUEST, "Empty batch")
+            responses = [await self.call(item) for item in request]
+            return [response for response in responses if response is not None] or None
+        return await self.call(request)
+
+    async def call(self, request):
+        """Runs one JSON-RPC request and returns its response (None for notifications)."""
+        if not isinstance(request, dict) or request.get("jsonrpc") != "2.0" \
+                or not isinstance(request.get("method"), str):
+            return error_response(request.get("id") if isinstance(request, dict) else None,
+                                  INVALID_REQUEST, "Invalid request")
+        request_id = request.get("id")
+        notification = "id" not in request
+
+        method = request["method"]
+        name = "rpc_" + method.replace("-", "_")
+        handler = getattr(self, name, None) if name.isidentifier() else None
+        if handler is None:
+            return None if notification else error_response(request_id, METHOD_NOT_FOUND, f"Unknown method '{method}'")
+
+        params = request.get("params", {})
+        try:
+            if isinstance(params, dict):
+                bound = inspect.signature(handler).bind(**params)
+            elif isinstance(params, list):
+                bound = inspect.signature(handler).bind(*params)
+            else:
+                raise TypeError("params must be an object or an array")
+        except TypeError as e:
+            return None if notification else error_response(request_id, INVALID_PARAMS, str(e))
+
+        try:
+            async with self.lock:
+                result = handler(*bound.args, **bound.kwargs)
+                if inspect.isawaitable(result):
+                    result = await result
+        except PickleDBGError as e:
+            return None if notification else error_response(request_id, DEBUGGER_ERROR, str(e))
+        except (TypeError, ValueError) as e:
+            return None if notification else error_response(request_id, INVALID_PARAMS, str(e))
+        return None if notification else {"jsonrpc": "2.0", "id": request_id, "result": result}
+
+    ### execution ###
+    async def execute(self, run, *args) -> dict:
+        """Runs `run(*args)` in a worker thread and returns the new state.
+
+        Unpickling finishing, or failing, is reported in the state rather
+        than as an error.
+        """
+        if not self.started:
+            raise PickleDBGError("The debugger has not been started. Call 'start' first.")
+        if self.finished:
+            raise PickleDBGError("Unpickling has finished. Call 'restart' or 'back' to go back.")
+        unpickler = self.unpickler
+        try:
+            await asyncio.to_thread(run, *args)
+        except _Stop as stopinst:
+            self.finished = True
+            unpickler.stop_reason = "Unpickling complete"
+            self.renderer.memo = unpickler.memo
+            self.result = self.preview(stopinst.value)
+        except Exception as e:
+            self.finished = True
+            unpickler.stop_reason = "Unpickling failed"
+            self.error = f"{type(e).__name__}: {e}"
+        return self.rpc_state()
+
+    async def rewind(self, count: int) -> dict:
+        """Goes back `count` instructions, which also leaves a finished or failed run."""
+        unpickler = self.unpickler
+        if not self.started:
+            raise PickleDBGError("The debugger has not been started. Call 'start' first.")
+        if unpickler._file_seek is None:
+            raise PickleDBGError("The pickle input is not seekable, so it cannot be replayed.")
+        if self.finished:
+            # the instruction that finished or failed changed the machine
+            # without being counted, so going back over it replays to here
+            count -= 1
+            self.finished = False
+            self.result = self.error = None
+        elif unpickler.executed == 0:
+            raise PickleDBGError("Already at the first instruction.")
+        await asyncio.to_thread(unpickler.step_back, count)
+        unpickler.stop_reason = None
+        return self.rpc_state()
+
+    ### previews ###
+    def preview(self, value) -> str:
+        """Returns the plain-text preview of a value."""
+        return ANSI_RE.sub("", self.renderer.render_value(value))
+
+    def describe(self, value) -> dict:
+        """Returns the type, length (for containers and strings) and preview of a value."""
+        entry = {"type": type(value).__name__}
+        if isinstance(value, SIZED_TYPES):
+            entry["length"] = len(value)
+        entry["preview"] = self.preview(value)
+        return entry
+
+    ### methods ###
+    def rpc_info(self) -> dict:
+        """Returns the name and size of the pickle and what the session is doing."""
+        unpickler = self.unpickler
+        return {"name": self.name, "instructions": len(unpickler.disasm),
+                "disassembly_error": unpickler.disasm.error, "started": self.started,
+                "finished": self.finished}
+
+    def rpc_start(self) -> dict:
+        """Starts the debugger before the first instruction."""
+        if self.started:
+            raise PickleDBGError("Debugger already started.")
+        self.started = True
+        return self.rpc_state()
+
+    async def rpc_step(self, count: int = 1) -> dict:
+        """Executes `count` instructions, or fewer if a breakpoint or watchpoint stops execution."""
+        if not isinstance(count, int) or count < 1:
+            raise ValueError("count must be a positive integer")
+        return await self.execute(self.unpickler.run, count)
+
+    async def rpc_step_to(self, addr: int) -> dict:
+        """Executes instructions until the one at `addr` is next."""
+        unpickler = self.unpickler
+        if unpickler.disasm.line_of(addr) is None:
+            raise PickleDBGError("Invalid instruction address, check the disassembly.")
+        if unpickler.disasm_line_no < len(unpickler.addresses):
+            if addr < unpickler.curr_addr() and not unpickler.heatmap.loops():
+                raise PickleDBGError("You cannot step backwards. Use 'back' instead.")
+            if addr == unpickler.curr_addr():
+                return self.rpc_state()
+        return await self.execute(unpickler.run, None, addr)
+
+    async def rpc_continue(self) -> dict:
+        """Executes instructions until a breakpoint or watchpoint stops execution or unpickling finishes."""
+        return await self.execute(self.unpickler.run)
+
+    async def rpc_back(self, count: int = 1) -> dict:
+        """Goes back `count` instructions by restoring a checkpoint and replaying forward."""
+        if not isinstance(count, int) or count < 1:
+            raise ValueError("count must be a positive integer")
+        return await self.rewind(count)
+
+    async def rpc_restart(self) -> dict:
+        """Goes back to before the first instruction."""
+        if self.unpickler.executed == 0 and not self.finished:
+            return self.rpc_state()
+        return await self.rewind(self.unpickler.executed + self.finished)
+
+    def rpc_state(self) -> dict:
+        """Returns where execution is, why it last stopped and the size of each storage area."""
+        unpickler = self.unpickler
+        line = unpickler.disasm_line_no
+        state = {"started": self.started, "finished": self.finished, "executed": unpickler.executed,
+                 "line": line, "addr": unpickler.addresses[line] if line < len(unpickler.addresses) else None,
+                 "instruction": ANSI_RE.sub("", unpickler.disasm.line(line)) if line < len(unpickler.disasm) else None,
+                 "stop_reason": unpickler.stop_reason, "proto": unpickler.proto,
+                 "stack_depth": len(unpickler.stack), "metastack_depth": len(unpickler.metastack),
+                 "memo_size": len(unpickler.memo)}
+        if self.result is not None:
+            state["result"] = self.result
+        if self.error is not None:
+            state["error"] = self.error
+        return state
+
+    def rpc_stack(self, level: int = 0, start: int = 0, count: int = 50) -> dict:
+        """Returns up to `count` items of a stack, from index `start` (bottom first; negative counts from the top).
+
+        Level 0 is the current stack, the items above the topmost MARK.
+        Level n is the stack that was current n MARKs ago.
+        """
+        unpickler = self.unpickler
+        if not isinstance(level, int) or not 0 <= level <= len(unpickler.metastack):
+            raise ValueError(f"level must be between 0 and {len(unpickler.metastack)}")
+        items = unpickler.stack if level == 0 else unpickler.metastack[-level]
+        start, stop = page(start, count, len(items))
+        self.renderer.memo = unpickler.memo
+        return {"level": level, "total": len(items), "start": start,
+                "items": [self.describe(items[i]) for i in range(start, stop)]}
+
+    def rpc_memo(self, start: int = 0, count: int = 50, keys: list = None) -> dict:
+        """Returns up to `count` memo entries in the order they were stored, from position `start`.
+
+        With `keys`, returns those entries instead, skipping missing keys.
+        """
+        memo = self.unpickler.memo
+        self.renderer.memo = memo
+        if keys is not None:
+            if not isinstance(keys, list) or len(keys) > MAX_PAGE:
+                raise ValueError(f"keys must be a list of at most {MAX_PAGE} memo indices")
+            entries = [(key, memo[key]) for key in keys if isinstance(key, int) and key in memo]
+            start = None
+        else:
+            start, stop = page(start, count, len(memo))
+            entries = islice(memo.items(), start, stop)
+        return {"total": len(memo), "start": start,
+                "entries": [{"key": key, **self.describe(value)} for key, value in entries]}
+
+    def rpc_disassembly(self, start: int = None, count: int = 20) -> dict:
+        """Returns up to `count` disassembled instructions from line `start` (by default, 3 before the current one)."""
+        unpickler = self.unpickler
+        disasm = unpickler.disasm
+        if start is None:
+            start = max(unpickler.disasm_line_no - 3, 0)
+        start, stop = page(start, count, len(disasm))
+        return {"total": len(disasm), "start": start, "current": unpickler.disasm_line_no,
+                "lines": [{"line": i, "addr": disasm.offsets[i], "text": ANSI_RE.sub("", disasm.line(i))}
+                          for i in range(start, stop)]}
+
+    def rpc_set_breakpoint(self, addr: int = None, opcode: str = None, condition: str = None) -> dict:
+        """Sets a breakpoint on an address or on every instruction with an opcode, with an optional condition."""
+        bp = self.unpickler.set_breakpoint(addr=addr, opcode=opcode, condition=condition)
+        return self.point(bp.number, bp)
+
+    def rpc_set_watchpoint(self, kind: str, slot: int = None, comparison: str = None, limit: int = None) -> dict:
+        """Sets a 'memo', 'obj' (with `slot`) or 'stack-depth' (with `comparison` and `limit`) watchpoint."""
+        watchpoint = self.unpickler.set_watchpoint(kind, slot, comparison, limit)
+        return self.point(watchpoint.number, watchpoint)
+
+    def rpc_delete(self, number: int) -> bool:
+        """Deletes a breakpoint or watchpoint by number."""
+        unpickler = self.unpickler
+        if number in unpickler.watchpoints:
+            unpickler.delete_watchpoint(number)
+        elif number in unpickler.breakpoints:
+            unpickler.delete_breakpoint(number)
+        else:
+            raise PickleDBGError(f"No breakpoint or watchpoint number {number}.")
+        return True
+
+    def rpc_breakpoints(self) -> list[dict]:
+        """Lists every breakpoint and watchpoint."""
+        unpickler = self.unpickler
+        points = dict(unpickler.breakpoints)
+        points.update(unpickler.watchpoints)
+        return [self.point(number, points[number]) for number in sorted(points)]
+
+    def point(self, number: int, point) -> dict:
+        """Returns the description of a breakpoint or watchpoint."""
+        kind = "watchpoint" if number in self.unpickler.watchpoints else "breakpoint"
+        return {"number": number, "kind": kind, "hits": point.hits, "description": point.describe()}
+
+    def rpc_shutdown(self) -> bool:
+        """Stops the server once this response is sent."""
+        asyncio.get_running_loop().call_soon(self.done.set)
+        return True
+
+
+### FUNCTIONS ###
+def encode(response) -> bytes:
+    return json.dumps(response).encode() + b"\n"
+
+
+def error_response(request_id, code: int, message: str) -> dict:
+    return {"jsonrpc": "2.0", "id": request_id, "error": {"code": code, "message": message}}
+
+
+def page(start: int, count: int, total: int) -> tuple[int, int]:
+    """Returns the bounds of a page of at most `count` (and at most MAX_PAGE) items from `start`.
+
+    A negative `start` counts from the end.
+    """
+    if not isinstance(start, int) or not isinstance(count, int) or count < 0:
+        raise ValueError("start and count must be integers, and count must not be negative")
+    if start < 0:
+        start = max(total + start, 0)
+    start = min(start, total)
+    return start, min(start + min(count, MAX_PAGE), total)
+
+
+def remove_stale_socket(path: str) -> None:
+    """Removes a socket left at `path`, refusing to remove anything else."""
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise PickleDBGError(f"'{path}' exists and is not a socket")
+    os.unlink(path)
+
+
+def parse_address(address: str) -> str:
+    """Returns the socket path of a 'unix:<path>' address."""
+    scheme, _, path = address.partition(":")
+    if scheme != "unix" or not path:
+        raise PickleDBGError(f"Invalid address '{address}'. Only local sockets are supported: 'unix:<path>'.")
+    if not hasattr(asyncio, "start_unix_server"):
+        raise PickleDBGError("Unix sockets are not supported on this platform.")
+    return path
+
+
+def serve(unpickler, address: str, name: str) -> None:
+    """Serves the debugger for `unpickler` at `address` until a client calls `shutdown`.
+
+    Args:
+        unpickler (DbgUnpickler): A freshly constructed unpickler with a disassembly.
+        address (str): Where to listen, 'unix:<path>'.
+        name (str): The name of the pickle, reported by `info`.
+    """
+    path = parse_address(address)
+    unpickler.setup_machine()
+    asyncio.run(DebugServer(unpickler, name).serve_forever(path))
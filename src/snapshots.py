@@ -0,0 +1,238 @@
+###############################################################################
+#
+# Checkpoints for reverse stepping in pickledbg
+#
+# A copy of the Pickle Machine (stack, metastack, memo, protocol, input
+# position and out-of-band buffers used) and of the execution heatmap is
+# saved every so often. Stepping
+# backwards restores the nearest checkpoint before the target instruction
+# and replays forward from there.
+#
+# Only the plain containers the pickle builds (lists, dicts, sets and
+# bytearrays, and the tuples holding them) are copied; everything else is
+# shared with the live state. The copy never calls a method of an object
+# the pickle made, so no code from the pickle runs while checkpointing, and
+# it is cheap enough that the spacing between checkpoints can grow with the
+# size of the state, which keeps the time spent copying a small fraction of
+# the time spent executing.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import io
+from types import BuiltinMethodType, MethodWrapperType
+
+
+### CONSTANTS ###
+# values that can't change, which are shared rather than copied
+ATOMS = frozenset((str, bytes, int, float, complex, bool, type(None)))
+# containers that are copied, see `StateCopier`
+CONTAINERS = frozenset((list, dict, set, bytearray))
+# methods of builtin types, which are rebound to the copy of their container
+BOUND_METHODS = frozenset((BuiltinMethodType, MethodWrapperType))
+# instructions between checkpoints per item copied, see `Checkpoints.gap()`
+SIZE_FACTOR = 4
+
+
+### CLASSES ###
+class Checkpoint:
+    """A saved copy of the Pickle Machine after `executed` instructions.
+
+    Attributes:
+        size (int): Roughly the number of items copied, counting container
+            items and heatmap counters, which is what taking and restoring
+            the checkpoint costs.
+    """
+    __slots__ = ('executed', 'line_no', 'file_pos', 'frame', 'frame_pos', 'proto', 'next_buffer', 'state',
+                 'heatmap', 'size')
+
+    def __init__(self, unpickler):
+        frame = unpickler._unframer.current_frame
+        self.executed = unpickler.executed
+        self.line_no = unpickler.disasm_line_no
+        self.file_pos = unpickler._file_tell()
+        self.frame = None if frame is None else frame.getvalue()
+        self.frame_pos = 0 if frame is None else frame.tell()
+        self.proto = unpickler.proto
+        self.next_buffer = unpickler.next_buffer
+        # one copy, so objects shared between the stack and the memo stay shared
+        copier = StateCopier()
+        self.state = copier.copy((unpickler.stack, unpickler.metastack, unpickler.memo))
+        self.heatmap = unpickler.heatmap.snapshot()
+        # a memcpy of eight counters costs about as much as copying one item
+        self.size = copier.items + (len(self.heatmap[0]) // 64 if self.heatmap[0] else 0)
+
+    def restore(self, unpickler) -> None:
+        """Puts the unpickler back in the state this checkpoint was taken in."""
+        stack, metastack, memo = StateCopier().copy(self.state)
+        unpickler.stack = stack
+        unpickler.append = stack.append
+        unpickler.metastack = metastack
+        unpickler.memo = memo
+        unpickler.proto = self.proto
+        unpickler.next_buffer = self.next_buffer
+        unpickler.executed = self.executed
+        unpickler.disasm_line_no = self.line_no
+        unpickler.heatmap.restore(self.heatmap, self.line_no)
+        unpickler._file_seek(self.file_pos)
+        if self.frame is None:
+            unpickler._unframer.current_frame = None
+        else:
+            unpickler._unframer.current_frame = io.BytesIO(self.frame)
+            unpickler._unframer.current_frame.seek(self.frame_pos)
+
+
+class StateCopier:
+    """Copies the plain containers in the Pickle Machine state.
+
+    Lists, dicts, sets and bytearrays are copied, and tuples are rebuilt if
+    they hold any of those. Every other object, including the instances
+    and container subclasses a pickle builds, is shared with the original,
+    so a change made to it after the checkpoint isn't undone by going back.
+    Methods bound to a copied container, such as a `list.pop` the pickle
+    got with `getattr`, are bound to the copy instead. Objects reached
+    twice are copied once, like `copy.deepcopy`.
+
+    Nothing is looked up on the objects being copied. A dict is copied
+    with `dict.copy()`, which reuses the stored hashes, and the values in
+    the copy are only replaced when every key is a builtin atom, since
+    storing them again rehashes their key. Set and frozenset elements are
+    hashable, so they can't be plain containers and are shared.
+
+    Attributes:
+        items (int): The number of container items visited.
+    """
+    def __init__(self):
+        self.memo = {}      # id(original) -> copy
+        self.items = 0
+
+    def copy(self, value):
+        t = type(value)
+        if t in ATOMS:
+            return value
+        key = id(value)
+        found = self.memo.get(key)
+        if found is not None:
+            return found
+        memo = self.memo
+        copy = self.copy
+
+        if t is list:
+            result = memo[key] = []
+            self.items += len(value)
+            result.extend([v if type(v) in ATOMS else copy(v) for v in value])
+        elif t is dict:
+            result = memo[key] = value.copy()
+            self.items += len(value)
+            if all(type(k) in ATOMS for k in value):
+                for k, v in value.items():
+                    if type(v) not in ATOMS:
+                        result[k] = copy(v)
+        elif t is tuple:
+            self.items += len(value)
+            for v in value:
+                if type(v) not in ATOMS:
+                    break
+            else:
+                return value
+            items = [v if type(v) in ATOMS else copy(v) for v in value]
+            # a cycle through a list inside may have copied this already
+            result = memo.get(key)
+            if result is None:
+                changed = any(a is not b for a, b in zip(items, value))
+                result = memo[key] = tuple(items) if changed else value
+        elif t is set:
+            result = memo[key] = value.copy()
+            self.items += len(value)
+        elif t is bytearray:
+            result = memo[key] = bytearray(value)
+            self.items += 1
+        elif t in BOUND_METHODS and type(value.__self__) in CONTAINERS:
+            # e.g. a memoized `list.pop`, which has to act on the copy of its list
+            result = memo[key] = getattr(copy(value.__self__), value.__name__)
+        else:
+            return value
+        return result
+
+
+class Checkpoints:
+    """The checkpoints taken so far, oldest first.
+
+    Checkpoints are at least `interval` instructions apart, and further
+    apart when the state is large, see `gap()`. When more than `limit`
+    checkpoints have been taken, every other one is dropped and the
+    interval is doubled, so memory stays bounded while the whole run
+    remains covered.
+
+    Args:
+        interval (int): Instructions between checkpoints, 0 disables them.
+        limit (int): The maximum number of checkpoints kept.
+    """
+    def __init__(self, interval: int, limit: int):
+        self.interval = interval
+        self.limit = limit
+        self.saved = []
+        self.failed = 0     # checkpoints that could not be taken
+        self.next_at = interval or None
+
+    def configure(self, interval: int, limit: int) -> None:
+        """Changes the spacing and limit, keeping the checkpoints already taken."""
+        self.interval = interval
+        self.limit = limit
+        self._thin()
+        self._schedule()
+
+    def gap(self, checkpoint: Checkpoint) -> int:
+        """Returns how many instructions after `checkpoint` the next one is taken.
+
+        Copying an item of the state costs less than executing an
+        instruction, so spacing checkpoints `SIZE_FACTOR` instructions per
+        item copied keeps checkpointing to a small fraction of the execution
+        time however large the state grows.
+        """
+        return max(self.interval, SIZE_FACTOR * checkpoint.size)
+
+    def take(self, unpickler) -> None:
+        """Saves a checkpoint of the unpickler. Called when `executed` reaches `next_at`."""
+        try:
+            self.saved.append(Checkpoint(unpickler))
+        except Exception:
+            # e.g. nesting too deep to copy, the previous checkpoint will do
+            self.failed += 1
+            self.next_at = unpickler.executed + self.interval if self.interval else None
+            return
+        self._thin()
+        self._schedule()
+
+    def _schedule(self) -> None:
+        """Sets `next_at` from the last checkpoint kept."""
+        if not self.interval:
+            self.next_at = None
+        elif self.saved:
+            last = self.saved[-1]
+            self.next_at = last.executed + self.gap(last)
+        else:
+            self.next_at = self.interval
+
+    def _thin(self) -> None:
+        """Drops every other checkpoint while there are more than `limit`."""
+        while self.limit and len(self.saved) > self.limit:
+            self.saved = self.saved[1::2]
+            self.interval *= 2
+
+    def before(self, executed: int):
+        """Returns the latest checkpoint taken at or before `executed`, or None.
+
+        Checkpoints after `executed` are discarded, since the replay may not
+        take the same path again (e.g. if the pickle reads from stdin).
+        """
+        while self.saved and self.saved[-1].executed > executed:
+            self.saved.pop()
+        self._schedule()
+        return self.saved[-1] if self.saved else None
+
+    def clear(self) -> None:
+        """Drops every checkpoint."""
+        self.saved = []
+        self.next_at = self.interval or None
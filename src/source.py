@@ -0,0 +1,201 @@
+###############################################################################
+#
+# Pickle input sources for pickledbg
+#
+# The pickle is memory-mapped once and shared by the disassembler and the
+# unpickler, so multi-GB pickles are never read into memory up front and
+# only the pages that are actually touched become resident. A pickle stored
+# inside a larger file, such as an uncompressed zip member, is used in place
+# through a `MappedRange` over the mapping of the whole file. Protocol 5
+# out-of-band buffers are mapped the same way and handed to the unpickler
+# as `PickleBuffer` views.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import io, mmap
+from pickle import PickleBuffer
+
+
+### CLASSES ###
+class MappedRange:
+    """The bytes `start` to `start + length` of a mapping, addressed from 0.
+
+    Supports len(), indexing, slicing and `find()` like the mapping itself,
+    so it can be used wherever the disassembler or a reader takes an mmap.
+    Slicing returns bytes, copied from the mapping.
+    """
+    __slots__ = ('_map', '_start', '_len')
+
+    def __init__(self, data, start: int, length: int):
+        if start < 0 or length < 0 or start + length > len(data):
+            raise ValueError("range outside the mapping")
+        self._map = data
+        self._start = start
+        self._len = length
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __getitem__(self, key):
+        if key.__class__ is int:
+            if key < 0:
+                key += self._len
+            if not 0 <= key < self._len:
+                raise IndexError("index out of range")
+            return self._map[self._start + key]
+        start, stop, step = key.indices(self._len)
+        return self._map[self._start + start:self._start + stop:step]
+
+    def find(self, sub, start: int = 0, end: int = None) -> int:
+        if end is None or end > self._len:
+            end = self._len
+        pos = self._map.find(sub, self._start + start, self._start + end)
+        return pos - self._start if pos >= 0 else -1
+
+    def view(self) -> memoryview:
+        """Returns a memoryview of the range, without copying."""
+        return memoryview(self._map)[self._start:self._start + self._len]
+
+    def close(self) -> None:
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+
+class PickleSource:
+    """A pickle that is memory-mapped from a file (or held in memory).
+
+    `data` supports len(), indexing, slicing and `find()`, which is all the
+    disassembler needs. Each call to `reader()` returns an independent
+    file-like object over the same data for an unpickler.
+
+    A pickle taken out of a container (see `containers.open_source()`)
+    also describes what the unpickler needs to get through it without
+    loading anything from outside the pickle.
+
+    Args:
+        data: The pickle bytes, an mmap of them or a `MappedRange`.
+        name (str): A name for the source, usually the file path.
+        kind (str): What the pickle was found in, e.g. 'pickle' or 'torch zip'.
+        payloads (dict): Offset -> stub for data embedded in the stream
+            after an instruction (joblib's numpy arrays). Each stub's
+            `length` is the number of bytes to skip.
+        stubs (dict): "module.name" -> object returned instead of importing
+            that global.
+    """
+    def __init__(self, data, name: str = "<memory>", kind: str = "pickle",
+                 payloads: dict = None, stubs: dict = None):
+        self.data = data
+        self.name = name
+        self.kind = kind
+        self.payloads = payloads or {}
+        self.stubs = stubs or {}
+
+    @classmethod
+    def open(cls, path: str) -> "PickleSource":
+        """Memory-maps the pickle at `path` read-only.
+
+        Empty files can't be mapped, so they are represented by empty bytes.
+        """
+        with open(path, "rb") as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                data = b""
+        return cls(data, path)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def reader(self) -> "SourceReader":
+        """Returns a new file-like reader positioned at the start of the pickle."""
+        return SourceReader(self.data, self.name)
+
+    @property
+    def skips(self) -> dict:
+        """Offset -> number of bytes of embedded data to skip there, for the disassembler."""
+        return {offset: payload.length for offset, payload in self.payloads.items()}
+
+    def close(self) -> None:
+        """Unmaps the pickle. Readers must not be used afterwards."""
+        if isinstance(self.data, (mmap.mmap, MappedRange)):
+            self.data.close()
+
+
+class SourceReader(io.RawIOBase):
+    """A seekable, read-only file over the bytes of a `PickleSource`.
+
+    `readinto()` copies straight from the mapping into the caller's buffer,
+    so BYTEARRAY8 payloads are copied exactly once.
+    """
+    def __init__(self, data, name: str):
+        self._data = data
+        self._view = data.view() if isinstance(data, MappedRange) else memoryview(data)
+        self._pos = 0
+        self.name = name
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, pos: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += len(self._data)
+        if pos < 0:
+            raise ValueError("negative seek position %d" % pos)
+        self._pos = pos
+        return pos
+
+    def read(self, n: int = -1) -> bytes:
+        start = self._pos
+        if n is None or n < 0:
+            end = len(self._data)
+        else:
+            end = min(start + n, len(self._data))
+        if end <= start:
+            return b""
+        self._pos = end
+        return self._data[start:end]
+
+    def readinto(self, buf) -> int:
+        start = self._pos
+        n = max(min(len(buf), len(self._data) - start), 0)
+        memoryview(buf).cast("B")[:n] = self._view[start:start+n]
+        self._pos = start + n
+        return n
+
+    def readline(self, size: int = -1) -> bytes:
+        start = self._pos
+        end = self._data.find(b"\n", start) + 1
+        if end == 0:
+            end = len(self._data)
+        if size is not None and 0 <= size < end - start:
+            end = start + size
+        self._pos = max(end, start)
+        return self._data[start:self._pos]
+
+    def close(self) -> None:
+        self._view.release()
+        super().close()
+
+
+### FUNCTIONS ###
+def map_buffer(path: str) -> PickleBuffer:
+    """Memory-maps the file at `path` read-only as an out-of-band buffer.
+
+    The buffer is a view of the mapping, so only the pages that are
+    actually read become resident and nothing is copied.
+    """
+    with open(path, "rb") as f:
+        try:
+            return PickleBuffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except ValueError:
+            return PickleBuffer(b"")
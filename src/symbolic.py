@@ -0,0 +1,391 @@
+###############################################################################
+#
+# Symbolic execution for pickledbg
+#
+# SymbolicUnpickler runs a pickle with the normal `_Unpickler` handlers for
+# everything that only builds data (strings, numbers, lists, dicts, tuples,
+# the memo, MARKs), but never imports or calls anything. Globals become
+# `Symbol`s, and REDUCE, NEWOBJ, INST and OBJ become `Call` nodes. BUILD and
+# item assignments on those nodes are recorded on them instead of applied.
+# The result is the object graph the pickle describes, plus every call it
+# would make, without any of its code running.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import sys, json, reprlib, argparse
+from pickle import _Stop, _inverted_registry, UnpicklingError
+
+
+### LOCAL IMPORTS ###
+from errors import PickleDBGError
+from pickledbg import DbgUnpickler
+from containers import open_source
+
+
+### CONSTANTS ###
+# stands in for a STACK_GLOBAL module or name that isn't a literal string
+COMPUTED = "<computed>"
+
+
+### CLASSES ###
+class Symbol:
+    """A global referenced by the pickle, such as `os.system`. Never imported."""
+    __slots__ = ('name',)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __repr__(self) -> str:
+        return self.name
+
+
+class Call:
+    """A call the pickle would make, recorded instead of made.
+
+    Attributes:
+        func: What would be called, usually a `Symbol`.
+        args: The positional arguments. For REDUCE this is whatever was on
+            the stack, normally a tuple.
+        kwargs (dict|None): Keyword arguments, only for NEWOBJ_EX.
+        opcode (str): The opcode that made the call, e.g. 'REDUCE'.
+        addr (int): The address of that opcode.
+        state (list): Arguments of every BUILD applied to the result.
+        items (list): Items appended or added to the result.
+        setitems (list): (key, value) pairs assigned to the result.
+    """
+    __slots__ = ('func', 'args', 'kwargs', 'opcode', 'addr', 'state', 'items', 'setitems')
+
+    def __init__(self, func, args, opcode: str, addr: int, kwargs: dict = None):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.opcode = opcode
+        self.addr = addr
+        self.state = []
+        self.items = []
+        self.setitems = []
+
+    def __repr__(self) -> str:
+        return describe(self)
+
+
+class NodeRepr(reprlib.Repr):
+    """A `reprlib.Repr` that knows how to show `Symbol` and `Call` nodes.
+
+    Calls are shown as Python expressions, followed by any state and items
+    recorded on them, e.g. `collections.OrderedDict().update({'a': 1})`.
+    """
+    def __init__(self):
+        super().__init__()
+        self.maxlevel = 8
+        self.maxtuple = self.maxlist = self.maxdict = self.maxset = self.maxfrozenset = 20
+        self.maxstring = self.maxother = 120
+        self.maxlong = 60
+
+    def repr_Symbol(self, obj: Symbol, level: int) -> str:
+        return obj.name
+
+    def repr_Call(self, obj: Call, level: int) -> str:
+        func = self.repr1(obj.func, level - 1)
+        if level <= 0:
+            return func + "(...)"
+
+        if isinstance(obj.args, tuple):
+            args = [self.repr1(arg, level - 1) for arg in obj.args[:self.maxtuple]]
+            if len(obj.args) > self.maxtuple:
+                args.append("...")
+        else:
+            args = ["*" + self.repr1(obj.args, level - 1)]
+        if obj.kwargs:
+            args.append("**" + self.repr1(obj.kwargs, level - 1))
+        text = f"{func}({', '.join(args)})"
+
+        for state in obj.state:
+            text += f".__setstate__({self.repr1(state, level - 1)})"
+        if obj.items:
+            text += f".extend({self.repr1(obj.items, level - 1)})"
+        if obj.setitems:
+            pairs = [f"{self.repr1(key, level - 1)}: {self.repr1(value, level - 1)}"
+                     for key, value in obj.setitems[:self.maxdict]]
+            if len(obj.setitems) > self.maxdict:
+                pairs.append("...")
+            text += ".update({%s})" % ", ".join(pairs)
+        return text
+
+
+class SymbolicUnpickler(DbgUnpickler):
+    """A DbgUnpickler that never imports or calls anything from the pickle.
+
+    Attributes:
+        targets (list[str]): The "module.name" of every global looked up, in
+            order. A STACK_GLOBAL whose module or name was not a literal
+            string (e.g. it came from a call) has `COMPUTED` in its place.
+        calls (list[Call]): Every call the pickle would make, in order.
+        counts (list[int]): How many times each opcode byte was executed.
+        max_stack (int): The most items on the stack at once, counting the
+            items under every MARK.
+        max_marks (int): The deepest MARK nesting.
+    """
+    def __init__(self, file, **kwargs):
+        super().__init__(file, **kwargs)
+        self.targets = []
+        self.calls = []
+        self.counts = [0] * 256
+        self.max_stack = 0
+        self.max_marks = 0
+
+    def summarize(self):
+        """Runs the pickle to completion and returns the final (symbolic) object.
+
+        If the pickle is malformed the exception propagates, and the
+        attributes describe everything executed before it.
+        """
+        self.setup_machine()
+        read = self.read
+        dispatch = self.dispatch
+        counts = self.counts
+        # only MARK and the opcodes that pop one change its length or replace
+        # the stack, and the lists on it don't change until they are popped
+        metastack = self.metastack
+        stack = self.stack
+        max_stack = self.max_stack
+        max_marks = self.max_marks
+
+        # below[i] is the number of items under the first i MARKs, so the
+        # total below the topmost one is updated in constant time per MARK
+        below = [0]
+        marks = 0
+        under = 0
+        try:
+            while True:
+                key = read(1)
+                if not key:
+                    raise EOFError
+                code = key[0]
+                counts[code] += 1
+                dispatch[code](self)
+
+                if len(metastack) != marks:
+                    if len(metastack) == marks + 1:
+                        below.append(under + len(metastack[-1]))
+                    else:
+                        del below[len(metastack) + 1:]
+                        while len(below) <= len(metastack):
+                            below.append(below[-1] + len(metastack[len(below) - 1]))
+                    marks = len(metastack)
+                    under = below[-1]
+                    stack = self.stack
+                    if marks > max_marks:
+                        max_marks = marks
+                depth = under + len(stack)
+                if depth > max_stack:
+                    max_stack = depth
+        except _Stop as stopinst:
+            return stopinst.value
+        finally:
+            self.max_stack = max_stack
+            self.max_marks = max_marks
+
+    def _call(self, func, args, opcode: str, kwargs: dict = None, addr: int = None) -> Call:
+        if addr is None:
+            # only the opcode byte has been read so far
+            addr = self.tell() - 1
+        call = Call(func, args, opcode, addr, kwargs)
+        self.calls.append(call)
+        return call
+
+    def find_class(self, module: str, name: str) -> Symbol:
+        target = f"{module}.{name}"
+        self.targets.append(target)
+        return Symbol(target)
+
+    def persistent_load(self, pid) -> Call:
+        return self._call(Symbol("persistent_load"), (pid,), "BINPERSID")
+
+    def load_persid(self):
+        addr = self.tell() - 1
+        try:
+            pid = self.readline()[:-1].decode("ascii")
+        except UnicodeDecodeError:
+            raise UnpicklingError("persistent IDs in protocol 0 must be ASCII strings")
+        self.append(self._call(Symbol("persistent_load"), (pid,), "PERSID", addr=addr))
+
+    def get_extension(self, code: int) -> None:
+        # unlike _Unpickler, don't put symbols in the process-wide extension cache
+        key = _inverted_registry.get(code)
+        if not key:
+            if code <= 0:
+                raise UnpicklingError("EXT specifies code <= 0")
+            raise ValueError("unregistered extension code %d" % code)
+        self.append(self.find_class(*key))
+
+    def load_inst(self):
+        addr = self.tell() - 1
+        module = self.readline()[:-1].decode("ascii")
+        name = self.readline()[:-1].decode("ascii")
+        klass = self.find_class(module, name)
+        self.append(self._call(klass, tuple(self.pop_mark()), "INST", addr=addr))
+
+    def load_obj(self):
+        args = self.pop_mark()
+        cls = args.pop(0)
+        self.append(self._call(cls, tuple(args), "OBJ"))
+
+    def load_stack_global(self):
+        name = self.stack.pop()
+        module = self.stack.pop()
+        if type(module) is not str:
+            module = COMPUTED
+        if type(name) is not str:
+            name = COMPUTED
+        self.append(self.find_class(module, name))
+
+    def load_reduce(self):
+        stack = self.stack
+        args = stack.pop()
+        stack[-1] = self._call(stack[-1], args, "REDUCE")
+
+    def load_newobj(self):
+        args = self.stack.pop()
+        cls = self.stack.pop()
+        self.append(self._call(cls, args, "NEWOBJ"))
+
+    def load_newobj_ex(self):
+        kwargs = self.stack.pop()
+        args = self.stack.pop()
+        cls = self.stack.pop()
+        self.append(self._call(cls, args, "NEWOBJ_EX", kwargs))
+
+    def load_build(self):
+        stack = self.stack
+        state = stack.pop()
+        inst = stack[-1]
+        if not isinstance(inst, Call):
+            inst = stack[-1] = self._call(Symbol("<build>"), (inst,), "BUILD")
+        inst.state.append(state)
+        if self.payloads:
+            self.skip_payload()
+
+    def _marked_target(self):
+        """Returns the object below the topmost MARK, which APPENDS, SETITEMS and ADDITEMS modify."""
+        if self.metastack and self.metastack[-1]:
+            return self.metastack[-1][-1]
+        return None
+
+    def load_append(self):
+        stack = self.stack
+        if isinstance(stack[-2], Call):
+            value = stack.pop()
+            stack[-1].items.append(value)
+        else:
+            DbgUnpickler.load_append(self)
+
+    def load_appends(self):
+        if isinstance(self._marked_target(), Call):
+            items = self.pop_mark()
+            self.stack[-1].items.extend(items)
+        else:
+            DbgUnpickler.load_appends(self)
+
+    def load_setitem(self):
+        stack = self.stack
+        if isinstance(stack[-3], Call):
+            value = stack.pop()
+            key = stack.pop()
+            stack[-1].setitems.append((key, value))
+        else:
+            DbgUnpickler.load_setitem(self)
+
+    def load_setitems(self):
+        if isinstance(self._marked_target(), Call):
+            items = self.pop_mark()
+            self.stack[-1].setitems.extend(zip(items[::2], items[1::2]))
+        else:
+            DbgUnpickler.load_setitems(self)
+
+    def load_additems(self):
+        if isinstance(self._marked_target(), Call):
+            items = self.pop_mark()
+            self.stack[-1].items.extend(items)
+        else:
+            DbgUnpickler.load_additems(self)
+
+    dispatch = dict(DbgUnpickler.dispatch)
+    dispatch[b'P'[0]] = load_persid
+    dispatch[b'i'[0]] = load_inst
+    dispatch[b'o'[0]] = load_obj
+    dispatch[b'\x93'[0]] = load_stack_global
+    dispatch[b'R'[0]] = load_reduce
+    dispatch[b'\x81'[0]] = load_newobj
+    dispatch[b'\x92'[0]] = load_newobj_ex
+    dispatch[b'b'[0]] = load_build
+    dispatch[b'a'[0]] = load_append
+    dispatch[b'e'[0]] = load_appends
+    dispatch[b's'[0]] = load_setitem
+    dispatch[b'u'[0]] = load_setitems
+    dispatch[b'\x90'[0]] = load_additems
+
+
+### FUNCTIONS ###
+_node_repr = NodeRepr()
+
+def describe(obj) -> str:
+    """Returns a bounded, readable expression for a symbolic object."""
+    return _node_repr.repr(obj)
+
+
+def summary(unpickler: SymbolicUnpickler, value=None, error: str = None) -> dict:
+    """Returns the summary of a finished (or failed) symbolic run as a JSON-friendly dict."""
+    return {
+        "instructions": sum(unpickler.counts),
+        "max_stack": unpickler.max_stack,
+        "max_marks": unpickler.max_marks,
+        "max_memo": len(unpickler.memo),
+        "globals": list(dict.fromkeys(unpickler.targets)),
+        "calls": [{"addr": call.addr, "opcode": call.opcode, "call": describe(call)} for call in unpickler.calls],
+        "value": None if error is not None else describe(value),
+        "error": error,
+    }
+
+
+def main(argv: list[str]) -> int:
+    """Runs `pickledbg summary`. Returns the exit code."""
+    parser = argparse.ArgumentParser(
+        prog="pickledbg summary",
+        description="Summarize what a pickle builds and calls without running any of it")
+    parser.add_argument("picklefile", help="the pickle file to summarize")
+    parser.add_argument("--member", metavar="NAME", help="the pickle to summarize inside a zip archive, by default its data.pkl")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args(argv)
+
+    try:
+        source = open_source(args.picklefile, args.member)
+    except (OSError, PickleDBGError) as e:
+        print(f"[-] Error: could not open '{args.picklefile}': {e}", file=sys.stderr)
+        return 1
+
+    unpickler = SymbolicUnpickler(source.reader(), payloads=source.payloads)
+    value = error = None
+    try:
+        value = unpickler.summarize()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    result = summary(unpickler, value, error)
+
+    if args.json:
+        print(json.dumps(result, indent=1))
+    else:
+        print(f"Instructions : {result['instructions']}")
+        print(f"Max stack    : {result['max_stack']} (MARK depth {result['max_marks']})")
+        print(f"Max memo     : {result['max_memo']}")
+        print(f"Globals      : {', '.join(result['globals']) or '(none)'}")
+        print(f"Calls        : {len(result['calls'])}")
+        for call in result['calls']:
+            print(f"  {call['addr']:>8}: {call['opcode']:<9} {call['call']}")
+        if error is not None:
+            print(f"Error        : {error}")
+        else:
+            print(f"Result       : {result['value']}")
+    return 0 if error is None else 1
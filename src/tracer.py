@@ -0,0 +1,90 @@
+###############################################################################
+#
+# Headless tracing for pickledbg
+#
+# Runs a DbgUnpickler to completion without ever touching the terminal and
+# writes one JSON record per executed instruction. This is meant for CI and
+# batch triage jobs where redrawing the Pickle Machine state after every
+# instruction is far too slow.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+from time import perf_counter_ns
+from pickle import _Stop
+from pickletools import code2op
+
+
+### CONSTANTS ###
+# opcode byte -> opcode name, e.g. 0x80 -> 'PROTO'
+OPCODE_NAMES = {ord(code): op.name for code, op in code2op.items()}
+
+
+### CLASSES ###
+class TracingMemo(dict):
+    """A memo that records every key read or written by the Pickle Machine.
+
+    The recorded keys are collected in `touched`. `trace()` writes them out
+    and clears them after each instruction; the recorder clears them before
+    each one.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.touched = []
+
+    def __getitem__(self, key):
+        self.touched.append(key)
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        self.touched.append(key)
+        super().__setitem__(key, value)
+
+
+### FUNCTIONS ###
+def trace(unpickler, out) -> object:
+    """Runs the unpickler to completion, writing one JSONL record per instruction.
+
+    Each record holds the instruction address, opcode name, stack and
+    metastack depth after the instruction, the memo keys it touched and the
+    time it took in nanoseconds. If the pickle fails, a final record with the
+    error is written and the exception is re-raised.
+
+    Args:
+        unpickler (DbgUnpickler): A freshly constructed unpickler.
+        out: A writable text file object.
+    Returns:
+        object: The unpickled value.
+    """
+    unpickler.memo = memo = TracingMemo(unpickler.memo)
+    touched = memo.touched
+    write = out.write
+    addr = 0    # where the error is reported if the pickle fails before its first instruction
+
+    try:
+        unpickler.setup_machine()
+        read = unpickler.read
+        tell = unpickler.tell
+        dispatch = unpickler.dispatch
+        while True:
+            addr = tell()
+            key = read(1)
+            if not key:
+                raise EOFError
+            start = perf_counter_ns()
+            try:
+                dispatch[key[0]](unpickler)
+            finally:
+                elapsed = perf_counter_ns() - start
+                write('{"addr": %d, "op": "%s", "stack": %d, "metastack": %d, "memo": [%s], "ns": %d}\n' % (
+                    addr, OPCODE_NAMES.get(key[0], "UNKNOWN"), len(unpickler.stack),
+                    len(unpickler.metastack), ", ".join(map(str, touched)), elapsed))
+                touched.clear()
+    except _Stop as stopinst:
+        return stopinst.value
+    except Exception as e:
+        import json
+        write('{"error": %s, "addr": %d}\n' % (json.dumps(f"{type(e).__name__}: {e}"), addr))
+        raise
+
@@ -1,5 +1,3 @@
-from typing import Optional, Union
-import readline
 from colors import *
 
 commands = {
@@ -7,21 +5,57 @@ commands = {
     'next': [],
     'step': [],
     'step-to': [],
+    'back': [],
+    'restart': [],
+    'continue': [],
+    'c': [],
+    'break': ['opcode', 'search'],
+    'b': ['opcode', 'search'],
+    'delete': [],
+    'watch': ['memo', 'stack-depth', 'obj'],
+    'info': ['breakpoints', 'watchpoints', 'hooks', 'hot'],
+    'commands': [],
+    'source': [],
     'start': [],
     'run': [],
+    'profile': ['on', 'off', 'show', 'save', 'reset'],
+    'search': ['opcode', 'string', 'bytes'],
+    'xref': ['memo', 'addr'],
     'export': [],
     '?': [],
     'exit': [],
     'quit': [],
     'set': {
-        'step-verbose': ['true', 'false']
+        'step-verbose': ['true', 'false'],
+        'render-max-items': [],
+        'render-max-depth': [],
+        'render-max-width': [],
+        'checkpoint-interval': [],
+        'checkpoint-limit': [],
+        'profile-memory': ['true', 'false'],
+        'max-instructions': [],
+        'max-memory-mb': [],
+        'max-container-len': [],
     },
     'show': ['options'],
     'help': ['options']
 }
 
 
-def completer(text: str, state: int) -> Optional[str]:
+def setup_readline() -> None:
+    """Enables line editing and tab completion for the prompt.
+
+    readline is only imported here, when the interactive prompt is about to
+    be shown, so the other modes and the start of the debugger don't pay
+    for it.
+    """
+    import readline
+    readline.set_completer_delims(' ')
+    readline.set_completer(completer)
+    readline.parse_and_bind("tab: complete")
+
+
+def completer(text: str, state: int) -> str | None:
     """Completer function for readline to provide command completion.
     
     Args:
@@ -29,11 +63,12 @@ def completer(text: str, state: int) -> Optional[str]:
         state (int): The state of the completion, used to iterate through options.
 
     Returns:
-        Optional[str]: The next completion option or None if no more options are available.
+        str | None: The next completion option or None if no more options are available.
     """
+    import readline
     buffer = readline.get_line_buffer().split()
     
-    def get_options(cmd_tree: Union[dict, list], tokens: list[str], current_text: str) -> list[str]:
+    def get_options(cmd_tree: dict | list, tokens: list[str], current_text: str) -> list[str]:
         # we only have a list of valid leaf commands
         if isinstance(cmd_tree, list):
             return [cmd for cmd in cmd_tree if cmd.startswith(current_text)]
@@ -61,7 +96,7 @@ def print_help(terminal_width: int) -> None:
     """Prints the color-coded help menu for the Pickle Debugger."""
     # start
     print(redify("start"))
-    print("Starts the debugger, pointing to the first instruction but not executing it. Must only be ran once. To restart debugging, close the program and run it again. Must also be run before stepping through instructions.")
+    print("Starts the debugger, pointing to the first instruction but not executing it. Must only be ran once. To restart debugging, use 'restart'. Must also be run before stepping through instructions.")
     print(yellowify("Aliases:")+' run')
     print()
     print(grayify('─'*terminal_width))
@@ -91,6 +126,129 @@ def print_help(terminal_width: int) -> None:
     print(grayify('─'*terminal_width))
 
 
+    # back
+    print(redify("back"))
+    print("Steps backwards the given number of instructions (default 1) and shows the Pickle Machine state. The nearest checkpoint before the target is restored and the instructions after it are run again, including any side effects they have. Checkpoints copy plain lists, dicts, sets and bytearrays; other objects are shared, so changes made to them since the checkpoint (e.g. by BUILD) are not undone.")
+    print(yellowify("Syntax:")+' back [number]')
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # restart
+    print(redify("restart"))
+    print("Goes back to before the first instruction without leaving the debugger. Breakpoints and options are kept.")
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # continue
+    print(redify("continue"))
+    print("Executes instructions until a breakpoint is hit or unpickling finishes, then shows the updated Pickle Machine state.")
+    print(yellowify("Aliases:")+' c')
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # break
+    print(redify("break"))
+    print("Sets a breakpoint on an instruction address, on every instruction with the given opcode or on every match of the last 'search'. An optional Python condition is evaluated before the instruction runs, with 'stack', 'metastack', 'memo', 'proto' and 'addr' available.")
+    print(yellowify("Syntax:")+' break <address> [if <condition>]')
+    print(yellowify("Syntax:")+' break opcode <NAME> [if <condition>]')
+    print(yellowify("Syntax:")+' break search [if <condition>]')
+    print(yellowify("Example:")+' break 1234 if len(stack) > 50')
+    print(yellowify("Aliases:")+' b')
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # delete
+    print(redify("delete"))
+    print("Deletes a breakpoint or watchpoint by number, or all of them if no number is given.")
+    print(yellowify("Syntax:")+' delete [number]')
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # watch
+    print(redify("watch"))
+    print("Sets a watchpoint, which stops execution right after the instruction that: stores a different object in a memo slot ('memo'), makes the stack depth (the items above the topmost MARK) satisfy the comparison when it didn't before ('stack-depth'), or mutates the object in a memo slot with APPEND(S), SETITEM(S), ADDITEMS or BUILD ('obj'). Only the handlers of the opcodes that can trigger a watchpoint are instrumented.")
+    print(yellowify("Syntax:")+' watch memo <index>')
+    print(yellowify("Syntax:")+' watch stack-depth >|>=|<|<=|==|!= <number>')
+    print(yellowify("Syntax:")+' watch obj <memo index>')
+    print(yellowify("Example:")+' watch stack-depth > 1000')
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # info breakpoints
+    print(redify("info breakpoints"))
+    print("Lists all breakpoints and watchpoints and how many times each has been hit. 'info watchpoints' lists only the watchpoints.")
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # commands
+    print(redify("commands"))
+    print("Sets the debugger commands run every time a breakpoint or watchpoint stops execution, one per line up to 'end'. Without a number, they are attached to the last breakpoint or watchpoint set. If the first line is 'silent', the Pickle Machine state isn't shown when it stops. A command that resumes execution ends the list, and the commands of wherever execution stops next are run instead.")
+    print(yellowify("Syntax:")+' commands [number]')
+    print(yellowify("Example:")+' commands 1 / silent / info hot 3 / continue / end')
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # source
+    print(redify("source"))
+    print("Runs a file of debugger commands, one per line ('#' starts a comment and 'commands' blocks are read from the file), or loads a Python plugin if the file ends in .py. Plugins can call on_opcode(\"REDUCE\", fn) and on_address(120, fn) to have fn(debugger) called with the live debugger on every such instruction, and execute(\"command\") to run debugger commands. Only the handlers of hooked opcodes are instrumented.")
+    print(yellowify("Syntax:")+' source <file>')
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # info hooks
+    print(redify("info hooks"))
+    print("Lists the hooks set by plugins and how many times each has been called.")
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # info hot
+    print(redify("info hot"))
+    print("Lists the most executed instructions, and the loops formed when a pickle that seeks its own input jumps backwards, with how many times each ran. Once a jump has happened, the disassembly also shows how many times each instruction executed. If no number is specified, the default is 10.")
+    print(yellowify("Syntax:")+' info hot [number]')
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # profile
+    print(redify("profile"))
+    print("Measures the wall time and memory allocated by every instruction executed while profiling is on. 'profile show' prints the totals per opcode and the most expensive addresses, and 'profile save' writes them all as JSON. If no filename is specified, the default is 'profile.json'.")
+    print(yellowify("Syntax:")+' profile on|off|reset')
+    print(yellowify("Syntax:")+' profile show [number]')
+    print(yellowify("Syntax:")+' profile save [filename]')
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # search
+    print(redify("search"))
+    print("Finds the instructions with the given opcode, or whose bytes contain the given string (UTF-8 encoded, quotes are optional) or hex bytes. The raw pickle is searched rather than the disassembly text. 'break search' sets a breakpoint on every match of the last search.")
+    print(yellowify("Syntax:")+' search opcode <NAME>')
+    print(yellowify("Syntax:")+' search string <text>')
+    print(yellowify("Syntax:")+' search bytes <hex>')
+    print(yellowify("Example:")+' search bytes 63 6f')
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # xref
+    print(redify("xref"))
+    print("Cross-references the disassembly. 'xref memo' lists the instructions that write and read a memo slot, and 'xref addr' lists the instructions that pushed the stack values an instruction uses and those that use what it pushes. The index is built on the first use, in one pass over the disassembly.")
+    print(yellowify("Syntax:")+' xref memo <index>')
+    print(yellowify("Syntax:")+' xref addr <address>')
+    print()
+    print(grayify('─'*terminal_width))
+
+
     # export 
     print(redify("export"))
     print("Writes the disassembly of the pickle to a file. If no filename is specified, the default is 'out.disasm'.")
@@ -127,4 +285,86 @@ def print_help(terminal_width: int) -> None:
     print("Exits the debugger.")
     print(yellowify("Aliases:")+' quit')
     print()
+    print(grayify('─'*terminal_width))
+
+
+def print_options_help(terminal_width: int) -> None:
+    """Prints the color-coded help menu for the debugger options."""
+    # step-verbose
+    print(redify("step-verbose"))
+    print(f"When set to {blueify('true')}, the debugger will print the state of the Pickle Machine after each instruction rather than just the final state.")
+    print(f"{yellowify('Default:')} {blueify('false')}")
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # render-max-items
+    print(redify("render-max-items"))
+    print("The maximum number of items shown for each container in the stack and memo. The stack and memo themselves show their most recent items. 0 means unlimited.")
+    print(f"{yellowify('Default:')} {blueify('50')}")
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # render-max-depth
+    print(redify("render-max-depth"))
+    print("The maximum nesting depth shown for containers in the stack and memo. 0 means unlimited.")
+    print(f"{yellowify('Default:')} {blueify('6')}")
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # render-max-width
+    print(redify("render-max-width"))
+    print("The approximate maximum number of characters shown for each value in the stack and memo. 0 means unlimited.")
+    print(f"{yellowify('Default:')} {blueify('500')}")
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # checkpoint-interval
+    print(redify("checkpoint-interval"))
+    print("The minimum number of instructions between checkpoints of the Pickle Machine, which 'back' restores from. Checkpoints are spaced further apart as the Pickle Machine holds more items, so that taking them stays a small fraction of the execution time. Smaller values make 'back' faster but use more memory. 0 disables checkpoints, so 'back' replays from the start.")
+    print(f"{yellowify('Default:')} {blueify('1000')}")
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # checkpoint-limit
+    print(redify("checkpoint-limit"))
+    print("The maximum number of checkpoints kept. When it is reached, every other checkpoint is dropped and the interval is doubled. 0 means unlimited.")
+    print(f"{yellowify('Default:')} {blueify('64')}")
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # profile-memory
+    print(redify("profile-memory"))
+    print("Whether 'profile on' measures memory allocated as well as time. Tracking allocations makes execution several times slower. Takes effect the next time profiling is turned on.")
+    print(f"{yellowify('Default:')} {blueify('True')}")
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # max-instructions
+    print(redify("max-instructions"))
+    print("The total number of instructions that may be executed. Execution stops when it is reached, and every later step stops right away until the limit is raised. 0 means unlimited.")
+    print(f"{yellowify('Default:')} {blueify('0')}")
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # max-memory-mb
+    print(redify("max-memory-mb"))
+    print("The resident memory of the debugger, in MB, above which execution stops with a report of how fast memory was growing. Checked after every instruction that calls a function and every 1024 instructions otherwise. 0 means unlimited.")
+    print(f"{yellowify('Default:')} {blueify('0')}")
+    print()
+    print(grayify('─'*terminal_width))
+
+
+    # max-container-len
+    print(redify("max-container-len"))
+    print("The number of items a list, dict, set or tuple built by the pickle may hold, checked after every instruction that builds or grows one. The stack (counting the items under every MARK) and the memo are checked every 1024 instructions. 0 means unlimited.")
+    print(f"{yellowify('Default:')} {blueify('0')}")
+    print()
     print(grayify('─'*terminal_width))
\ No newline at end of file
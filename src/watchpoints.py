@@ -0,0 +1,217 @@
+###############################################################################
+#
+# Watchpoints for pickledbg
+#
+# A watchpoint stops execution when something in the Pickle Machine changes:
+# a memo slot is written, the stack depth crosses a limit or an object is
+# mutated. Only the dispatch handlers of the opcodes that can cause the
+# change are wrapped, so every other instruction runs at full speed and the
+# state is never diffed.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import operator, reprlib
+
+
+### LOCAL IMPORTS ###
+from errors import *
+from disasm import OPCODE_TABLE
+
+
+### CONSTANTS ###
+COMPARISONS = {
+    '>': operator.gt, '>=': operator.ge, '<': operator.lt,
+    '<=': operator.le, '==': operator.eq, '!=': operator.ne,
+}
+
+MEMO_WRITES = frozenset(map(ord, ('\x94', 'p', 'q', 'r')))    # MEMOIZE, PUT, BINPUT, LONG_BINPUT
+
+# mutating opcode -> how far below the top of the stack its target is, or
+# None if the target is the item below the topmost MARK
+MUTATORS = {
+    ord('a'): 2,        # APPEND
+    ord('e'): None,     # APPENDS
+    ord('s'): 3,        # SETITEM
+    ord('u'): None,     # SETITEMS
+    ord('\x90'): None,  # ADDITEMS
+    ord('b'): 2,        # BUILD
+}
+
+MISSING = object()
+_repr = reprlib.Repr()
+_repr.maxstring = _repr.maxother = 60
+
+
+### CLASSES ###
+class Watchpoint:
+    """Base class for watchpoints.
+
+    Subclasses list the opcodes whose handlers need wrapping in `opcodes`,
+    and implement `before()`, called before such a handler runs, and
+    `after()`, called after it, which returns a stop message or None.
+
+    Attributes:
+        number (int): The number shown to the user, shared with breakpoints.
+        hits (int): How many times the watchpoint has stopped execution.
+        commands (list[str]): The debugger commands run when it stops execution.
+    """
+    opcodes = frozenset()
+
+    def __init__(self, number: int):
+        self.number = number
+        self.hits = 0
+        self.commands = []      # run when the watchpoint stops execution, see 'commands'
+
+    def before(self, unpickler):
+        return None
+
+    def after(self, unpickler, state):
+        return None
+
+    @property
+    def title(self) -> str:
+        """How stop messages refer to the watchpoint."""
+        return f"Watchpoint {self.number}"
+
+    def describe(self) -> str:
+        """Returns a one-line description of the watchpoint."""
+        return f"{self.what()}, hit {self.hits} time{'s' if self.hits != 1 else ''}"
+
+
+class MemoWatch(Watchpoint):
+    """Stops when a different object is stored in memo slot `slot`."""
+    opcodes = MEMO_WRITES
+
+    def __init__(self, number: int, slot: int):
+        super().__init__(number)
+        self.slot = slot
+
+    def before(self, unpickler):
+        return unpickler.memo.get(self.slot, MISSING)
+
+    def after(self, unpickler, old):
+        new = unpickler.memo.get(self.slot, MISSING)
+        if new is not old:
+            return f"memo[{self.slot}] = {_repr.repr(new)}"
+        return None
+
+    def what(self) -> str:
+        return f"memo {self.slot}"
+
+
+class DepthWatch(Watchpoint):
+    """Stops when `len(stack) <comparison> limit` becomes true.
+
+    The depth is that of `unpickler.stack`, the items above the topmost MARK.
+    Only the handlers that can move the depth towards the condition are
+    wrapped: those that push more than they pop for '>' and '>=', those that
+    pop more than they push (and MARK, which starts an empty stack) for '<'
+    and '<=', and both for '==' and '!='. Opcodes that consume a MARK
+    restore the items below it, so they are wrapped for every comparison.
+    """
+    def __init__(self, number: int, comparison: str, limit: int):
+        super().__init__(number)
+        if comparison not in COMPARISONS:
+            raise PickleDBGError(f"Unknown comparison '{comparison}'")
+        self.comparison = comparison
+        self.compare = COMPARISONS[comparison]
+        self.limit = limit
+
+        grows = comparison in ('>', '>=', '==', '!=')
+        shrinks = comparison in ('<', '<=', '==', '!=')
+        codes = set()
+        for code, entry in enumerate(OPCODE_TABLE):
+            if entry is None:
+                continue
+            op, _, _, pops, pushes, consumes_mark = entry
+            if consumes_mark or (grows and pushes > pops) or \
+               (shrinks and (pops > pushes or op.name == 'MARK')):
+                codes.add(code)
+        self.opcodes = frozenset(codes)
+
+    def before(self, unpickler):
+        return self.compare(len(unpickler.stack), self.limit)
+
+    def after(self, unpickler, was_true):
+        depth = len(unpickler.stack)
+        if not was_true and self.compare(depth, self.limit):
+            return f"stack depth {depth} {self.comparison} {self.limit}"
+        return None
+
+    def what(self) -> str:
+        return f"stack-depth {self.comparison} {self.limit}"
+
+
+class ObjectWatch(Watchpoint):
+    """Stops when APPEND(S), SETITEM(S), ADDITEMS or BUILD mutates the object in memo slot `slot`.
+
+    The object is looked up when each of those opcodes runs, so the watch
+    keeps working after `back` or `restart` replace the memo with copies.
+    """
+    opcodes = frozenset(MUTATORS)
+
+    def __init__(self, number: int, slot: int):
+        super().__init__(number)
+        self.slot = slot
+
+    def before(self, unpickler):
+        target = unpickler.memo.get(self.slot, MISSING)
+        if target is MISSING:
+            return False
+        stack = unpickler.stack
+        depth = MUTATORS[unpickler.current_opcode]
+        if depth is None:
+            below = unpickler.metastack[-1] if unpickler.metastack else ()
+            return bool(below) and below[-1] is target
+        return len(stack) >= depth and stack[-depth] is target
+
+    def after(self, unpickler, mutated):
+        if mutated:
+            return f"memo[{self.slot}] mutated: {_repr.repr(unpickler.memo.get(self.slot))}"
+        return None
+
+    def what(self) -> str:
+        return f"obj {self.slot}"
+
+
+### FUNCTIONS ###
+def instrument(dispatch: dict, watchpoints, hits: list) -> dict:
+    """Returns a copy of `dispatch` with the handlers the watchpoints need wrapped.
+
+    When a watchpoint fires, (watchpoint, message) is appended to `hits`
+    for the execution loop to act on.
+    """
+    watched = dict(dispatch)
+    for code in set().union(*(w.opcodes for w in watchpoints)):
+        if code in dispatch:
+            watchers = tuple(w for w in watchpoints if code in w.opcodes)
+            watched[code] = _wrap(code, dispatch[code], watchers, hits)
+    return watched
+
+
+def _wrap(code: int, handler, watchers: tuple, hits: list):
+    if len(watchers) == 1:
+        # the common case, without the loops
+        (watcher,) = watchers
+        before, after = watcher.before, watcher.after
+
+        def watched_one(unpickler):
+            unpickler.current_opcode = code
+            state = before(unpickler)
+            handler(unpickler)
+            message = after(unpickler, state)
+            if message is not None:
+                hits.append((watcher, message))
+        return watched_one
+
+    def watched(unpickler):
+        unpickler.current_opcode = code
+        states = [w.before(unpickler) for w in watchers]
+        handler(unpickler)
+        for w, state in zip(watchers, states):
+            message = w.after(unpickler, state)
+            if message is not None:
+                hits.append((w, message))
+    return watched
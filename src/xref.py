@@ -0,0 +1,287 @@
+###############################################################################
+#
+# Memo and stack cross-references for pickledbg
+#
+# One pass over the disassembly index records which instructions write and
+# read every memo slot and, by emulating the stack statically, which
+# instructions produced the values each instruction consumes. The records
+# are kept in flat arrays grouped by key, so every lookup is a slice.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+### LOCAL IMPORTS ###
+from disasm import (OPCODE_TABLE, MARK, POP, MEMOIZE, PUT, BINPUT, LONG_BINPUT,
+                    GET, BINGET, LONG_BINGET, memo_slot)
+
+
+### CONSTANTS ###
+MEMO_WRITE_OPCODES = (MEMOIZE, PUT, BINPUT, LONG_BINPUT)
+MEMO_READ_OPCODES = (GET, BINGET, LONG_BINGET)
+
+# how each opcode is handled by the stack emulation
+PLAIN, MARKED, PUSH_MARK, POP_ONE, MEMO_WRITE, MEMO_READ = range(6)
+
+
+def _kinds() -> tuple[list, list, list]:
+    """Builds tables indexed by opcode byte of the kind of each opcode and
+    the stack items it pops and pushes."""
+    kinds = [PLAIN] * 256
+    pops = [0] * 256
+    pushes = [0] * 256
+    for code, entry in enumerate(OPCODE_TABLE):
+        if entry is None:
+            continue
+        _, _, _, pops[code], pushes[code], consumes_mark = entry
+        if consumes_mark:
+            kinds[code] = MARKED
+    kinds[MARK] = PUSH_MARK
+    kinds[POP] = POP_ONE
+    for code in MEMO_WRITE_OPCODES:
+        kinds[code] = MEMO_WRITE
+    for code in MEMO_READ_OPCODES:
+        kinds[code] = MEMO_READ
+    return kinds, pops, pushes
+
+KINDS, POPS, PUSHES = _kinds()
+
+
+### CLASSES ###
+class Groups:
+    """Integer values grouped by integer key, looked up in constant time.
+
+    When the keys are reasonably dense (the usual case for memo slots and
+    instruction indices), the groups are stored in compressed sparse row
+    form: every value ordered by key, and where each key's values start.
+    Sparse keys, such as the huge LONG_BINPUT slots a hostile pickle might
+    use, fall back to a sorted key array and binary search. Within a group,
+    values keep the order they were added in.
+
+    Args:
+        keys (array): The key of each value.
+        values (array): The values, parallel to `keys`.
+    """
+    def __init__(self, keys: array, values: array):
+        count = len(keys)
+        size = max(keys) + 1 if count else 0
+        if size <= 2 * count + 65536:
+            # counting sort: values for key k are at starts[k]:starts[k+1]
+            starts = array('Q', bytes(8 * (size + 1)))
+            for key in keys:
+                starts[key + 1] += 1
+            total = 0
+            for key in range(size + 1):
+                total += starts[key]
+                starts[key] = total
+            fill = starts[:-1]
+            ordered = array('I', bytes(4 * count))
+            for key, value in zip(keys, values):
+                ordered[fill[key]] = value
+                fill[key] += 1
+            self.keys = None
+            self.starts = starts
+            self.values = ordered
+        else:
+            order = sorted(range(count), key=keys.__getitem__)
+            self.keys = array('Q', (keys[i] for i in order))
+            self.starts = None
+            self.values = array('I', (values[i] for i in order))
+
+    @classmethod
+    def from_arrays(cls, arrays: dict, prefix: str) -> "Groups":
+        """Rebuilds groups saved by `arrays()` under `prefix`."""
+        groups = cls.__new__(cls)
+        groups.keys = arrays.get(prefix + ".keys")
+        groups.starts = arrays.get(prefix + ".starts")
+        groups.values = arrays[prefix + ".values"]
+        if (groups.keys is None) == (groups.starts is None):
+            raise ValueError("groups need either keys or starts")
+        return groups
+
+    def arrays(self, prefix: str) -> dict:
+        """Returns the arrays the groups are made of, named with `prefix`."""
+        arrays = {prefix + ".values": self.values}
+        if self.starts is not None:
+            arrays[prefix + ".starts"] = self.starts
+        else:
+            arrays[prefix + ".keys"] = self.keys
+        return arrays
+
+    def get(self, key: int) -> array:
+        """Returns the values for `key`, in the order they were added."""
+        if self.starts is not None:
+            if 0 <= key < len(self.starts) - 1:
+                return self.values[self.starts[key]:self.starts[key+1]]
+            return array('I')
+        start = bisect_left(self.keys, key)
+        return self.values[start:bisect_right(self.keys, key, start)]
+
+
+class CrossReference:
+    """Memo and stack cross-references for every instruction of a disassembly.
+
+    Built in one pass over the disassembly's offsets and opcodes. The stack
+    emulation is static: it tracks which instruction pushed each value, not
+    the values themselves, the same way the disassembler tracks MARKs.
+
+    Args:
+        disasm (Disassembly): The disassembled pickle.
+    """
+    def __init__(self, disasm):
+        self.disasm = disasm
+        # instruction i used the values pushed by the instructions
+        # used[used_starts[i]:used_starts[i+1]]
+        self.used = array('I')
+        self.used_starts = array('I', [0])
+        self.memo_size = 0      # distinct memo slots written
+        self._users = None
+        self._build()
+
+    def _build(self) -> None:
+        disasm = self.disasm
+        data = disasm.data
+        offsets = disasm.offsets
+        kinds, pops, pushes = KINDS, POPS, PUSHES
+        used = self.used
+        used_extend = used.extend
+        used_append = used.append
+        starts_append = self.used_starts.append
+        write_slots, writers = array('Q'), array('I')
+        read_slots, readers = array('Q'), array('I')
+
+        # the producer of each item above the topmost MARK, and for each
+        # enclosing MARK the items below it and the MARK's own instruction
+        stack = []
+        marks = []
+
+        # MEMOIZE stores at the number of distinct slots written so far, so
+        # the slots are only kept once another opcode has written one
+        put_slots = None
+        memo_size = 0
+
+        for i, code in enumerate(disasm.opcodes):
+            kind = kinds[code]
+
+            if kind == PLAIN:
+                n = pops[code]
+                if n:
+                    used_extend(stack[-n:])
+                    del stack[-n:]
+                n = pushes[code]
+                if n == 1:
+                    stack.append(i)
+                elif n:
+                    stack.extend([i] * n)
+
+            elif kind == MEMO_READ or kind == MEMO_WRITE:
+                slot = memo_slot(data, offsets[i], code, memo_size)
+                if kind == MEMO_READ:
+                    stack.append(i)
+                    if slot >= 0:
+                        read_slots.append(slot)
+                        readers.append(i)
+                else:
+                    # the value is stored, not popped
+                    if stack:
+                        used_append(stack[-1])
+                    if slot >= 0:
+                        write_slots.append(slot)
+                        writers.append(i)
+                        if code != MEMOIZE and put_slots is None:
+                            put_slots = set(range(memo_size))
+                        if put_slots is None:
+                            memo_size += 1
+                        elif slot not in put_slots:
+                            put_slots.add(slot)
+                            memo_size += 1
+
+            elif kind == PUSH_MARK:
+                marks.append((stack, i))
+                stack = []
+
+            elif kind == MARKED or (kind == POP_ONE and not stack and marks):
+                if marks:
+                    below, mark = marks.pop()
+                    n = pops[code]
+                    if kind == POP_ONE:
+                        # protocol 0 pickles may POP a MARK
+                        used_append(mark)
+                    else:
+                        if n:
+                            used_extend(below[-n:])
+                            del below[-n:]
+                        used_append(mark)
+                        used_extend(stack)
+                    stack = below
+                else:
+                    used_extend(stack)
+                    stack = []
+                n = pushes[code]
+                if n:
+                    stack.extend([i] * n)
+
+            else:
+                # POP
+                if stack:
+                    used_append(stack.pop())
+
+            starts_append(len(used))
+
+        self.memo_size = memo_size
+        self._writers = Groups(write_slots, writers)
+        self._readers = Groups(read_slots, readers)
+
+    @classmethod
+    def from_arrays(cls, disasm, memo_size: int, arrays: dict) -> "CrossReference":
+        """Rebuilds cross-references from what `arrays()` returned, without a pass over the disassembly."""
+        xref = cls.__new__(cls)
+        xref.disasm = disasm
+        xref.used = arrays["used"]
+        xref.used_starts = arrays["used_starts"]
+        xref.memo_size = memo_size
+        xref._users = None
+        xref._writers = Groups.from_arrays(arrays, "writers")
+        xref._readers = Groups.from_arrays(arrays, "readers")
+        return xref
+
+    def arrays(self) -> dict:
+        """Returns the arrays the cross-references are made of, by name, e.g. to save them."""
+        arrays = {"used": self.used, "used_starts": self.used_starts}
+        arrays.update(self._writers.arrays("writers"))
+        arrays.update(self._readers.arrays("readers"))
+        return arrays
+
+    def memo_writers(self, slot: int) -> array:
+        """Returns the indices of the instructions that write memo slot `slot`."""
+        return self._writers.get(slot)
+
+    def memo_readers(self, slot: int) -> array:
+        """Returns the indices of the instructions that read memo slot `slot`."""
+        return self._readers.get(slot)
+
+    def uses(self, i: int) -> array:
+        """Returns the indices of the instructions that pushed the values instruction `i` uses.
+
+        These are the stack items it pops, bottom first, including the MARK
+        it consumes, if any. For memo writes, it is the stored stack top.
+        """
+        return self.used[self.used_starts[i]:self.used_starts[i+1]]
+
+    def users(self, i: int) -> array:
+        """Returns the indices of the instructions that use the values instruction `i` pushes.
+
+        The reverse index is built the first time this is called.
+        """
+        if self._users is None:
+            owners = array('I', bytes(4 * len(self.used)))
+            starts = self.used_starts
+            for j in range(len(starts) - 1):
+                for k in range(starts[j], starts[j+1]):
+                    owners[k] = j
+            self._users = Groups(self.used, owners)
+        return self._users.get(i)
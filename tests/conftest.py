@@ -0,0 +1,20 @@
+###############################################################################
+#
+# Test configuration for pickledbg
+#
+# The debugger's modules import each other as top-level modules, so src/ is
+# put on the path the same way the benchmarks do.
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import os, sys
+
+
+### CONSTANTS ###
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, "src")
+
+if SRC not in sys.path:
+    sys.path.insert(0, SRC)
@@ -0,0 +1,69 @@
+###############################################################################
+#
+# Tests for conditional breakpoints
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import pickle
+import pytest
+
+
+### LOCAL IMPORTS ###
+from disasm import Disassembly
+from errors import PickleDBGError
+from pickledbg import DbgUnpickler
+from source import PickleSource
+
+
+### CONSTANTS ###
+# three BININT1 at addresses 2, 4 and 6, then TUPLE3 at 8
+THREE_INTS = b"\x80\x02K\x01K\x02K\x03\x87."
+
+
+### FUNCTIONS ###
+def debugger(data: bytes) -> DbgUnpickler:
+    unpickler = DbgUnpickler(PickleSource(data).reader(), disasm=Disassembly(data))
+    unpickler.setup_machine()
+    return unpickler
+
+
+def stops(unpickler: DbgUnpickler) -> list[int]:
+    """Runs to the end, returning the address execution stopped at each time."""
+    found = []
+    with pytest.raises(pickle._Stop):
+        while True:
+            unpickler.run()
+            found.append(unpickler.curr_addr())
+    return found
+
+
+@pytest.mark.parametrize("condition, addresses", [
+    (None, [2, 4, 6]),
+    ("len(stack) == 2", [6]),
+    ("proto == 2 and addr > 2", [4, 6]),
+    ("stack and stack[-1] == 1 and not metastack and not memo", [4]),
+    ("False", []),
+])
+def test_condition_is_evaluated_at_each_address(condition, addresses):
+    unpickler = debugger(THREE_INTS)
+    bp = unpickler.set_breakpoint(opcode="binint1", condition=condition)
+    assert stops(unpickler) == addresses
+    assert bp.hits == len(addresses)
+    assert bp.describe().startswith("opcode BININT1 (3 locations)" + (f" if {condition}" if condition else ""))
+
+
+def test_condition_that_raises_stops():
+    unpickler = debugger(THREE_INTS)
+    unpickler.set_breakpoint(addr=4, condition="stack[5]")
+    unpickler.run()
+    assert unpickler.curr_addr() == 4
+    assert unpickler.stop_reason == "Breakpoint 1 condition raised IndexError: list index out of range"
+
+
+def test_invalid_condition_is_rejected():
+    unpickler = debugger(THREE_INTS)
+    with pytest.raises(PickleDBGError, match="Invalid breakpoint condition"):
+        unpickler.set_breakpoint(addr=4, condition="len(stack) ==")
+    assert not unpickler.breakpoints and not unpickler.break_addrs
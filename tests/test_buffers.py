@@ -0,0 +1,75 @@
+###############################################################################
+#
+# Tests for out-of-band buffers given with --buffer
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import pickle
+from pickle import PickleBuffer
+import pytest
+
+
+### LOCAL IMPORTS ###
+from disasm import Disassembly
+from errors import PickleDBGError, UnpicklingError
+from pickledbg import DbgUnpickler, open_buffers
+from source import PickleSource
+
+
+### FUNCTIONS ###
+@pytest.fixture
+def dumped(tmp_path):
+    """Returns (pickle, buffer specs) of a protocol 5 pickle with a writable, a read-only and an empty buffer."""
+    buffers = []
+    data = pickle.dumps([PickleBuffer(bytearray(b"abc")), "inline", PickleBuffer(b"xyz"),
+                         PickleBuffer(bytearray())], protocol=5, buffer_callback=buffers.append)
+    specs = []
+    # given out of order, numbered as NEXT_BUFFER consumes them
+    for i, buffer in reversed(list(enumerate(buffers))):
+        path = tmp_path / f"buffer{i}"
+        path.write_bytes(buffer.raw())
+        specs.append(f"{i}={path}")
+    return data, specs
+
+
+def debugger(data: bytes, buffers) -> DbgUnpickler:
+    unpickler = DbgUnpickler(PickleSource(data).reader(), disasm=Disassembly(data), buffers=buffers)
+    unpickler.setup_machine()
+    return unpickler
+
+
+def test_buffers_are_attached_in_order(dumped):
+    data, specs = dumped
+    unpickler = debugger(data, open_buffers(specs))
+    for _ in range(2):
+        with pytest.raises(pickle._Stop) as stop:
+            unpickler.run()
+        value = stop.value.value
+        assert [bytes(item) if not isinstance(item, str) else item for item in value] == \
+            [b"abc", "inline", b"xyz", b""]
+        # READONLY_BUFFER made the mapped buffer read-only, as it was dumped
+        assert memoryview(value[2]).readonly
+        # and going back hands them out again from the first
+        unpickler.restart_machine()
+
+
+def test_too_few_buffers(dumped):
+    data, specs = dumped
+    unpickler = debugger(data, open_buffers(sorted(specs)[:2]))
+    with pytest.raises(UnpicklingError, match="not enough out-of-band buffers"):
+        unpickler.run()
+    with pytest.raises(UnpicklingError, match="no \\*buffers\\* argument"):
+        debugger(data, None).run()
+
+
+@pytest.mark.parametrize("specs, message", [
+    (["0"], "Invalid buffer '0', expected N=FILE"),
+    (["x=file"], "Invalid buffer 'x=file', expected N=FILE"),
+    (["0=a", "0=b"], "Buffer 0 given more than once"),
+    (["0=a", "2=b"], "missing 1"),
+])
+def test_invalid_specs(specs, message):
+    with pytest.raises(PickleDBGError, match=message):
+        open_buffers(specs)
@@ -0,0 +1,62 @@
+###############################################################################
+#
+# Tests for the persistent index cache
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import pickle, threading
+import pytest
+
+
+### LOCAL IMPORTS ###
+import cache
+from cache import IndexCache, MIN_INSTRUCTIONS
+from disasm import Disassembly
+from xref import CrossReference
+
+
+### FUNCTIONS ###
+@pytest.fixture
+def large(tmp_path):
+    """Returns (path, disassembly) of a pickle with enough instructions to be cached."""
+    # memoized strings, so there are memo slots to cross-reference
+    strings = [f"s{i}" for i in range(MIN_INSTRUCTIONS // 2)]
+    data = pickle.dumps(strings + strings, protocol=2)
+    path = tmp_path / "large.pkl"
+    path.write_bytes(data)
+    disasm = Disassembly(data)
+    assert len(disasm) >= MIN_INSTRUCTIONS
+    return str(path), disasm
+
+
+def test_xref_is_never_hashed_on_the_caller(tmp_path, large, monkeypatch):
+    path, disasm = large
+    hashing = threading.Event()
+    release = threading.Event()
+    real_hash = cache.content_hash
+
+    def slow_hash(data):
+        hashing.set()
+        assert release.wait(10)
+        return real_hash(data)
+    monkeypatch.setattr(cache, "content_hash", slow_hash)
+
+    entries = IndexCache(str(tmp_path / "cache"), 1 << 30, path)
+    # no record of the file yet, so it's a miss rather than a hash
+    assert entries.load_xref(disasm) is None
+    assert not hashing.is_set()
+
+    xref = CrossReference(disasm)
+    entries.save_xref(xref)
+    assert hashing.wait(10)
+    release.set()
+    entries.wait()
+
+    # the record written with the entry finds it without hashing
+    monkeypatch.setattr(cache, "content_hash", None)
+    loaded = IndexCache(str(tmp_path / "cache"), 1 << 30, path).load_xref(disasm)
+    assert loaded is not None
+    assert list(loaded.memo_writers(7)) == list(xref.memo_writers(7))
+    assert list(loaded.memo_readers(7)) == list(xref.memo_readers(7))
@@ -0,0 +1,85 @@
+###############################################################################
+#
+# Tests for the budgeted Renderer and its preview cache
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import pickle
+import pytest
+
+
+### LOCAL IMPORTS ###
+from colors import Renderer
+from pickledbg import DbgUnpickler
+from source import PickleSource
+
+
+### CONSTANTS ###
+shared = [1, 2]
+VALUES = [
+    # the inner list and dict are changed after the outer ones are built
+    [[shared, {"a": shared}], [], {"b": {1, 2}}, shared],
+    {"x": [[0] * 3 for _ in range(5)], "y": {"z": {}}},
+    [{frozenset({1}): [b"x", 2.5]}, (shared, shared)],
+]
+
+
+### FUNCTIONS ###
+def frames(unpickler):
+    """Yields after every instruction until the pickle finishes."""
+    unpickler.setup_machine()
+    try:
+        while True:
+            unpickler.run(count=1)
+            yield
+    except pickle._Stop:
+        return
+
+
+@pytest.mark.parametrize("protocol", range(pickle.HIGHEST_PROTOCOL + 1))
+@pytest.mark.parametrize("value", VALUES)
+def test_cached_previews_match_uncached(value, protocol):
+    unpickler = DbgUnpickler(PickleSource(pickle.dumps(value, protocol)).reader())
+    cached = unpickler.renderer
+    for _ in frames(unpickler):
+        fresh = Renderer(cached.max_items, cached.max_depth, cached.max_width)
+        for renderer in (cached, fresh):
+            renderer.memo = unpickler.memo
+        assert cached.render_items(unpickler.stack) == fresh.render_items(unpickler.stack)
+        assert cached.render_mapping(unpickler.memo) == fresh.render_mapping(unpickler.memo)
+        cached.end_frame()
+
+
+def test_touch_only_invalidates_previews_containing_the_container():
+    renderer = Renderer()
+    inner, other = [1], [2]
+    outer = [inner]
+    first = renderer.render(outer), renderer.render(other)
+    renderer.end_frame()
+    inner.append(3)
+    renderer.touch(inner)
+    assert renderer.render(outer) != first[0]
+    entry = renderer._cache[id(other)]
+    # not rendered again
+    assert renderer.render(other) is entry[2]
+
+
+def test_cached_preview_keeps_its_value_alive():
+    renderer = Renderer()
+    renderer.render([1, 2, 3])
+    renderer.end_frame()
+    # the id of the rendered list can't be given to a new list while it is cached
+    assert renderer.render([4, 5, 6]) == Renderer().render_value([4, 5, 6])
+
+
+def test_memo_labels_only_name_the_slot_holding_the_object():
+    renderer = Renderer()
+    a, b = [1], [2]
+    memo = renderer.memo = {0: a}
+    assert "<memo 0>" in renderer.render_value([a, a])
+    # overwriting the slot, as a crafted PUT can, doesn't leave a wrong label behind
+    memo[0] = b
+    assert "<memo 0>" not in renderer.render_value([a, a])
+    assert "<ref>" in renderer.render_value([a, a])
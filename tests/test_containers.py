@@ -0,0 +1,109 @@
+###############################################################################
+#
+# Tests for opening pickles inside containers
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import gzip, lzma, pickle, sys, types, zipfile
+import pytest
+
+
+### LOCAL IMPORTS ###
+from containers import open_source, LazyArray
+from disasm import Disassembly
+from pickledbg import open_unpickler
+
+
+### CONSTANTS ###
+VALUE = {"weights": [1.5, 2.5], "name": "model"}
+DATA = pickle.dumps(VALUE, protocol=4)
+ARRAY = bytes(range(24))     # the data of a float64 array of 3 items
+
+
+### FUNCTIONS ###
+def load(source):
+    """Runs a debugger over `source` to the end and returns the value."""
+    unpickler = open_unpickler(source, Disassembly(source.data))
+    unpickler.setup_machine()
+    with pytest.raises(pickle._Stop) as stop:
+        unpickler.run()
+    return stop.value.value
+
+
+def joblib_dump(monkeypatch) -> tuple[bytes, int]:
+    """Returns a pickle written like a joblib dump of a float64 array, and the offset of the array's data.
+
+    joblib and numpy are stood in for by modules that only exist while pickling.
+    """
+    joblib = types.ModuleType("joblib")
+    numpy_pickle = types.ModuleType("joblib.numpy_pickle")
+    numpy = types.ModuleType("numpy")
+
+    class NumpyArrayWrapper:
+        __module__ = "joblib.numpy_pickle"
+        __qualname__ = "NumpyArrayWrapper"
+
+    class dtype:
+        __module__ = "numpy"
+        __qualname__ = "dtype"
+
+        def __reduce__(self):
+            return dtype, ("f8", False, True), (3, "<", None, None, None, -1, -1, 0)
+
+    numpy_pickle.NumpyArrayWrapper = NumpyArrayWrapper
+    numpy.dtype = dtype
+    for module in (joblib, numpy_pickle, numpy):
+        monkeypatch.setitem(sys.modules, module.__name__, module)
+
+    wrapper = NumpyArrayWrapper()
+    wrapper.__dict__.update(subclass=None, shape=(3,), order="C", dtype=dtype(), allow_mmap=True)
+    # the array's data follows the wrapper's BUILD
+    head = pickle.dumps(wrapper, protocol=2)[:-1]
+    return head + ARRAY + b".", len(head)
+
+
+@pytest.mark.parametrize("compress, kind", [
+    (gzip.compress, "gzip"),
+    (lzma.compress, "xz"),
+    (lambda data: data, "pickle"),
+])
+def test_compressed(tmp_path, compress, kind):
+    path = tmp_path / "value.pkl"
+    path.write_bytes(compress(DATA))
+    source = open_source(str(path))
+    assert source.kind == kind
+    assert bytes(source.data) == DATA
+    assert load(source) == VALUE
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_torch_zip(tmp_path, compression):
+    path = tmp_path / "model.pt"
+    with zipfile.ZipFile(path, "w", compression) as archive:
+        archive.writestr("model/version", "3\n")
+        archive.writestr("model/extra.pkl", pickle.dumps("other"))
+        archive.writestr("model/data.pkl", DATA)
+    source = open_source(str(path))
+    assert (source.kind, source.name) == ("torch zip", f"{path}:model/data.pkl")
+    assert bytes(source.data[:len(DATA)]) == DATA
+    assert load(source) == VALUE
+
+    assert load(open_source(str(path), member="model/extra.pkl")) == "other"
+
+
+def test_joblib_arrays_are_stubbed(tmp_path, monkeypatch):
+    data, offset = joblib_dump(monkeypatch)
+    path = tmp_path / "array.joblib"
+    path.write_bytes(gzip.compress(data))
+    monkeypatch.undo()
+
+    source = open_source(str(path))
+    assert source.kind == "joblib (gzip)"
+    (array,) = source.payloads.values()
+    assert (array.dtype, array.shape, array.offset, array.length) == ("float64", (3,), offset, len(ARRAY))
+
+    value = load(source)
+    assert isinstance(value, LazyArray)
+    assert value.offset == offset
@@ -0,0 +1,82 @@
+###############################################################################
+#
+# Tests for the differential runner
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import pickle, struct
+
+
+### LOCAL IMPORTS ###
+import diff
+from diff import diff_file, narrow, prefix
+from disasm import Disassembly
+
+
+### CONSTANTS ###
+# APPENDS to an int with no items: the Python unpickler looks up `append`
+# and raises, the C one returns without touching it
+APPENDS_TO_INT = b"K\x01K\x02(e."
+
+
+### FUNCTIONS ###
+def framed(body: bytes) -> bytes:
+    """Returns a protocol 4 pickle of `body` in a single frame."""
+    return b"\x80\x04\x95" + struct.pack("<Q", len(body)) + body
+
+
+def write(tmp_path, data: bytes) -> str:
+    path = tmp_path / "case.pkl"
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_engines_agree(tmp_path):
+    report = diff_file(write(tmp_path, pickle.dumps({"a": [1, (2, 3)], "b": {4}}, protocol=4)))
+    assert report["result"] == "agree"
+    assert report["python"] == report["c"]
+    assert report["address"] is None and report["reason"] is None
+
+
+def test_one_engine_raises(tmp_path):
+    report = diff_file(write(tmp_path, APPENDS_TO_INT))
+    assert report["result"] == "diverge"
+    assert (report["address"], report["opcode"]) == (5, "APPENDS")
+    assert report["python"].startswith("raised AttributeError")
+    assert report["c"] == "returned 2"
+    assert report["reason"].startswith("python raised AttributeError")
+
+
+def test_narrow_bisects_prefixes_of_a_framed_pickle(tmp_path, monkeypatch):
+    # unpicklers read a frame at once, so only prefixes place the failure in it
+    body = b"K\x00" * 60 + APPENDS_TO_INT[:-1] + b"K\x00" * 20 + b"."
+    data = framed(body)
+    disasm = Disassembly(data)
+    appends = disasm.offsets.index(3 + 8 + 120 + 5)
+    assert disasm.opcodes[appends] == ord("e")
+
+    for count in (1, appends, len(disasm) - 1):
+        assert b"\x95" not in prefix(data, disasm, count)
+
+    rounds = []
+    run_both = diff.run_both
+    def counting(path, probes, *args):
+        if probes is not None:
+            rounds.append(len(probes))
+        return run_both(path, probes, *args)
+    monkeypatch.setattr(diff, "PROBES_PER_ROUND", 4)
+    monkeypatch.setattr(diff, "run_both", counting)
+
+    path = write(tmp_path, data)
+    index, found = narrow(path, data, disasm, "ASCII", 10, 1024)
+    assert index == appends
+    assert not found["python"]["ok"] and found["c"]["ok"]
+    assert len(rounds) > 1 and max(rounds) <= 5
+
+    # the offset the Python unpickler failed at is the end of the frame
+    rounds.clear()
+    report = diff_file(path)
+    assert rounds
+    assert (report["address"], report["opcode"]) == (disasm.offsets[appends], "APPENDS")
@@ -0,0 +1,50 @@
+###############################################################################
+#
+# Tests for the lazy disassembly index
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import io, pickle, pickletools
+import pytest
+
+
+### LOCAL IMPORTS ###
+from disasm import Disassembly
+from source import PickleSource
+
+
+### FUNCTIONS ###
+@pytest.mark.parametrize("protocol", range(pickle.HIGHEST_PROTOCOL + 1))
+def test_export_matches_pickletools(protocol):
+    data = pickle.dumps([{"a": [1, 2], "b": ("x", b"y")}, {1, 2}, "x"], protocol)
+    out, expected = io.StringIO(), io.StringIO()
+    Disassembly(data).export(out)
+    pickletools.dis(data, out=expected)
+    assert out.getvalue() == expected.getvalue()
+
+
+def test_memoize_labels_count_slots_in_any_order():
+    data = pickle.dumps([[i] for i in range(5000)], protocol=4)
+    disasm = Disassembly(data)
+    lines = [i for i in range(len(disasm)) if disasm.opcodes[i] == 0x94]
+    # out of order, so later writes are found before earlier ones are asked for
+    for i in lines[::-997] + lines[:5]:
+        assert disasm.line(i).endswith("(as %d)" % lines.index(i))
+
+
+@pytest.mark.parametrize("data, slot", [
+    # BINPUT writes slot 0 twice, so the MEMOIZE stores at len(memo) == 1
+    (b"\x80\x04K\x01q\x00K\x02q\x00K\x03\x94h\x01.", 1),
+    # slot 1 is written first, so the MEMOIZE overwrites it
+    (b"\x80\x04K\x01q\x01K\x03\x94h\x01.", 1),
+    (b"\x80\x04K\x01\x94K\x02q\x05K\x03\x94h\x02.", 2),
+])
+def test_memoize_label_is_the_slot_the_unpickler_uses(data, slot):
+    unpickler = pickle._Unpickler(PickleSource(data).reader())
+    unpickler.load()
+    disasm = Disassembly(data)
+    i = bytes(disasm.opcodes).rindex(b"\x94")
+    assert disasm.line(i).endswith("(as %d)" % slot)
+    assert unpickler.memo[slot] == 3
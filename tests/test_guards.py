@@ -0,0 +1,77 @@
+###############################################################################
+#
+# Tests for the resource guards
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import pickle, struct
+import pytest
+
+
+### LOCAL IMPORTS ###
+import guards
+from disasm import Disassembly
+from pickledbg import DbgUnpickler
+from source import PickleSource
+
+
+### CONSTANTS ###
+# twenty ints pushed above a MARK, then made into a list
+TWENTY_ON_STACK = b"(" + b"K\x07" * 20 + b"l."
+# the same ints appended to a list, ten at a time
+TWO_APPENDS = b"]" + (b"(" + b"K\x07" * 10 + b"e") * 2 + b"."
+# ten ints memoized and popped, so only the memo grows
+TEN_MEMOIZED = b"\x80\x04" + b"K\x07\x940" * 10 + b"N."
+# a call that allocates 48 MB at once, b'x' * (48 << 20)
+CALL = b"\x80\x03coperator\nmul\nC\x01xJ" + struct.pack("<i", 48 << 20) + b"\x86R."
+
+
+### FUNCTIONS ###
+def debugger(data: bytes) -> DbgUnpickler:
+    unpickler = DbgUnpickler(PickleSource(data).reader(), disasm=Disassembly(data))
+    unpickler.setup_machine()
+    return unpickler
+
+
+@pytest.mark.parametrize("data, option, limit, executed, reason", [
+    (TWENTY_ON_STACK, "max-instructions", 5, 5, "5 instructions executed, max-instructions is 5"),
+    (TWENTY_ON_STACK, "max-container-len", 10, 12, "stack holds 11 items, max-container-len is 10"),
+    (TEN_MEMOIZED, "max-container-len", 4, 16, "memo holds 5 entries, max-container-len is 4"),
+    (TWO_APPENDS, "max-container-len", 15, 25, "list of 20 items on top of the stack, max-container-len is 15"),
+    # a limit above what the process uses now, which only the call crosses
+    (CALL, "max-memory-mb", None, 6, "MB after a call"),
+])
+def test_guards_stop_until_the_limit_is_raised(monkeypatch, data, option, limit, executed, reason):
+    # sample often, so short pickles cross the sampled limits
+    monkeypatch.setattr(guards, "SAMPLE_INTERVAL", 4)
+    if limit is None:
+        limit = (guards.rss_bytes() >> 20) + 24
+    unpickler = debugger(data)
+    unpickler.do_set(f"{option} {limit}")
+    unpickler.run()
+    assert unpickler.executed == executed
+    assert unpickler.stop_reason.startswith("Guard: ")
+    assert reason in unpickler.stop_reason
+    assert unpickler.stop_reason.endswith(f"Enter 'set {option} <n>' with a higher limit, or 0 for none, to continue")
+    assert unpickler.guards.hits == 1
+
+    # nothing runs while the limit is still crossed
+    unpickler.run(count=1)
+    assert unpickler.executed == executed
+    assert option in unpickler.stop_reason
+
+    unpickler.do_set(f"{option} 0")
+    with pytest.raises(pickle._Stop):
+        unpickler.run()
+
+
+def test_raising_a_limit_moves_it():
+    unpickler = debugger(TWENTY_ON_STACK)
+    unpickler.do_set("max-instructions 5")
+    unpickler.run()
+    unpickler.do_set("max-instructions 8")
+    unpickler.run()
+    assert unpickler.executed == 8
+    assert unpickler.guards.hits == 2
@@ -0,0 +1,89 @@
+###############################################################################
+#
+# Tests for the execution heatmap of pickles that seek their own input
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import pickle, struct
+import pytest
+
+
+### LOCAL IMPORTS ###
+from disasm import Disassembly
+from pickledbg import DbgUnpickler
+from source import PickleSource
+
+
+### FUNCTIONS ###
+def looping_pickle(iterations: int) -> bytes:
+    """Returns a pickle that jumps back to a loop body `iterations` times with `pickle.f.seek()`.
+
+    Like `examples/sickle.pickle`, it reaches the file object being read
+    through a global named `f`, here in the `pickle` module. The seek
+    targets are popped from a list, the last one leaving the loop.
+    """
+    def binint(n: int) -> bytes:
+        return b"J" + struct.pack("<i", n)
+
+    prefix = (b"cbuiltins\ngetattr\n" + b"cpickle\nf\n" + b"X\x04\x00\x00\x00seek" + b"\x86R" + b"q\x00" + b"0"
+              + b"]" + b"(" + binint(0) * (iterations + 1) + b"e" + b"q\x01" + b"0"
+              + b"N")
+    loop = len(prefix)
+    # discard what seek() returned, then seek to the next target
+    body = (b"0" + b"h\x00" + b"cbuiltins\ngetattr\n" + b"h\x01" + b"X\x03\x00\x00\x00pop" + b"\x86R"
+            + b")R" + b"\x85R")
+    end = loop + len(body)
+    targets = [end] + [loop] * iterations
+    prefix = prefix.replace(binint(0) * (iterations + 1), b"".join(binint(t) for t in targets))
+    return prefix + body + b"0" + b"N."
+
+
+def heat(unpickler) -> tuple:
+    return bytes(unpickler.heatmap.counts), dict(unpickler.heatmap.jumps)
+
+
+@pytest.fixture
+def looping():
+    """Returns a started debugger on a looping pickle."""
+    source = PickleSource(looping_pickle(5))
+    unpickler = DbgUnpickler(source.reader(), disasm=Disassembly(source.data))
+    unpickler.index_built()
+    unpickler.checkpoints.configure(4, 4)
+    unpickler.setup_machine()
+    return unpickler
+
+
+def test_loop_counts(looping):
+    with pytest.raises(pickle._Stop):
+        looping.run()
+    counts = looping.heatmap.counts
+    body = looping.disasm.line_of(looping.heatmap.loops()[0][0])
+    assert looping.heatmap.loops()[0][2] == 5
+    assert counts[body] == 6
+    assert counts[0] == 1 and counts[len(looping.addresses) - 1] == 1
+
+
+def test_back_and_restart_roll_back_the_heatmap(looping):
+    heats = [heat(looping)]
+    with pytest.raises(pickle._Stop):
+        while True:
+            looping.run(count=1)
+            heats.append(heat(looping))
+    # STOP is counted, though it raises before it finishes executing
+    final = heat(looping)
+    total = looping.executed
+
+    for back in (1, 7, 13, total - 3, 2):
+        looping.step_back(back)
+        assert heat(looping) == heats[looping.executed]
+    with pytest.raises(pickle._Stop):
+        looping.run()
+    assert heat(looping) == final
+
+    looping.step_back(looping.executed)
+    assert heat(looping) == heats[0]
+    with pytest.raises(pickle._Stop):
+        looping.run()
+    assert heat(looping) == final
@@ -0,0 +1,97 @@
+###############################################################################
+#
+# Tests for the Python hooks plugins register
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import pickle
+import pytest
+
+
+### LOCAL IMPORTS ###
+from disasm import Disassembly
+from pickledbg import DbgUnpickler
+from source import PickleSource
+
+
+### CONSTANTS ###
+# three BININT1 at addresses 2, 4 and 6, then TUPLE3 at 8
+THREE_INTS = b"\x80\x02K\x01K\x02K\x03\x87."
+
+
+### FUNCTIONS ###
+def debugger(data: bytes) -> DbgUnpickler:
+    unpickler = DbgUnpickler(PickleSource(data).reader(), disasm=Disassembly(data))
+    unpickler.setup_machine()
+    return unpickler
+
+
+def test_address_hook_only_fires_at_its_address():
+    unpickler = debugger(THREE_INTS)
+    seen = []
+    unpickler.on_address(4, lambda d: seen.append(d.curr_addr()))
+    with pytest.raises(pickle._Stop):
+        unpickler.run()
+    assert seen == [4]
+
+
+def test_hooks_run_in_order_around_the_instruction():
+    unpickler = debugger(THREE_INTS)
+    events = []
+
+    def hook(name):
+        return lambda d: events.append((name, d.curr_addr(), len(d.stack)))
+    unpickler.on_address(4, hook("address after"), after=True)
+    unpickler.on_address(4, hook("address before"))
+    unpickler.on_opcode("BININT1", hook("opcode after"), after=True)
+    unpickler.on_opcode("binint1", hook("opcode before"))
+    unpickler.run(count=3)
+    assert events[2:] == [
+        ("opcode before", 4, 1),
+        ("address before", 4, 1),
+        ("opcode after", 4, 2),
+        ("address after", 4, 2),
+    ]
+
+
+@pytest.mark.parametrize("function, reason", [
+    (lambda d: "found it", "found it"),
+    (lambda d: d.curr_addr() == 4, "stopped at 4"),
+    (lambda d: 1 / 0, "raised ZeroDivisionError: division by zero"),
+])
+def test_hooks_stop_execution(function, reason):
+    unpickler = debugger(THREE_INTS)
+    hook = unpickler.on_address(4, function)
+    unpickler.run()
+    assert unpickler.executed == 3
+    assert unpickler.stop_reason == f"{hook.title}: {reason}"
+    assert unpickler.stopped_by == [hook]
+    assert hook.hits == 1
+
+
+def test_hooks_are_not_called_while_replaying():
+    unpickler = debugger(THREE_INTS)
+    calls = []
+    unpickler.on_opcode("BININT1", lambda d: calls.append(d.curr_addr()))
+    unpickler.run(count=4)
+    assert calls == [2, 4, 6]
+
+    unpickler.step_back(2)
+    assert unpickler.executed == 2
+    assert calls == [2, 4, 6]
+    assert unpickler.hooks.enabled
+
+    unpickler.run(count=1)
+    assert calls == [2, 4, 6, 4]
+
+
+def test_remove_hook_unwraps_the_handler():
+    unpickler = debugger(THREE_INTS)
+    hook = unpickler.on_opcode("BININT1", lambda d: "stop")
+    assert "dispatch" in vars(unpickler)
+    unpickler.remove_hook(hook)
+    assert "dispatch" not in vars(unpickler)
+    with pytest.raises(pickle._Stop):
+        unpickler.run()
@@ -0,0 +1,97 @@
+###############################################################################
+#
+# Tests for recording a trace and replaying it
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import io, re, copy, pickle
+import pytest
+
+
+### LOCAL IMPORTS ###
+import recorder
+from pickledbg import DbgUnpickler
+from recorder import record
+from replay import TraceReader, Replayer
+from screen import Screen
+from source import PickleSource
+
+
+### FUNCTIONS ###
+def strip_colors(text: str) -> str:
+    return re.sub(r"\x1b\[[0-9;]*m", "", text)
+
+
+def value_with_long_frame(width: int) -> tuple:
+    """Returns a value whose pickle has `width` items below the MARK of an inner list."""
+    return tuple(range(width)) + ([f"s{i}" for i in range(10)], {"k": [1, 2]}, "end")
+
+
+def live_states(data: bytes) -> list:
+    """Returns a copy of (stack, metastack, memo) after every instruction of a live run."""
+    unpickler = DbgUnpickler(PickleSource(data).reader())
+    unpickler.setup_machine()
+    states = [copy.deepcopy(([], [], {}))]
+    while True:
+        try:
+            unpickler.run(count=1)
+        except pickle._Stop:
+            stopped = True
+        else:
+            stopped = False
+        states.append(copy.deepcopy((unpickler.stack, unpickler.metastack, unpickler.memo)))
+        if stopped:
+            return states
+
+
+@pytest.fixture
+def trace(tmp_path, monkeypatch):
+    """Returns (trace reader, pickle) for a recorded pickle with keyframes every few instructions."""
+    monkeypatch.setattr(recorder, "KEYFRAME_MIN", 8)
+    data = pickle.dumps(value_with_long_frame(60), protocol=2)
+    path = tmp_path / "trace.bin"
+    with open(path, "wb") as out:
+        record(DbgUnpickler(PickleSource(data).reader()), out)
+    reader = TraceReader(str(path))
+    yield reader, data
+    reader.close()
+
+
+def test_replay_matches_a_live_run(trace):
+    reader, data = trace
+    states = live_states(data)
+    assert reader.count == len(states) - 1
+    assert len(reader.kf_insn) > 2
+
+    replayer = Replayer(reader)
+    # forwards, backwards and across keyframes
+    for n in list(range(0, reader.count, 7)) + [reader.count, 3, reader.count - 1, 0]:
+        replayer.goto(n)
+        position = replayer.position
+        built = {}
+        materialize = lambda oids: [reader.materialize(oid, n, built) for oid in oids]
+        stack, metastack, memo = states[n]
+        assert materialize(position.stack) == stack
+        assert [materialize(frame) for frame in position.metastack] == metastack
+        assert {key: reader.materialize(oid, n, built) for key, oid in position.memo.items()} == memo
+
+
+def test_long_metastack_frames_are_not_padded(trace):
+    reader, data = trace
+    out = io.StringIO()
+    replayer = Replayer(reader)
+    replayer.screen = Screen(out)
+    # the inner list's MARK, with the 60 tuple items below it
+    replayer.goto(next(n for n, (_, metastack, _) in enumerate(live_states(data))
+                       if metastack and len(metastack[-1]) > replayer.renderer.max_items))
+    frame = replayer.position.metastack[-1]
+    assert len(frame) > replayer.renderer.max_items
+    replayer.print_state()
+    text = out.getvalue()
+    assert "None" not in text
+    # the frame's first items, then the rest counted in the last slot
+    shown = replayer.renderer.max_items - 1
+    assert ", ".join(str(i) for i in range(shown)) in strip_colors(text)
+    assert f"...{len(frame) - shown} more" in text
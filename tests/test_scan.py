@@ -0,0 +1,62 @@
+###############################################################################
+#
+# Tests for the corpus scanner
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import os, pickle
+import pytest
+
+
+### LOCAL IMPORTS ###
+import scan
+
+
+### FUNCTIONS ###
+def address_space_mb() -> int:
+    """Returns the address space this process uses in MB, which forked workers start with."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmSize:"):
+                return int(line.split()[1]) // 1024
+    pytest.skip("no /proc/self/status")
+
+
+def crash_on_crash_files(path: str, timeout: float = 0) -> dict:
+    """Stands in for `scan_file`, killing the worker on files named crash*."""
+    with open(path + ".attempts", "a") as f:
+        f.write("x")
+    if os.path.basename(path).startswith("crash"):
+        os._exit(1)
+    return {"path": path, "verdict": "safe", "error": None}
+
+
+@pytest.mark.skipif(scan.resource is None, reason="no address-space limits")
+def test_file_larger_than_memory_cap(tmp_path):
+    memory_mb = address_space_mb() + 64
+    path = tmp_path / "big.pkl"
+    with open(path, "wb") as f:
+        # a small pickle followed by sparse padding, like the storages in a PyTorch checkpoint
+        f.write(pickle.dumps({"a": [1, 2, 3]}, protocol=4))
+        f.truncate(2 * memory_mb * 1024 * 1024)
+
+    reports = list(scan.scan([str(path)], jobs=1, memory_mb=memory_mb))
+    assert [(r["error"], r["verdict"]) for r in reports] == [(None, "safe")]
+
+
+def test_worker_crash_only_blames_the_crashing_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(scan, "scan_file", crash_on_crash_files)
+    paths = [str(tmp_path / f"ok{i}.pkl") for i in range(8)]
+    paths.insert(3, str(tmp_path / "crash.pkl"))
+
+    reports = {r["path"]: r for r in scan.scan(paths, jobs=2, memory_mb=0)}
+    assert sorted(reports) == sorted(paths)
+    assert reports[paths[3]]["error"] == scan.WORKER_DIED
+    assert all(reports[path]["error"] is None for path in paths if path != paths[3])
+
+    # once in the pool and once alone; files that weren't running aren't rerun
+    attempts = {path: len(open(path + ".attempts").read()) for path in paths}
+    assert attempts[paths[3]] == 2
+    assert sum(count > 1 for count in attempts.values()) <= 2
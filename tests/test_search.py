@@ -0,0 +1,53 @@
+###############################################################################
+#
+# Tests for searching the disassembly
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import pickle
+import pytest
+
+
+### LOCAL IMPORTS ###
+from disasm import Disassembly
+from pickledbg import DbgUnpickler
+from source import PickleSource
+
+
+### CONSTANTS ###
+# BINUNICODE 'needle' at 6, SHORT_BINBYTES at 19, BINUNICODE 'hay needle' at
+# 28 and BINPUTs at 3, 17, 26, 43, 51 and 54
+DATA = pickle.dumps(["needle", b"ab\x00cd", "hay needle", ("x",)], protocol=3)
+
+
+### FUNCTIONS ###
+@pytest.mark.parametrize("args, description, addresses", [
+    ("opcode binput", "opcode BINPUT", [3, 17, 26, 43, 51, 54]),
+    ("opcode APPENDS", "opcode APPENDS", [56]),
+    ("string needle", "string needle", [6, 28]),
+    ("string 'hay needle'", "string 'hay needle'", [28]),
+    ("bytes 00 63", "bytes 00 63", [19]),
+    # an opcode byte and the start of its argument
+    ("bytes 5806", "bytes 5806", [6]),
+    ("string missing", "string missing", []),
+])
+def test_search_hits(capsys, args, description, addresses):
+    disasm = Disassembly(DATA)
+    debugger = DbgUnpickler(PickleSource(DATA).reader(), disasm=disasm)
+    debugger.do_search(args)
+    assert debugger.search_results == (description, addresses)
+    out = capsys.readouterr().out
+    assert f"{len(addresses)} match" in out
+    for addr in addresses:
+        assert disasm.line(disasm.line_of(addr)) in out
+
+
+@pytest.mark.parametrize("args", ["opcode NOPE", "bytes zz", "string", "regex x"])
+def test_invalid_searches_keep_the_last_results(capsys, args):
+    debugger = DbgUnpickler(PickleSource(DATA).reader(), disasm=Disassembly(DATA))
+    debugger.do_search("opcode APPENDS")
+    debugger.do_search(args)
+    assert "Invalid command" in capsys.readouterr().out
+    assert debugger.search_results == ("opcode APPENDS", [56])
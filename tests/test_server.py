@@ -0,0 +1,120 @@
+###############################################################################
+#
+# Tests for the JSON-RPC debug server
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import json, os, socket, threading, time
+import pytest
+
+
+### LOCAL IMPORTS ###
+import server
+from disasm import Disassembly
+from pickledbg import DbgUnpickler
+from source import PickleSource
+
+
+### CONSTANTS ###
+# three BININT1 at addresses 2, 4 and 6, then TUPLE3 at 8
+THREE_INTS = b"\x80\x02K\x01K\x02K\x03\x87."
+
+
+### CLASSES ###
+class Client:
+    """A JSON-RPC client talking to the server over a unix socket."""
+    def __init__(self, path: str):
+        self.sock = socket.socket(socket.AF_UNIX)
+        self.sock.settimeout(10)
+        self.sock.connect(path)
+        self.file = self.sock.makefile("rwb")
+        self.next_id = 1
+
+    def send(self, line: bytes):
+        self.file.write(line + b"\n")
+        self.file.flush()
+        return json.loads(self.file.readline())
+
+    def call(self, method: str, **params):
+        request_id = self.next_id
+        self.next_id += 1
+        response = self.send(json.dumps({"jsonrpc": "2.0", "id": request_id, "method": method,
+                                         "params": params}).encode())
+        assert response["id"] == request_id
+        assert "error" not in response, response["error"]
+        return response["result"]
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+### FUNCTIONS ###
+@pytest.fixture
+def client(tmp_path):
+    """Returns a client of a server debugging THREE_INTS, and checks it shuts down cleanly."""
+    path = str(tmp_path / "pdbg.sock")
+    unpickler = DbgUnpickler(PickleSource(THREE_INTS).reader(), disasm=Disassembly(THREE_INTS))
+    thread = threading.Thread(target=server.serve, args=(unpickler, "unix:" + path, "three.pickle"))
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not os.path.exists(path):
+        assert time.monotonic() < deadline and thread.is_alive()
+        time.sleep(0.01)
+    connection = Client(path)
+    try:
+        yield connection
+        assert connection.call("shutdown") is True
+    finally:
+        connection.close()
+        thread.join(10)
+    assert not thread.is_alive()
+    assert not os.path.exists(path)
+
+
+def test_debugging_round_trip(client):
+    assert client.call("start")["executed"] == 0
+    point = client.call("set_breakpoint", addr=6)
+    assert (point["number"], point["kind"], point["hits"]) == (1, "breakpoint", 0)
+
+    state = client.call("continue")
+    assert (state["executed"], state["addr"], state["stack_depth"]) == (3, 6, 2)
+    stack = client.call("stack")
+    assert stack["total"] == 2
+    assert [item["preview"] for item in stack["items"]] == ["1", "2"]
+    assert client.call("breakpoints")[0]["hits"] == 1
+
+    state = client.call("back")
+    assert (state["executed"], state["addr"], state["stack_depth"]) == (2, 4, 1)
+    assert client.call("continue")["executed"] == 3
+
+    state = client.call("continue")
+    assert state["finished"]
+    assert state["result"] == "(1, 2, 3)"
+    assert state["stop_reason"] == "Unpickling complete"
+
+    state = client.call("restart")
+    assert (state["executed"], state["finished"]) == (0, False)
+
+
+@pytest.mark.parametrize("line, request_id, code", [
+    (b"{not json", None, server.PARSE_ERROR),
+    (b"[]", None, server.INVALID_REQUEST),
+    (b'{"jsonrpc": "1.0", "id": 7, "method": "info"}', 7, server.INVALID_REQUEST),
+    (b'{"jsonrpc": "2.0", "id": 7, "method": "explode"}', 7, server.METHOD_NOT_FOUND),
+    (b'{"jsonrpc": "2.0", "id": 7, "method": "step", "params": {"steps": 2}}', 7, server.INVALID_PARAMS),
+    (b'{"jsonrpc": "2.0", "id": 7, "method": "step", "params": [0]}', 7, server.INVALID_PARAMS),
+    # not started yet
+    (b'{"jsonrpc": "2.0", "id": 7, "method": "step"}', 7, server.DEBUGGER_ERROR),
+])
+def test_malformed_requests_get_error_objects(client, line, request_id, code):
+    response = client.send(line)
+    assert response["jsonrpc"] == "2.0"
+    assert response["id"] == request_id
+    assert response["error"]["code"] == code
+    assert isinstance(response["error"]["message"], str)
+    assert "result" not in response
+    # and the session carries on
+    assert client.call("info")["name"] == "three.pickle"
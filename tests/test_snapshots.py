@@ -0,0 +1,76 @@
+###############################################################################
+#
+# Tests for checkpoints and reverse stepping
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import pickle, random, collections
+import pytest
+
+
+### LOCAL IMPORTS ###
+from colors import Renderer
+from pickledbg import DbgUnpickler
+from snapshots import StateCopier
+from source import PickleSource
+
+
+### FUNCTIONS ###
+def state(unpickler) -> tuple:
+    renderer = Renderer()
+    renderer.memo = unpickler.memo
+    return (renderer.render_value(unpickler.stack), renderer.render_value(unpickler.metastack),
+            renderer.render_value(unpickler.memo), unpickler.disasm_line_no, unpickler.tell())
+
+
+@pytest.mark.parametrize("protocol", range(pickle.HIGHEST_PROTOCOL + 1))
+def test_back_restores_every_state(protocol):
+    shared = [1]
+    value = [[(i, f"s{i}", [i], {i: shared}, {i}, bytearray(b"x")) for i in range(15)], shared]
+    value.append(value)
+    unpickler = DbgUnpickler(PickleSource(pickle.dumps(value, protocol)).reader())
+    unpickler.checkpoints.configure(50, 4)
+    unpickler.setup_machine()
+    states = [state(unpickler)]
+    with pytest.raises(pickle._Stop):
+        while True:
+            unpickler.run(count=1)
+            states.append(state(unpickler))
+
+    rng = random.Random(protocol)
+    for _ in range(20):
+        target = rng.randrange(unpickler.executed)
+        unpickler.step_back(unpickler.executed - target)
+        assert unpickler.executed == target
+        assert state(unpickler) == states[target]
+        forward = rng.randrange(min(200, len(states) - 2 - target) + 1)
+        if forward:
+            unpickler.run(count=forward)
+        assert state(unpickler) == states[target + forward]
+
+
+def test_copier_copies_plain_containers_only():
+    inner = [1]
+    ordered = collections.OrderedDict(a=inner)
+    original = ([inner, inner], {"k": inner}, (inner, 2), (1, "a"), {3}, bytearray(b"x"), ordered)
+    copier = StateCopier()
+    copy = copier.copy(original)
+    lists, mapping, mixed, atoms, numbers, data, same = copy
+    assert lists[0] is lists[1] is mapping["k"] is mixed[0] is not inner
+    assert atoms is original[3]
+    assert numbers == {3} and numbers is not original[4]
+    assert data == b"x" and data is not original[5]
+    # anything else is shared rather than copied through its own methods
+    assert same is ordered
+    assert copier.items > 0
+
+
+def test_copier_rebinds_methods_of_copied_containers():
+    items = [1, 2]
+    original = [items, items.pop, items.__setitem__, len]
+    copied, pop, setitem, same = StateCopier().copy(original)
+    assert pop() == 2 and setitem(0, 5) is None
+    assert copied == [5] and items == [1, 2]
+    assert same is len
@@ -0,0 +1,49 @@
+###############################################################################
+#
+# Tests for symbolic execution
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import pickle, collections
+from pickle import _Stop
+import pytest
+
+
+### LOCAL IMPORTS ###
+from source import PickleSource
+from symbolic import SymbolicUnpickler
+
+
+### FUNCTIONS ###
+def naive_depths(data: bytes) -> tuple[int, int]:
+    """Returns (max stack, max marks) by summing the whole metastack after every instruction."""
+    unpickler = SymbolicUnpickler(PickleSource(data).reader())
+    unpickler.setup_machine()
+    max_stack = max_marks = 0
+    try:
+        while True:
+            unpickler.dispatch[unpickler.read(1)[0]](unpickler)
+            max_marks = max(max_marks, len(unpickler.metastack))
+            max_stack = max(max_stack, sum(map(len, unpickler.metastack)) + len(unpickler.stack))
+    except _Stop:
+        return max_stack, max_marks
+
+
+def nested(depth: int):
+    value = []
+    for i in range(depth):
+        value = [i, (i, value, {i}), {"k": value}]
+    return value
+
+
+@pytest.mark.parametrize("protocol", range(pickle.HIGHEST_PROTOCOL + 1))
+@pytest.mark.parametrize("value", [nested(40), [(i, [i] * 3) for i in range(2000)],
+                                   collections.OrderedDict(a=[1, (2, 3)], b=frozenset({4}))])
+def test_depths_match_a_full_recount(protocol, value):
+    data = pickle.dumps(value, protocol)
+    unpickler = SymbolicUnpickler(PickleSource(data).reader())
+    unpickler.summarize()
+    assert (unpickler.max_stack, unpickler.max_marks) == naive_depths(data)
+    assert unpickler.max_marks > 0
@@ -0,0 +1,54 @@
+###############################################################################
+#
+# Tests for the headless tracer
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import io, json, pickle
+import pytest
+
+
+### LOCAL IMPORTS ###
+from pickledbg import DbgUnpickler
+from source import PickleSource
+from tracer import trace
+
+
+### FUNCTIONS ###
+def run_trace(data: bytes):
+    """Traces `data`, returning (value or exception, JSONL records)."""
+    out = io.StringIO()
+    try:
+        result = trace(DbgUnpickler(PickleSource(data).reader()), out)
+    except Exception as e:
+        result = e
+    return result, [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+def test_trace_records_every_instruction():
+    data = pickle.dumps([1, "a"], protocol=2)
+    value, records = run_trace(data)
+    assert value == [1, "a"]
+    assert records[0] == {**records[0], "addr": 0, "op": "PROTO"}
+    assert records[-1]["op"] == "STOP"
+
+
+@pytest.mark.parametrize("data", [b"", b"\x80\x04\x95\x10\x00"])
+def test_trace_error_record(data):
+    error, records = run_trace(data)
+    assert isinstance(error, Exception)
+    assert "error" in records[-1]
+    assert isinstance(records[-1]["addr"], int)
+
+
+def test_trace_error_before_first_instruction():
+    # an unpickler whose __init__ wasn't run fails in setup, before any instruction
+    unpickler = DbgUnpickler(io.BytesIO(b"."))
+    del unpickler._file_read
+    out = io.StringIO()
+    with pytest.raises(Exception):
+        trace(unpickler, out)
+    record = json.loads(out.getvalue())
+    assert record["addr"] == 0 and "UnpicklingError" in record["error"]
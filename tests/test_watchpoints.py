@@ -0,0 +1,102 @@
+###############################################################################
+#
+# Tests for memo, stack depth and object watchpoints
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import pickle
+import pytest
+
+
+### LOCAL IMPORTS ###
+from disasm import Disassembly
+from pickledbg import DbgUnpickler
+from source import PickleSource
+
+
+### CONSTANTS ###
+# memo slot 0 is written twice, then slot 1
+OVERWRITE = b"\x80\x04K\x01q\x00K\x02q\x00K\x03q\x01."
+# depths 0 1 2 3 1 2 1 after each instruction
+DEPTHS = b"\x80\x02K\x01K\x02K\x03\x87K\x04\x86."
+# a list and a dict filled by APPENDS and SETITEMS under MARKs
+MUTATED = b"\x80\x02]q\x00(K\x01K\x02e}q\x01(K\x01K\x02uh\x00\x86."
+
+
+### FUNCTIONS ###
+def debugger(data: bytes) -> DbgUnpickler:
+    unpickler = DbgUnpickler(PickleSource(data).reader(), disasm=Disassembly(data))
+    unpickler.setup_machine()
+    return unpickler
+
+
+def stops(unpickler: DbgUnpickler) -> list[tuple[int, str]]:
+    """Runs to the end, returning (instructions executed, stop reason) at every stop."""
+    found = []
+    with pytest.raises(pickle._Stop):
+        while True:
+            unpickler.run()
+            found.append((unpickler.executed, unpickler.stop_reason))
+    return found
+
+
+def test_memo_watch_fires_on_overwrite():
+    unpickler = debugger(OVERWRITE)
+    watch = unpickler.set_watchpoint("memo", slot=0)
+    assert stops(unpickler) == [(3, "Watchpoint 1: memo[0] = 1"), (5, "Watchpoint 1: memo[0] = 2")]
+    assert watch.hits == 2
+
+
+@pytest.mark.parametrize("comparison, limit, expected", [
+    (">=", 3, [4]),
+    (">", 1, [3, 6]),
+    ("<", 2, [5, 7]),
+    ("<=", 1, [5, 7]),
+])
+def test_depth_watch_fires_when_crossing(comparison, limit, expected):
+    unpickler = debugger(DEPTHS)
+    unpickler.set_watchpoint("stack-depth", comparison=comparison, limit=limit)
+    found = stops(unpickler)
+    assert [executed for executed, _ in found] == expected
+    assert all(reason.endswith(f"{comparison} {limit}") for _, reason in found)
+
+
+def test_depth_watch_sees_a_mark_empty_the_stack():
+    unpickler = debugger(b"\x80\x02K\x01(K\x02t\x86.")
+    unpickler.set_watchpoint("stack-depth", comparison="<", limit=1)
+    unpickler.run()
+    assert unpickler.executed == 3
+    assert unpickler.stop_reason == "Watchpoint 1: stack depth 0 < 1"
+
+
+@pytest.mark.parametrize("slot, executed, value", [(0, 7, "[1, 2]"), (1, 13, "{1: 2}")])
+def test_object_watch_fires_on_marked_mutations(slot, executed, value):
+    unpickler = debugger(MUTATED)
+    unpickler.set_watchpoint("obj", slot=slot)
+    unpickler.run()
+    assert unpickler.executed == executed
+    assert unpickler.stop_reason == f"Watchpoint 1: memo[{slot}] mutated: {value}"
+    with pytest.raises(pickle._Stop):
+        unpickler.run()
+
+
+@pytest.mark.parametrize("data, kind, slot", [(OVERWRITE, "memo", 0), (MUTATED, "obj", 1)])
+def test_watches_survive_back_and_restart(data, kind, slot):
+    unpickler = debugger(data)
+    # a checkpoint every other instruction, so going back restores one
+    unpickler.checkpoints.configure(2, 8)
+    unpickler.set_watchpoint(kind, slot=slot)
+    unpickler.run()
+    executed, reason = unpickler.executed, unpickler.stop_reason
+
+    # going back replaces the memo with copies and doesn't fire on the way
+    unpickler.step_back(1)
+    assert unpickler.executed == executed - 1
+    unpickler.run()
+    assert (unpickler.executed, unpickler.stop_reason) == (executed, reason)
+
+    unpickler.restart_machine()
+    unpickler.run()
+    assert (unpickler.executed, unpickler.stop_reason) == (executed, reason)
@@ -0,0 +1,94 @@
+###############################################################################
+#
+# Tests for memo and stack cross-references
+#
+###############################################################################
+
+
+### GLOBAL IMPORTS ###
+import re, pickle
+import pytest
+
+
+### LOCAL IMPORTS ###
+from disasm import Disassembly
+from pickledbg import DbgUnpickler
+from source import PickleSource
+from xref import CrossReference
+
+
+### CONSTANTS ###
+# (2, [2, 3, 2, 3], (1, [2, 3, 2, 3])) built with MARKs nested two deep,
+# where BINPUT 0 reuses the slot MEMOIZE wrote first and BINPUT 1 the one it
+# wrote second
+SLOT_REUSE = (b"\x80\x04"
+              b"("                      # 1  MARK
+              b"K\x01\x94"              # 2  BININT1 1, 3 MEMOIZE (as 0)
+              b"("                      # 4  MARK
+              b"K\x02q\x00"             # 5  BININT1 2, 6 BINPUT 0
+              b"K\x03\x94"              # 7  BININT1 3, 8 MEMOIZE (as 1)
+              b"h\x00h\x01"             # 9  BINGET 0, 10 BINGET 1
+              b"l"                      # 11 LIST
+              b"q\x01\x94"              # 12 BINPUT 1, 13 MEMOIZE (as 2)
+              b"t\x94"                  # 14 TUPLE, 15 MEMOIZE (as 3)
+              b"h\x00h\x02h\x03"        # 16-18 BINGET 0, 2, 3
+              b"\x87.")                 # 19 TUPLE3, 20 STOP
+MEMO_WRITE = re.compile(r"(?:MEMOIZE +\(as |PUT +)(\d+)")
+MEMO_READ = re.compile(r"GET +(\d+)")
+
+
+### FUNCTIONS ###
+def test_memo_slots_match_the_disassembly_labels():
+    disasm = Disassembly(SLOT_REUSE)
+    xref = CrossReference(disasm)
+    assert xref.memo_size == 4
+
+    writers, readers = {}, {}
+    for i in range(len(disasm)):
+        line = disasm.line(i)
+        for pattern, found in ((MEMO_WRITE, writers), (MEMO_READ, readers)):
+            match = pattern.search(line)
+            if match:
+                found.setdefault(int(match.group(1)), []).append(i)
+    assert writers == {0: [3, 6], 1: [8, 12], 2: [13], 3: [15]}
+    for slot in range(xref.memo_size):
+        assert list(xref.memo_writers(slot)) == writers[slot]
+        assert list(xref.memo_readers(slot)) == readers.get(slot, [])
+
+    # and the slots are the ones the unpickler uses
+    unpickler = DbgUnpickler(PickleSource(SLOT_REUSE).reader())
+    unpickler.setup_machine()
+    with pytest.raises(pickle._Stop):
+        unpickler.run()
+    inner = [2, 3, 2, 3]
+    assert unpickler.memo == {0: 2, 1: inner, 2: inner, 3: (1, inner)}
+    assert pickle.loads(SLOT_REUSE) == (2, inner, (1, inner))
+
+
+def test_stack_uses_across_nested_marks():
+    xref = CrossReference(Disassembly(SLOT_REUSE))
+    # the inner MARK and what was pushed above it, none of it from the outer frame
+    assert list(xref.uses(11)) == [4, 5, 7, 9, 10]
+    # the outer MARK, what is above it once the list replaced the inner frame
+    assert list(xref.uses(14)) == [1, 2, 11]
+    # memo writes use the stack top without popping it
+    assert list(xref.uses(12)) == list(xref.uses(13)) == [11]
+    assert list(xref.users(11)) == [12, 13, 14]
+    assert list(xref.users(2)) == [3, 14]
+    assert list(xref.uses(19)) == [16, 17, 18]
+
+
+def test_xref_commands_print_disassembly_lines(capsys):
+    disasm = Disassembly(SLOT_REUSE)
+    debugger = DbgUnpickler(PickleSource(SLOT_REUSE).reader(), disasm=disasm)
+
+    debugger.handle_xref(["memo", "1"])
+    out = capsys.readouterr().out
+    for i in (8, 12, 10):
+        assert disasm.line(i) in out
+    assert disasm.line(13) not in out
+
+    debugger.handle_xref(["addr", str(disasm.offsets[11])])
+    out = capsys.readouterr().out
+    for i in (4, 5, 7, 9, 10, 12, 13, 14):
+        assert disasm.line(i) in out